@@ -0,0 +1,58 @@
+import logging
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import HTTP_USER_AGENT, HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_BACKOFF_FACTOR
+
+
+LOG = logging.getLogger(__name__)
+
+# one keep-alive session per host, shared by all threads; requests' connection pools are thread-safe
+SESSIONS:dict[str, requests.Session] = {}
+SESSIONS_LOCK = Lock()
+
+
+def _make_session() -> requests.Session:
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=[ 429, 500, 502, 503, 504 ],
+        allowed_methods=[ 'GET' ],
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.headers.update({
+        'User-Agent' : HTTP_USER_AGENT,
+        'Accept-Encoding' : 'gzip'
+    })
+
+    return session
+
+
+def get_session(host:str) -> requests.Session:
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(host)
+        if session is None:
+            session = _make_session()
+            SESSIONS[host] = session
+            LOG.debug(f'opened HTTP session for {host}')
+
+    return session
+
+
+def close_sessions() -> None:
+    with SESSIONS_LOCK:
+        for session in SESSIONS.values():
+            session.close()
+        SESSIONS.clear()
+    LOG.debug('closed all HTTP sessions')
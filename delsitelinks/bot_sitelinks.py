@@ -1,4 +1,7 @@
+from collections import OrderedDict
+from functools import cache
 import logging
+from time import time
 from typing import Any, Optional
 
 import pywikibot as pwb
@@ -6,11 +9,70 @@ from pywikibot.exceptions import NoUsernameError, InvalidTitleError, Unsupported
     UnknownFamilyError, UnknownSiteError, APIError, OtherPageSaveError, SiteDefinitionError, \
     NoPageError, InconsistentTitleError
 
-from .config import REPO, EDITSUMMARY_HASHTAG
+from .config import EDITSUMMARY_HASHTAG, CONSOLIDATE_ITEM_EDITS, ENTITY_CACHE_SIZE, ENTITY_CACHE_MAX_AGE
 from .database import LoggingDB
+from .types import SitelinkChange
+from .work_queue import get_run_id
 
 
 LOG = logging.getLogger(__name__)
+MAX_EDIT_SUMMARY_LENGTH:int = 500
+
+# sitelink changes collected across projects if CONSOLIDATE_ITEM_EDITS is set; keyed by qid
+PENDING_SITELINK_CHANGES:dict[str, list[SitelinkChange]] = {}
+
+# items loaded during verification are reused for editing right after; pywikibot sends the loaded
+# revision as baserevid with each edit, so that concurrent changes are detected; keyed by (qid, lastrevid)
+ENTITY_CACHE:OrderedDict[tuple[str, int], tuple[float, pwb.ItemPage]] = OrderedDict()
+
+
+@cache
+def get_repo() -> pwb.site.DataSite:
+    site = pwb.Site('wikidata', 'wikidata')
+    return site.data_repository()
+
+
+def get_item(qid:str, lastrevid:Optional[int]=None, force_reload:bool=False) -> pwb.ItemPage:
+    # the most recently loaded revision of the item, or exactly lastrevid if given; a new (lazy) item otherwise
+    if force_reload is True:
+        invalidate_item(qid)
+
+    for (cached_qid, cached_revid), (cached_at, q_item) in reversed(ENTITY_CACHE.items()):
+        if cached_qid != qid or (lastrevid is not None and cached_revid != lastrevid):
+            continue
+        if time() - cached_at >= ENTITY_CACHE_MAX_AGE:
+            break
+        ENTITY_CACHE.move_to_end((cached_qid, cached_revid))
+        return q_item
+
+    return pwb.ItemPage(get_repo(), qid)
+
+
+def _cache_item(q_item:pwb.ItemPage) -> None:
+    # only loaded items are cached, under their current revision
+    lastrevid = getattr(q_item, '_revid', None)
+    if lastrevid is None:
+        return
+
+    invalidate_item(q_item.getID())
+    ENTITY_CACHE[(q_item.getID(), lastrevid)] = (time(), q_item)
+
+    while len(ENTITY_CACHE) > ENTITY_CACHE_SIZE:
+        ENTITY_CACHE.popitem(last=False)
+
+
+def get_cached_item_revision(qid:str) -> Optional[int]:
+    # revision of the item as last loaded by this process; None if not cached
+    for (cached_qid, cached_revid) in reversed(ENTITY_CACHE.keys()):
+        if cached_qid == qid:
+            return cached_revid
+
+    return None
+
+
+def invalidate_item(qid:str) -> None:
+    for key in [ key for key in ENTITY_CACHE.keys() if key[0] == qid ]:
+        del ENTITY_CACHE[key]
 
 
 def get_site_object(dbname:str) -> pwb.site._basesite.BaseSite:
@@ -24,7 +86,7 @@ def get_site_object(dbname:str) -> pwb.site._basesite.BaseSite:
 
 
 def check_if_item_has_sitelink(qid:str, dbname:str, page_title:str) -> bool:
-    q_item = pwb.ItemPage(REPO, qid)
+    q_item = get_item(qid)
     try:
         if not q_item.exists():
             return False
@@ -40,6 +102,7 @@ def check_if_item_has_sitelink(qid:str, dbname:str, page_title:str) -> bool:
         q_item.get()
     except NoPageError:
         return False
+    _cache_item(q_item)
 
     if not q_item.sitelinks:
         return False
@@ -92,9 +155,19 @@ def check_if_page_is_redirect(dbname:str, page_title:str) -> bool:
 
 def _make_edit_log(page:pwb.page.BasePage, err:Optional[Exception]=None) -> None:
     if err is not None:  # something went wrong --- nothing to log
+        invalidate_item(page.getID())
         return
 
-    LoggingDB.insert_log(page.latest_revision.get('revid'), page.callback_payload)
+    if isinstance(page, pwb.ItemPage):  # the cached item moves on to the new revision
+        _cache_item(page)
+
+    if isinstance(page.callback_payload, list):  # consolidated edit with several sitelink changes
+        callback_payloads = page.callback_payload
+    else:
+        callback_payloads = [ page.callback_payload ]
+
+    for callback_payload in callback_payloads:
+        LoggingDB.insert_log(page.latest_revision.get('revid'), callback_payload, run_id=get_run_id())
 
 
 def _make_edit_summary(dbname:str, page_title:str, edit_summary_log:Optional[str]=None) -> str:
@@ -104,16 +177,124 @@ def _make_edit_summary(dbname:str, page_title:str, edit_summary_log:Optional[str
     return f'remove sitelink "{dbname}:{page_title}" (page does not exist on client wiki{edit_summary_log}) #{dbname}{EDITSUMMARY_HASHTAG}'
 
 
+def _make_consolidated_edit_summary(changes:list[SitelinkChange]) -> str:
+    summaries = [ change.summary.replace(EDITSUMMARY_HASHTAG, '') if EDITSUMMARY_HASHTAG else change.summary for change in changes ]
+    edit_summary = f'{"; ".join(summaries)}{EDITSUMMARY_HASHTAG}'
+
+    if len(edit_summary) <= MAX_EDIT_SUMMARY_LENGTH:
+        return edit_summary
+
+    removed = [ change.dbname for change in changes if change.new_title == '' ]
+    updated = [ change.dbname for change in changes if change.new_title != '' ]
+    parts = []
+    if len(removed) > 0:
+        parts.append(f'remove sitelinks to inexistent pages for {", ".join(removed)}')
+    if len(updated) > 0:
+        parts.append(f'normalize sitelinks for {", ".join(updated)}')
+
+    return f'{"; ".join(parts)}{EDITSUMMARY_HASHTAG}'
+
+
+def _queue_sitelink_change(change:SitelinkChange) -> None:
+    PENDING_SITELINK_CHANGES.setdefault(change.qid, []).append(change)
+    LOG.debug(f'queued sitelink change for {change.dbname} in {change.qid}')
+
+
+def _merge_sitelink_changes(qid:str, changes:list[SitelinkChange]) -> list[SitelinkChange]:
+    # one change per wiki: the last queued one, but a removal beats a normalization
+    merged:dict[str, SitelinkChange] = {}
+    for change in changes:
+        kept = merged.get(change.dbname)
+        if kept is not None and kept.new_title == '' and change.new_title != '':
+            LOG.info(f'Dropped queued normalization of "{change.old_title}" for {change.dbname} in {qid}; the sitelink is removed')
+            continue
+        if kept is not None:
+            LOG.info(f'Dropped queued change of "{kept.old_title}" for {kept.dbname} in {qid}; superseded by a later change')
+        merged[change.dbname] = change
+
+    return list(merged.values())
+
+
+def _apply_item_sitelink_changes(qid:str, changes:list[SitelinkChange]) -> None:
+    q_item = get_item(qid, force_reload=True)  # changes were verified against a revision which may be long outdated
+    try:
+        if not q_item.exists() or q_item.isRedirectPage():
+            return
+        q_item.get()
+    except NoPageError:
+        return
+
+    verified_changes:list[SitelinkChange] = []
+    for change in _merge_sitelink_changes(qid, changes):
+        connected_sitelink = q_item.sitelinks.get(change.dbname)
+        if connected_sitelink is None or connected_sitelink.canonical_title() != change.old_title:
+            LOG.info(f'Sitelink for {change.dbname} in {qid} changed since verification; skip')
+            continue
+
+        verified_changes.append(change)
+
+    if len(verified_changes) == 0:
+        return
+
+    q_item.callback_payload = [ change.callback_payload for change in verified_changes ]  # payloads for logging purposes
+
+    try:
+        q_item.editEntity(
+            {
+                'sitelinks' : [ { 'site' : change.dbname, 'title' : change.new_title } for change in verified_changes ]
+            },
+            summary=_make_consolidated_edit_summary(verified_changes),
+            callback=_make_edit_log
+        )
+    except (APIError, OtherPageSaveError) as exception:
+        invalidate_item(qid)
+        LOG.warn(f'Cannot apply {len(verified_changes)} sitelink changes to {qid}: {exception}')
+
+
+def apply_queued_sitelink_changes(deadline:Optional[float]=None) -> None:
+    # stops at the deadline (timestamp), if any; the time of each item edit is charged in equal
+    # shares to the project stats of the wikis involved
+    LOG.info(f'Applying queued sitelink changes to {len(PENDING_SITELINK_CHANGES)} items')
+
+    durations:dict[str, float] = {}
+    applied = 0
+    for qid, changes in PENDING_SITELINK_CHANGES.items():
+        if deadline is not None and time() >= deadline:
+            LOG.warn(f'Run time budget exhausted; queued sitelink changes to {len(PENDING_SITELINK_CHANGES)-applied} items not applied')
+            break
+
+        started_at = time()
+        _apply_item_sitelink_changes(qid, changes)
+        applied += 1
+
+        dbnames = { change.dbname for change in changes }
+        for dbname in dbnames:
+            durations[dbname] = durations.get(dbname, 0) + (time() - started_at) / len(dbnames)
+
+    PENDING_SITELINK_CHANGES.clear()
+
+    for dbname, duration in durations.items():
+        LoggingDB.add_project_duration(get_run_id(), dbname, duration)
+
+
 def remove_sitelink_from_item(qid:str, dbname:str, page_title:str, callback_payload:dict[str, Any], edit_summary_log:Optional[str]=None) -> None:
     edit_summary = _make_edit_summary(dbname, page_title, edit_summary_log)
 
-    q_item = pwb.ItemPage(REPO, qid)
+    if CONSOLIDATE_ITEM_EDITS is True:
+        _queue_sitelink_change(SitelinkChange(qid, dbname, page_title, '', edit_summary, callback_payload))
+        return
+
+    q_item = get_item(qid)
     q_item.callback_payload = callback_payload  # payload for logging purposes
-    q_item.removeSitelink(
-        dbname,
-        summary=edit_summary,
-        callback=_make_edit_log
-    )
+    try:
+        q_item.removeSitelink(
+            dbname,
+            summary=edit_summary,
+            callback=_make_edit_log
+        )
+    except (APIError, OtherPageSaveError):
+        invalidate_item(qid)
+        raise
 
 
 def handle_uncanonicalizable_sitelink(qid:str, dbname:str, callback_payload:dict[str, Any], sitelink:pwb.page.BaseLink) -> bool:
@@ -133,6 +314,7 @@ def handle_uncanonicalizable_sitelink(qid:str, dbname:str, callback_payload:dict
 
     possible_other_q_item = pwb.ItemPage.fromPage(client_page, lazy_load=True)
     if possible_other_q_item.exists():
+        _cache_item(possible_other_q_item)
         callback_payload['eval_str'] += f'\nuncanonicalizable sitelink: found {sitelink.canonical_title()} for {dbname} in {qid} (connected to {possible_other_q_item.title()})'
         callback_payload['eval_params']['likely_reason'] = '5A-3'
         remove_sitelink_from_item(qid, dbname, sitelink.canonical_title(), callback_payload)
@@ -141,22 +323,27 @@ def handle_uncanonicalizable_sitelink(qid:str, dbname:str, callback_payload:dict
     return False
 
 
-def canonicalize_sitelink(qid:str, dbname:str, callback_payload:dict[str, Any]) -> None:
+def canonicalize_sitelink(qid:str, dbname:str, callback_payload:dict[str, Any]) -> bool:  # False if the edit failed
     edit_summary = f'normalize sitelink for {dbname} by using the canonical namespace prefix #{dbname}{EDITSUMMARY_HASHTAG}'
 
-    q_item = pwb.ItemPage(REPO, qid)
+    q_item = get_item(qid)
     try:
         q_item.get()
     except NoPageError:
-        return
+        return True
 
     connected_sitelink = q_item.sitelinks.get(dbname)
     if connected_sitelink is None:
-        return
+        return True
 
     already_done = handle_uncanonicalizable_sitelink(qid, dbname, callback_payload, connected_sitelink)
     if already_done is True:
-        return
+        return True
+
+    if CONSOLIDATE_ITEM_EDITS is True:
+        canonical_title = connected_sitelink.canonical_title()
+        _queue_sitelink_change(SitelinkChange(qid, dbname, canonical_title, canonical_title, edit_summary, callback_payload))
+        return True
 
     q_item.callback_payload = callback_payload  # payload for logging purposes
 
@@ -170,10 +357,13 @@ def canonicalize_sitelink(qid:str, dbname:str, callback_payload:dict[str, Any])
             callback=_make_edit_log
         )
     except (APIError, OtherPageSaveError) as exception:
-        pass
+        invalidate_item(qid)
+        return False
+
+    return True
 
 
-def normalize_title(qid:str, dbname:str, page_title:str, callback_payload:dict[str, Any]) -> None:
+def normalize_title(qid:str, dbname:str, page_title:str, callback_payload:dict[str, Any]) -> bool:  # False if the edit failed
     site = get_site_object(dbname)
 
     try:
@@ -182,11 +372,17 @@ def normalize_title(qid:str, dbname:str, page_title:str, callback_payload:dict[s
         LOG.warn(exception, dbname)
         raise RuntimeWarning from exception
 
-    q_item = pwb.ItemPage(REPO, qid)
+    edit_summary = 'Normalize sitelink title to match spelling on client wiki'
+
+    q_item = get_item(qid)
     q_item.callback_payload = callback_payload  # payload for logging purposes
 
     if page_title == page.title():
-        return
+        return True
+
+    if CONSOLIDATE_ITEM_EDITS is True:
+        _queue_sitelink_change(SitelinkChange(qid, dbname, page_title, page.title(), edit_summary, callback_payload))
+        return True
 
     try:
         q_item.setSitelink(
@@ -194,8 +390,11 @@ def normalize_title(qid:str, dbname:str, page_title:str, callback_payload:dict[s
                 'site' : dbname,
                 'title' : page.title()
             },
-            summary='Normalize sitelink title to match spelling on client wiki',
+            summary=edit_summary,
             callback=_make_edit_log
         )
     except (APIError, OtherPageSaveError) as exception:
-        pass
+        invalidate_item(qid)
+        return False
+
+    return True
@@ -0,0 +1,73 @@
+from importlib.util import find_spec
+from json import dumps
+import logging
+from os import makedirs, replace
+from os.path import getsize, join, relpath
+from time import time
+
+from .config import CANDIDATE_EXPORT_DIR, CANDIDATE_EXPORT_COMPRESSION, CANDIDATE_EXPORT_CHUNK_SIZE
+from .database import get_staging_suffix
+from .query_tooldb import CANDIDATE_CONDITIONS, query_candidates_chunked
+from .work_queue import get_run_id
+
+
+# Candidate sets of each wiki as Parquet files, streamed from the staging tables in row groups of
+# CANDIDATE_EXPORT_CHUNK_SIZE rows, in a hive-style layout:
+#   <CANDIDATE_EXPORT_DIR>/<run_id>/candidate_set=<set>/dbname=<dbname>/part-0.parquet
+# so that a run can be read with pyarrow.dataset.dataset(<run dir>, partitioning='hive'). Each
+# process appends one JSON line per file to manifest<staging suffix>.jsonl in the run directory.
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_FILE:str = 'manifest{suffix}.jsonl'
+
+
+def _export_candidate_set(run_dir:str, dbname:str, candidate_set:str) -> dict:
+    import pyarrow as pa  # optional dependency, only needed for the export
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('qid_sitelink', pa.string()),
+        ('sitelink', pa.string()),
+        ('ns_numerical', pa.int32()),
+        ('qid', pa.string()),
+    ])
+
+    directory = join(run_dir, f'candidate_set={candidate_set}', f'dbname={dbname}')
+    makedirs(directory, exist_ok=True)
+    filename = join(directory, 'part-0.parquet')
+
+    rows = 0
+    with pq.ParquetWriter(f'{filename}.tmp', schema, compression=CANDIDATE_EXPORT_COMPRESSION) as writer:
+        for chunk in query_candidates_chunked(candidate_set, CANDIDATE_EXPORT_CHUNK_SIZE):
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            rows += len(chunk)
+    replace(f'{filename}.tmp', filename)  # readers never see partial files
+
+    return {
+        'run_id' : get_run_id(),
+        'dbname' : dbname,
+        'candidate_set' : candidate_set,
+        'path' : relpath(filename, run_dir),
+        'rows' : rows,
+        'bytes' : getsize(filename),
+        'compression' : CANDIDATE_EXPORT_COMPRESSION,
+        'written_at' : int(time()),
+    }
+
+
+def export_candidate_sets(dbname:str) -> None:
+    # requires the staging tables of the wiki to be filled and indexed
+    if find_spec('pyarrow') is None:
+        raise RuntimeError('Candidate export requires pyarrow')
+
+    run_dir = join(CANDIDATE_EXPORT_DIR, get_run_id())
+    makedirs(run_dir, exist_ok=True)
+
+    entries = [ _export_candidate_set(run_dir, dbname, candidate_set) for candidate_set in CANDIDATE_CONDITIONS.keys() ]
+
+    with open(join(run_dir, MANIFEST_FILE.format(suffix=get_staging_suffix())), mode='a', encoding='utf8') as file_handle:
+        for entry in entries:
+            file_handle.write(f'{dumps(entry)}\n')
+
+    LOG.info(f'exported candidates of {dbname}: ' + ', '.join([ f'{entry["candidate_set"]}={entry["rows"]}' for entry in entries ]))
@@ -0,0 +1,334 @@
+from collections.abc import Callable, Generator
+import atexit
+from functools import wraps
+from hashlib import sha1
+from importlib import import_module
+import logging
+from os import makedirs, remove
+from os.path import exists, join
+import pickle
+from shutil import copyfile
+import sqlite3
+import sys
+from threading import Lock
+from time import perf_counter, sleep
+from types import ModuleType
+from typing import Any, Optional
+
+from .config import CASSETTE_MODE, CASSETTE_DIR, CASSETTE_REPLAY_SPEED, DB_PATH
+from . import database
+from .database import Replica, ToolDB
+from .types import WikiClient
+
+
+# Record/replay of all traffic to the replicas, the tool database, the MediaWiki API and the bot
+# functions which use pywikibot. A recorded run can be replayed offline with identical inputs;
+# replay never edits and does not import pywikibot. Calls are matched by target, arguments and
+# the number of identical calls before them, so that repeated queries replay in recorded order.
+
+LOG = logging.getLogger(__name__)
+
+CASSETTE_FILE:str = 'cassette.db'
+LOGGING_DB_SNAPSHOT:str = 'logging_snapshot.db'  # state of the logging database when recording started
+LOGGING_DB_REPLAY:str = 'logging_replay.db'  # scratch copy of the snapshot, used by LoggingDB in replay
+
+RECORD:str = 'record'
+REPLAY:str = 'replay'
+
+# bot functions which are called from outside their modules; all take and return plain data
+BOT_FUNCTIONS:dict[str, list[str]] = {
+    'delsitelinks.bot_sitelinks' : [
+        'remove_sitelink_from_item',
+        'canonicalize_sitelink',
+        'normalize_title',
+        'check_if_item_has_sitelink',
+        'check_if_page_exists_on_client',
+        'check_if_page_is_redirect',
+        'apply_queued_sitelink_changes',
+    ],
+    'delsitelinks.bot_touch' : [
+        'touch_page',
+    ],
+}
+
+
+class Cassette:
+    def __init__(self, mode:str, directory:str) -> None:
+        if mode not in [ RECORD, REPLAY ]:
+            raise ValueError(f'Unknown cassette mode "{mode}"')
+
+        self.mode = mode
+        self.directory = directory
+        self.lock = Lock()
+        self.call_counts:dict[tuple[str, str], int] = {}
+        self.stats:dict[str, list[float]] = {}  # target: [ calls, recorded duration, actual duration ]
+        self.misses = 0
+
+        makedirs(directory, exist_ok=True)
+        filename = join(directory, CASSETTE_FILE)
+        if mode == RECORD and exists(filename):
+            remove(filename)
+        if mode == REPLAY and not exists(filename):
+            raise RuntimeError(f'No cassette to replay at {filename}')
+
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS
+                    recorded_call (
+                        target TEXT,
+                        call_key TEXT,
+                        seq INT,
+                        is_error INT,
+                        payload BLOB,
+                        duration REAL,
+                        PRIMARY KEY (target, call_key, seq)
+                    )"""
+            )
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS
+                    recorded_chunk (
+                        target TEXT,
+                        call_key TEXT,
+                        seq INT,
+                        chunk_no INT,
+                        payload BLOB,
+                        PRIMARY KEY (target, call_key, seq, chunk_no)
+                    )"""
+            )
+
+    def _next_seq(self, target:str, call_key:str) -> int:
+        with self.lock:
+            seq = self.call_counts.get((target, call_key), 0)
+            self.call_counts[(target, call_key)] = seq + 1
+
+        return seq
+
+    def _add_stats(self, target:str, recorded_duration:float, actual_duration:float) -> None:
+        with self.lock:
+            stats = self.stats.setdefault(target, [ 0, 0., 0. ])
+            stats[0] += 1
+            stats[1] += recorded_duration
+            stats[2] += actual_duration
+
+    def store(self, target:str, call_key:str, seq:int, is_error:bool, payload:Any, duration:float) -> None:
+        try:
+            blob = pickle.dumps(payload)
+        except (pickle.PicklingError, TypeError, AttributeError):  # e.g. exceptions with unpicklable arguments
+            blob = pickle.dumps(RuntimeError(str(payload)))
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO recorded_call VALUES (?, ?, ?, ?, ?, ?)',
+                (target, call_key, seq, int(is_error), blob, duration)
+            )
+        self._add_stats(target, duration, duration)
+
+    def store_chunk(self, target:str, call_key:str, seq:int, chunk_no:int, chunk:Any) -> None:
+        blob = pickle.dumps(chunk)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO recorded_chunk VALUES (?, ?, ?, ?, ?)',
+                (target, call_key, seq, chunk_no, blob)
+            )
+
+    def load_chunk(self, target:str, call_key:str, seq:int, chunk_no:int) -> Any:
+        with self.lock:
+            result = self.connection.execute(
+                'SELECT payload FROM recorded_chunk WHERE target=? AND call_key=? AND seq=? AND chunk_no=?',
+                (target, call_key, seq, chunk_no)
+            ).fetchone()
+
+        if result is None:
+            self.misses += 1
+            raise LookupError(f'No recording for chunk {chunk_no} of call {seq} of {target} with key {call_key}')
+
+        return pickle.loads(result[0])
+
+    def load(self, target:str, call_key:str, seq:int) -> tuple[bool, Any, float]:
+        with self.lock:
+            result = self.connection.execute(
+                'SELECT is_error, payload, duration FROM recorded_call WHERE target=? AND call_key=? AND seq=?',
+                (target, call_key, seq)
+            ).fetchone()
+
+        if result is None:
+            self.misses += 1
+            raise LookupError(f'No recording for call {seq} of {target} with key {call_key}')
+
+        return bool(result[0]), pickle.loads(result[1]), result[2]
+
+    def summary(self) -> str:
+        lines = [ f'cassette {self.mode} at {self.directory}; {self.misses} misses' ]
+        for target, (calls, recorded_duration, actual_duration) in sorted(self.stats.items()):
+            lines.append(f'{target}: {int(calls)} calls, {recorded_duration:.1f}s recorded, {actual_duration:.1f}s now')
+
+        return '\n'.join(lines)
+
+    def close(self) -> None:
+        LOG.info(self.summary())
+        self.connection.close()
+
+
+ACTIVE_CASSETTE:Optional[Cassette] = None
+
+
+def _call_key(args:tuple, kwargs:dict[str, Any]) -> str:
+    return sha1(repr((args, sorted(kwargs.items()))).encode('utf8')).hexdigest()
+
+
+def _replay_delay(duration:float) -> None:
+    if CASSETTE_REPLAY_SPEED is not None and CASSETTE_REPLAY_SPEED > 0:
+        sleep(duration / CASSETTE_REPLAY_SPEED)
+
+
+def _wrap_function(cassette:Cassette, target:str, function:Optional[Callable], side_effect:Optional[Callable]=None) -> Callable:
+    # function is None in replay mode, where the original is never called
+    def wrapper(*args, **kwargs):
+        call_key = _call_key(args, kwargs)
+        seq = cassette._next_seq(target, call_key)
+
+        if cassette.mode == REPLAY:
+            start = perf_counter()
+            is_error, payload, duration = cassette.load(target, call_key, seq)
+            if side_effect is not None:
+                side_effect(*args, **kwargs)
+            _replay_delay(duration)
+            cassette._add_stats(target, duration, perf_counter() - start)
+            if is_error:
+                raise payload
+            return payload
+
+        start = perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as exception:
+            cassette.store(target, call_key, seq, True, exception, perf_counter() - start)
+            raise
+        cassette.store(target, call_key, seq, False, result, perf_counter() - start)
+
+        return result
+
+    if function is not None:
+        wrapper = wraps(function)(wrapper)
+
+    return wrapper
+
+
+def _wrap_generator(cassette:Cassette, target:str, function:Callable) -> Callable:
+    # each chunk is stored as soon as it has been read, so that neither recording nor replay holds a
+    # whole scan in memory; the call itself records the number of chunks and the final exception,
+    # and a scan which is abandoned halfway is recorded up to there
+    def wrapper(*args, **kwargs) -> Generator[Any, None, None]:
+        call_key = _call_key(args, kwargs)
+        seq = cassette._next_seq(target, call_key)
+
+        if cassette.mode == REPLAY:
+            start = perf_counter()
+            is_error, payload, duration = cassette.load(target, call_key, seq)
+            chunk_count, exception = payload
+            _replay_delay(duration)
+            cassette._add_stats(target, duration, perf_counter() - start)
+            for chunk_no in range(chunk_count):
+                yield cassette.load_chunk(target, call_key, seq, chunk_no)
+            if is_error:
+                raise exception
+            return
+
+        chunk_count = 0
+        start = perf_counter()
+        duration = 0.
+        try:
+            for chunk in function(*args, **kwargs):
+                duration += perf_counter() - start
+                cassette.store_chunk(target, call_key, seq, chunk_count, chunk)
+                chunk_count += 1
+                yield chunk
+                start = perf_counter()
+        except Exception as exception:
+            duration += perf_counter() - start
+            cassette.store(target, call_key, seq, True, (chunk_count, exception), duration)
+            raise
+        except GeneratorExit:  # closed by the consumer
+            cassette.store(target, call_key, seq, False, (chunk_count, None), duration)
+            raise
+        else:
+            duration += perf_counter() - start
+            cassette.store(target, call_key, seq, False, (chunk_count, None), duration)
+
+    return wraps(function)(wrapper)
+
+
+def _remove_load_file(table:str, filename:str, keep_file:bool=False) -> None:
+    # ToolDB.insert_batch removes the loaded file, unless it is kept for later loads
+    if keep_file is not True and exists(filename):
+        remove(filename)
+
+
+def _install_database_wrappers(cassette:Cassette) -> None:
+    for name in [ 'query_mediawiki' ]:
+        setattr(Replica, name, staticmethod(_wrap_function(cassette, f'Replica.{name}', getattr(Replica, name))))
+    for name in [ 'query_mediawiki_chunked', 'query_mediawiki_keyset' ]:
+        setattr(Replica, name, staticmethod(_wrap_generator(cassette, f'Replica.{name}', getattr(Replica, name))))
+
+    for name in [ 'query_tooldb', 'clear_table', 'prepare_staging_table', 'index_staging_table' ]:
+        setattr(ToolDB, name, staticmethod(_wrap_function(cassette, f'ToolDB.{name}', getattr(ToolDB, name))))
+    ToolDB.query_tooldb_chunked = staticmethod(_wrap_generator(cassette, 'ToolDB.query_tooldb_chunked', ToolDB.query_tooldb_chunked))  # type: ignore
+    setattr(
+        ToolDB,
+        'insert_batch',
+        staticmethod(_wrap_function(cassette, 'ToolDB.insert_batch', ToolDB.insert_batch, side_effect=_remove_load_file))
+    )
+
+    WikiClient.api_request = staticmethod(_wrap_function(cassette, 'WikiClient.api_request', WikiClient.api_request))  # type: ignore
+
+
+def _install_bot_wrappers(cassette:Cassette) -> None:
+    for module_name, function_names in BOT_FUNCTIONS.items():
+        if cassette.mode == REPLAY:  # replaces the module, so that pywikibot is not imported at all
+            module = ModuleType(module_name)
+            for function_name in function_names:
+                setattr(module, function_name, _wrap_function(cassette, f'{module_name}.{function_name}', None))
+            sys.modules[module_name] = module
+            setattr(sys.modules['delsitelinks'], module_name.rsplit('.', 1)[1], module)
+            continue
+
+        module = import_module(module_name)
+        for function_name in function_names:
+            setattr(module, function_name, _wrap_function(cassette, f'{module_name}.{function_name}', getattr(module, function_name)))
+
+
+def _install_logging_db(cassette:Cassette) -> None:
+    # replays start from the logging database state of the recording, and leave the real one untouched
+    snapshot = join(cassette.directory, LOGGING_DB_SNAPSHOT)
+    if cassette.mode == RECORD:
+        if exists(snapshot):
+            remove(snapshot)
+        if exists(DB_PATH):
+            copyfile(DB_PATH, snapshot)
+        return
+
+    scratch = join(cassette.directory, LOGGING_DB_REPLAY)
+    if exists(scratch):
+        remove(scratch)
+    if exists(snapshot):
+        copyfile(snapshot, scratch)
+    database.DB_PATH = scratch
+
+
+def install_cassette() -> None:
+    # needs to run before the processing modules are imported; no-op unless CASSETTE_MODE is set.
+    # Not covered: direct ToolDB connections of the work queue and of the query audit.
+    global ACTIVE_CASSETTE
+
+    if CASSETTE_MODE is None or ACTIVE_CASSETTE is not None:
+        return
+
+    cassette = Cassette(CASSETTE_MODE, CASSETTE_DIR)
+    _install_logging_db(cassette)
+    _install_database_wrappers(cassette)
+    _install_bot_wrappers(cassette)
+
+    ACTIVE_CASSETTE = cassette
+    atexit.register(cassette.close)
+    LOG.info(f'cassette installed in {CASSETTE_MODE} mode at {CASSETTE_DIR}')
@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+from multiprocessing import Queue
+from time import time
+from typing import Any, Optional
+
+import mariadb
+
+from .config import CENSUS_PARALLELISM
+from .database import ToolDB, set_staging_suffix
+from .query_replicas import query_pages, query_sitelinks
+from .query_tooldb import query_candidate_counts
+from .types import WikiClient
+
+
+# Read-only census of the candidates of all wikis: the usual staging tables are filled, and the
+# candidates are counted in the tool database; no candidate rows are fetched and nothing is
+# edited. Each worker process stages into tables of its own (suffix _census<slot>), so that a
+# census can run next to a regular run.
+
+LOG = logging.getLogger(__name__)
+
+CENSUS_COLUMNS:list[str] = [ 'sitelinks', 'missing_page', 'qid_different', 'qid_missing' ]
+
+
+def _init_census_worker(slots:Queue) -> None:
+    set_staging_suffix(f'_census{slots.get()}')
+
+
+def count_candidates(wiki_client:WikiClient) -> Optional[dict[str, Any]]:
+    started_at = time()
+    try:
+        query_sitelinks(wiki_client, use_export=False)  # never consumes the export of a regular run
+        query_pages(wiki_client)
+        ToolDB.index_staging_table('pages')
+        counts = query_candidate_counts()
+    except (RuntimeError, RuntimeWarning) as exception:
+        LOG.warn(f'Census of {wiki_client.dbname} failed: {exception}')
+        return None
+
+    return { 'dbname' : wiki_client.dbname, 'counted_at' : int(started_at), 'duration' : time() - started_at, **counts }
+
+
+def _create_census_table() -> None:
+    query = """CREATE TABLE IF NOT EXISTS census (
+        run_id VARBINARY(64) NOT NULL,
+        dbname VARBINARY(64) NOT NULL,
+        counted_at INT UNSIGNED NOT NULL,
+        duration FLOAT NOT NULL,
+        sitelinks INT UNSIGNED NOT NULL,
+        missing_page INT UNSIGNED NOT NULL,
+        qid_different INT UNSIGNED NOT NULL,
+        qid_missing INT UNSIGNED NOT NULL,
+        PRIMARY KEY (run_id, dbname),
+        KEY dbname_time (dbname, counted_at)
+    ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin"""
+
+    with ToolDB(autocommit=True) as (_, db_cursor):
+        try:
+            db_cursor.execute(query)
+        except mariadb.Error as exception:
+            msg = 'Cannot create census table in tool_db'
+            LOG.error(msg)
+            raise RuntimeWarning(msg) from exception
+
+
+def insert_census_row(run_id:str, row:dict[str, Any]) -> None:
+    query = f"""REPLACE INTO census
+        (run_id, dbname, counted_at, duration, {', '.join(CENSUS_COLUMNS)})
+    VALUES
+        (%(run_id)s, %(dbname)s, %(counted_at)s, %(duration)s, {', '.join([ f'%({column})s' for column in CENSUS_COLUMNS ])})"""
+
+    with ToolDB(autocommit=True) as (_, db_cursor):
+        try:
+            db_cursor.execute(query, { **row, 'run_id' : run_id })
+        except mariadb.Error as exception:
+            msg = f'Cannot write census of {row["dbname"]} for run {run_id}'
+            LOG.error(msg)
+            raise RuntimeWarning(msg) from exception
+
+
+def run_census(run_id:str, wiki_clients:list[WikiClient]) -> list[dict[str, Any]]:
+    # rows are written as soon as a wiki is counted, so that an interrupted census keeps its results
+    _create_census_table()
+
+    parallelism = max(1, min(CENSUS_PARALLELISM, len(wiki_clients)))
+    slots:Queue = Queue()
+    for slot in range(parallelism):
+        slots.put(slot)
+
+    rows:list[dict[str, Any]] = []
+    with ProcessPoolExecutor(max_workers=parallelism, initializer=_init_census_worker, initargs=(slots,)) as executor:
+        futures = { executor.submit(count_candidates, wiki_client) : wiki_client.dbname for wiki_client in wiki_clients }
+        for i, future in enumerate(as_completed(futures), start=1):
+            try:
+                row = future.result()
+            except Exception as exception:  # e.g. mariadb errors or a broken worker process; other wikis are still counted
+                LOG.warn(f'Census of {futures[future]} ({i}/{len(wiki_clients)}) failed: {exception!r}')
+                continue
+            if row is None:
+                continue
+
+            insert_census_row(run_id, row)
+            rows.append(row)
+            LOG.info(f'{futures[future]} ({i}/{len(wiki_clients)}): ' + ', '.join([ f'{column}={row[column]}' for column in CENSUS_COLUMNS ]))
+
+    return rows
@@ -1,33 +1,104 @@
-import pywikibot as pwb
 from typing import Optional
 
-# bot editing related
-SITE = pwb.Site('wikidata', 'wikidata')
-REPO = SITE.data_repository()
+# bot editing related; the Wikidata site object is initialized lazily in bot_sitelinks.get_repo()
 EDITSUMMARY_HASHTAG:str = ' #msynbotTask8'  # including leading space; may be an empty string as well
 TOUCH_SLEEP:int = 2  # int or None; time in seconds
+CONSOLIDATE_ITEM_EDITS:bool = False  # collect sitelink changes of the whole run and apply them with one edit per item; not in work queue mode
+ENTITY_CACHE_SIZE:int = 100  # number of loaded items kept between verification and editing; keyed by (qid, lastrevid)
+ENTITY_CACHE_MAX_AGE:int = 3600  # time in seconds; older items are loaded again before use
 
 # logging
 DB_PATH:str = './logging.db'  # an sqlite3 database to log actions performed on the wiki
+WORKER_DB_PATH:str = './logging_{worker}.db'  # work queue mode: one file per worker, merged into DB_PATH when the run is reported
 TOOLDB_NAME_FILE:str = './tooldb.my.cnf'  # sitting in the main directory of the tool
-SPECIAL_PAGE_LOG:str = './special_page_log.tsv'  # sitting in the main directory of the tool
+
+# MediaWiki API reads (not pywikibot)
+HTTP_USER_AGENT:str = 'msynbot delsitelinks (https://github.com/MisterSynergy/inexistent_sitelinks)'
+HTTP_TIMEOUT:int = 60  # time in seconds
+HTTP_POOL_SIZE:int = 10  # keep-alive connections per host
+HTTP_MAX_RETRIES:int = 3
+HTTP_BACKOFF_FACTOR:float = 1.0  # time in seconds; doubled with each retry
+
+# record all replica, tool database, API and bot traffic of a run, or replay a recorded run offline
+CASSETTE_MODE:Optional[str] = None  # None, 'record' or 'replay'
+CASSETTE_DIR:str = './cassette'  # sitting in the main directory of the tool
+CASSETTE_REPLAY_SPEED:Optional[float] = None  # None: replay without delays; 1.0: replay with recorded timing
+
+# profile process_project per wiki: sampled stacks for flamegraphs and top allocations per stage; also DELSITELINKS_PROFILING=1
+PROFILING:bool = False
+PROFILE_DIR:str = './profiles'  # sitting in the main directory of the tool, next to the log file
+PROFILE_SAMPLE_INTERVAL:float = 0.01  # time in seconds between stack samples
+PROFILE_TRACEMALLOC_FRAMES:int = 10  # stack depth recorded per allocation
+PROFILE_TOP_ALLOCATIONS:int = 20  # allocation sites reported per stage
 
 # querying
 QUERY_CHUNK_SIZE:int = 500000  # chunksize when querying from replicas; done in order to reduce memory demands
+QUERY_KEYSET_PAGINATION:bool = True  # page large replica scans on a stable key so that they can resume after connection loss
+QUERY_MAX_RECONNECTS:int = 5  # consecutive reconnect attempts per keyset-paginated scan before giving up
+QUERY_RECONNECT_SLEEP:int = 10  # time in seconds; multiplied by the number of the reconnect attempt
+
+# number of key ranges (and replica connections) that page and sitelink scans are split into; requires keyset pagination
+QUERY_PARALLELISM_DEFAULT:int = 1
+QUERY_PARALLELISM:dict[str, int] = {
+    'commonswiki' : 4,
+    'enwiki' : 4,
+    'wikidatawiki' : 4,
+}
 
-# These do not really response quickly enough when the logging table is queried
-LARGE_WIKIS_LOGEVENTS:dict[str, str] = {  # TODO: list instead of dict, and retrieve url from meta replica
-    'enwiki' : 'en.wikipedia.org',
-    'srwikinews' : 'sr.wikinews.org',
+# namespaces which are never scanned in full (dbname: namespaces); the few sitelinks into them are resolved by point lookups
+PAGE_SCAN_EXCLUDED_NAMESPACES:dict[str, list[int]] = {
+    'commonswiki' : [ 6 ],  # ~100M File pages
+    'wikidatawiki' : [ 0 ],  # items
 }
 
-# max number of sitelinks removed per project
+# answer page existence and redirect checks from the replicas unless they lag behind (seconds)
+REPLICA_VERIFICATION:bool = True
+MAX_REPLICATION_LAG:int = 60
+REPLICATION_LAG_CACHE_TTL:int = 60  # time in seconds
+
+# export wb_items_per_site once per run, partitioned by site, instead of querying it once per wiki
+SITELINK_EXPORT:bool = True
+SITELINK_EXPORT_DIR:str = './sitelink_export'  # sitting in the main directory of the tool
+SITELINK_EXPORT_PARALLELISM:int = 4
+SITELINK_EXPORT_MAX_AGE:int = 259200  # time in seconds; older exports (e.g. from a crashed run) are ignored
+
+# resolve sitelink titles by batched point lookups instead of a full page scan if
+# number of sitelinks * PAGE_LOOKUP_COST_FACTOR < estimated number of pages
+PAGE_LOOKUP_MODE:bool = True
+PAGE_LOOKUP_COST_FACTOR:int = 20  # relative cost of one point lookup vs. one row of a sequential page scan
+PAGE_LOOKUP_BATCH_SIZE:int = 1000
+
+# export the missing-page, different-qid and missing-qid candidates of each wiki as Parquet files (requires pyarrow)
+CANDIDATE_EXPORT:bool = False
+CANDIDATE_EXPORT_DIR:str = './candidate_export'  # sitting in the main directory of the tool; one subdirectory per run
+CANDIDATE_EXPORT_COMPRESSION:str = 'zstd'
+CANDIDATE_EXPORT_CHUNK_SIZE:int = 100000  # rows fetched from the tool database and written per row group
+
+# max number of sitelinks removed per project; candidates are sampled in the tool database
 MAX_SITELINKS_PER_PROJECT = 1000
+SITELINK_SAMPLE_SEED:Optional[int] = None  # int for a reproducible sample, or None
+SITELINK_SAMPLE_ORDER:Optional[str] = None  # None for a random sample, or 'oldest_item' to prioritize low QIDs
 
 # Q-IDs to ignore at most places; these should likely only be items for Special pages which are rather unusual
 QIDS_TO_IGNORE:list[str] = [
 ]
 
+# remember non-actionable candidates and skip them until the item or client page changes, or the verdict expires
+VERDICT_CACHE:bool = True
+VERDICT_CACHE_TTL:int = 2419200  # time in seconds (four weeks)
+
+# work queue mode (main_tidy_sitelinks_worker.py): identical pods claim wikis from a queue table in the tool database
+WORK_QUEUE_LEASE:int = 1800  # time in seconds; a claim expires unless renewed by the heartbeat of its worker
+WORK_QUEUE_HEARTBEAT:int = 300  # time in seconds
+WORK_QUEUE_MAX_ATTEMPTS:int = 3  # claims per wiki and run; crashed or failed attempts count as well
+
+# census (main_census.py): read-only candidate counts of all wikis, written to the census table of the tool database
+CENSUS_PARALLELISM:int = 4  # worker processes, each with its own staging tables
+
+# scheduling: projects with the most fixes per minute in recent runs go first, unmeasured projects before them
+PROJECT_STATS_HISTORY:int = 4  # number of recent runs per project to estimate its duration and yield from
+RUN_TIME_BUDGET:Optional[int] = None  # time in seconds, or None; projects which would exceed it are not started
+
 # wiki dbnames of projects with persistent problems; might require server admin attention as in
 # https://phabricator.wikimedia.org/T311148
 NEEDS_FIX_WIKIS:list[str] = []
@@ -48,3 +119,22 @@ MAX_PROJECT:Optional[str] = None
 # when using touch tasks, select which ones to activate here
 TOUCH_QID_DIFFERENT:bool = True
 TOUCH_QID_MISSING:bool = False
+
+# power touch (main_power_touch.py): wikis are scanned one after another, and touched concurrently with one worker per wiki
+TOUCH_PARALLEL_WIKIS:int = 8  # wikis touched at the same time; each worker touches its wiki at most once per TOUCH_SLEEP
+TOUCH_QUARANTINE_FAILURES:int = 5  # consecutive failed touches after which a wiki is quarantined for the rest of the run; 0 disables
+
+TOUCH_REVALIDATION:bool = True  # re-read page_props and wb_items_per_site right before touching, and skip pages which are consistent by then
+TOUCH_REVALIDATION_BATCH_SIZE:int = 100  # touch candidates revalidated at once
+
+# wikis which are not touched at all
+TOUCH_QUARANTINE_WIKIS:list[str] = [
+    'azwiki',  # some problem with nulledits
+    'cawikisource',  # captchas to solve
+    'ckbwiki',  # captchas to solve
+    'eswikiquote',  # captchas to solve
+    'eswikivoyage',  # captchas to solve
+    'simplewiki',  # captchas to solve
+    'zhwikinews',  # captchas to solve
+    'specieswiki',  # some login problem
+]
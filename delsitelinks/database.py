@@ -1,21 +1,68 @@
 from collections.abc import Generator
+from json import dumps
 import logging
 from os import remove
-from os.path import expanduser
+from os.path import exists, expanduser
+from time import sleep, time
 from typing import Any, Optional, Type, TypeVar
 
 import mariadb
 import sqlite3
 
-from .config import QUERY_CHUNK_SIZE, DB_PATH, TOOLDB_NAME_FILE
+from .config import QUERY_CHUNK_SIZE, QUERY_MAX_RECONNECTS, QUERY_RECONNECT_SLEEP, DB_PATH, TOOLDB_NAME_FILE
 
 
 LOG = logging.getLogger(__name__)
+
+# compact 64-bit join key for staged page titles and sitelinks; joins compare the full title as well
+TITLE_HASH_SQL:str = 'CAST(CONV(LEFT(MD5({column}), 16), 16, 10) AS UNSIGNED)'
+STAGING_TABLE_INDEXES:dict[str, dict[str, str]] = {  # table: { index: column }
+    'pages' : { 'title_hash' : 'title_hash' },
+    'sitelinks' : {},
+    'verdicts' : {},
+}
+STAGING_SUFFIX:str = ''  # per-process suffix of the staging tables; set via set_staging_suffix()
+LOGGING_DB_PATH:str = DB_PATH  # sqlite file which this process logs into; set via set_logging_db_path()
+LOGGING_DB_MIGRATION_EAV:str = 'eav_to_sitelink_edit'
+CASE_DIMENSIONS:dict[str, str] = {  # dimension: SQL expression over sitelink_edit
+    'dbname' : 'dbname',
+    'likely_reason' : 'likely_reason',
+    'log_action' : 'log_action',
+    'run_id' : 'run_id',
+    'user_name' : 'user_name',
+    'month' : "strftime('%Y-%m', logged_at, 'unixepoch')",
+    'log_month' : "substr(CAST(log_timestamp AS TEXT), 1, 6)",
+}
 L = TypeVar('L', bound='LoggingDB')
 R = TypeVar('R', bound='Replica')
 T = TypeVar('T', bound='ToolDB')
 
 
+def set_staging_suffix(suffix:str) -> None:
+    # workers which share the tool database each stage into their own copies of the staging tables
+    global STAGING_SUFFIX
+
+    if suffix != '' and not suffix.replace('_', '').isalnum():
+        raise ValueError(f'Invalid staging table suffix "{suffix}"')
+    STAGING_SUFFIX = suffix
+
+
+def get_staging_suffix() -> str:
+    return STAGING_SUFFIX
+
+
+def staging_table(table:str) -> str:
+    return f'{table}{STAGING_SUFFIX}'
+
+
+def set_logging_db_path(path:str) -> None:
+    # workers of a shared run each log into a file of their own, since sqlite locking is not
+    # reliable on the shared NFS directory; the files are merged into DB_PATH by merge_logging_db()
+    global LOGGING_DB_PATH
+
+    LOGGING_DB_PATH = path
+
+
 class Replica:
     def __init__(self, dbname:str, dict_cursor:bool=True) -> None:
         params = {
@@ -74,8 +121,65 @@ class Replica:
                     break
                 yield chunk
 
+    @classmethod
+    def query_mediawiki_keyset(cls:Type[R], dbname:str, query:str, key:str, params:Optional[dict[str, Any]]=None, start_key:Any=0, chunksize:int=QUERY_CHUNK_SIZE) -> Generator[list[dict[str, Any]], None, None]:
+        # query needs to select the key column and to contain a "key>%(last_key)s" condition;
+        # ordering and limit are appended here, so that each chunk is an index range read of its own
+        query_chunk = f'{query}\n    ORDER BY {key}\n    LIMIT {int(chunksize)}'
+
+        last_key = start_key
+        reconnects = 0
+        replica:Optional[R] = None
+
+        try:
+            while True:
+                chunk_params = { **(params or {}), 'last_key' : last_key }
+                try:
+                    if replica is None:
+                        replica = cls(dbname)
+                    replica.cursor.execute(query_chunk, chunk_params)
+                    chunk = replica.cursor.fetchall()
+                except mariadb.ProgrammingError as exception:
+                    msg = f'Failed to query "{query}" with params "{chunk_params}" at {dbname}'
+                    LOG.warn(msg)
+                    raise RuntimeError(msg) from exception
+                except (mariadb.InterfaceError, mariadb.OperationalError) as exception:
+                    reconnects += 1
+                    if reconnects > QUERY_MAX_RECONNECTS:
+                        msg = f'Connection error during keyset pagination at {dbname}; giving up after {QUERY_MAX_RECONNECTS} reconnects'
+                        LOG.warn(msg)
+                        raise RuntimeError(msg) from exception
+
+                    LOG.warn(f'Connection error during keyset pagination at {dbname} after key {last_key!r}; reconnecting ({reconnects}/{QUERY_MAX_RECONNECTS})')
+                    if replica is not None:
+                        replica._close_quietly()
+                        replica = None
+                    sleep(QUERY_RECONNECT_SLEEP * reconnects)
+                    continue
+
+                reconnects = 0
+                if not len(chunk):
+                    break
+
+                last_key = chunk[-1][key]
+                yield chunk
+
+                if len(chunk) < chunksize:
+                    break
+        finally:
+            if replica is not None:
+                replica._close_quietly()
+
+    def _close_quietly(self) -> None:
+        try:
+            self.__exit__(None, None, None)
+        except mariadb.Error:
+            LOG.debug('replica database connection was already lost')
+
 
 class ToolDB:
+    staging_suffixes_created:set[str] = set()  # staging tables are created once per process and suffix
+
     def __init__(self, autocommit:bool=False) -> None:
         params = {
             'host' : 'tools.db.svc.wikimedia.cloud',
@@ -91,7 +195,9 @@ class ToolDB:
             self.connection = mariadb.connect(**params)
 
         self.cursor = self.connection.cursor(dictionary=True)
-        self._create_tables()
+        if STAGING_SUFFIX not in ToolDB.staging_suffixes_created:
+            self._create_tables()
+            ToolDB.staging_suffixes_created.add(STAGING_SUFFIX)
         LOG.debug('tool database connection established')
 
     def __enter__(self):  #  -> tuple[mariadb.Connection, mariadb._mariadb.Cursor]
@@ -103,22 +209,34 @@ class ToolDB:
         LOG.debug('tool database connection closed')
 
     def _create_tables(self) -> None:
+        # staging tables carry no secondary index while being loaded; the join index on the compact
+        # title hash is built once per wiki by index_staging_table()
+        pages, sitelinks, verdicts = staging_table('pages'), staging_table('sitelinks'), staging_table('verdicts')
         queries = [
-            """CREATE TABLE IF NOT EXISTS pages (
+            f"""CREATE TABLE IF NOT EXISTS {pages} (
                 id INT(11) NOT NULL AUTO_INCREMENT,
                 ns_numerical INT(11) NOT NULL,
                 full_page_title VARBINARY(255) NOT NULL,
                 qid VARBINARY(10) NOT NULL,
+                title_hash BIGINT UNSIGNED NOT NULL DEFAULT 0,
                 PRIMARY KEY (id)
             ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin""",
-            """CREATE INDEX IF NOT EXISTS title ON pages (full_page_title)""",
-            """CREATE TABLE IF NOT EXISTS sitelinks (
+            f"""ALTER TABLE {pages} ADD COLUMN IF NOT EXISTS title_hash BIGINT UNSIGNED NOT NULL DEFAULT 0""",
+            f"""CREATE TABLE IF NOT EXISTS {sitelinks} (
                 id INT(11) NOT NULL AUTO_INCREMENT,
                 sitelink VARBINARY(255) NOT NULL,
                 qid_sitelink VARBINARY(10) NOT NULL,
+                sitelink_hash BIGINT UNSIGNED NOT NULL DEFAULT 0,
                 PRIMARY KEY (id)
             ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin""",
-            """CREATE INDEX IF NOT EXISTS title ON sitelinks (sitelink)"""
+            f"""ALTER TABLE {sitelinks} ADD COLUMN IF NOT EXISTS sitelink_hash BIGINT UNSIGNED NOT NULL DEFAULT 0""",
+            f"""CREATE TABLE IF NOT EXISTS {verdicts} (
+                id INT(11) NOT NULL AUTO_INCREMENT,
+                verdict_qid VARBINARY(10) NOT NULL,
+                verdict_sitelink VARBINARY(255) NOT NULL,
+                PRIMARY KEY (id),
+                KEY verdict_key (verdict_qid, verdict_sitelink)
+            ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin"""
         ]
 
         for query in queries:
@@ -126,13 +244,15 @@ class ToolDB:
             LOG.debug('created table for tool database')
 
     @classmethod
-    def query_tooldb(cls:Type[T], query:str, params:Optional[dict[str, Any]]=None) -> list[dict[str, Any]]:
+    def query_tooldb(cls:Type[T], query:str, params:Optional[dict[str, Any]]=None, params_tuple:Optional[tuple]=None) -> list[dict[str, Any]]:
         with cls() as (_, db_cursor):
             try:
-                if params is None:
+                if params is None and params_tuple is None:
                     db_cursor.execute(query)
-                else:
+                elif params is not None:
                     db_cursor.execute(query, params)
+                elif params_tuple is not None:
+                    db_cursor.execute(query, params_tuple)
             except mariadb.Error as exception:
                 msg = f'Cannot make query "{query}" with params "{params}" against tool_db'
                 LOG.warn(msg)
@@ -142,6 +262,27 @@ class ToolDB:
 
         return result
 
+    @classmethod
+    def query_tooldb_chunked(cls:Type[T], query:str, params:Optional[dict[str, Any]]=None, chunksize:int=QUERY_CHUNK_SIZE) -> Generator[list[dict[str, Any]], None, None]:
+        with cls() as (_, db_cursor):
+            try:
+                db_cursor.execute(query, params, buffered=False)
+            except mariadb.Error as exception:
+                msg = f'Cannot make query "{query}" with params "{params}" against tool_db'
+                LOG.warn(msg)
+                raise RuntimeWarning(msg) from exception
+
+            while True:
+                try:
+                    chunk = db_cursor.fetchmany(chunksize)
+                except mariadb.InterfaceError as exception:
+                    msg = 'Connection error during chunking'
+                    LOG.warn(msg)
+                    raise RuntimeWarning(msg) from exception
+                if not len(chunk):  # check if cursor is empty
+                    break
+                yield chunk
+
     @classmethod
     def clear_table(cls:Type[T], table:str) -> None:
         query = f'TRUNCATE TABLE {table}'
@@ -157,14 +298,43 @@ class ToolDB:
         LOG.info(f'Cleared table {table}')
 
     @classmethod
-    def insert_batch(cls:Type[T], table:str, filename:str) -> None:
+    def prepare_staging_table(cls:Type[T], table:str) -> None:
+        cls.clear_table(staging_table(table))
+
+        with cls(autocommit=True) as (_, db_cursor):
+            try:
+                for index in [ 'title', *STAGING_TABLE_INDEXES.get(table, {}).keys() ]:  # "title" is the former full-width index
+                    db_cursor.execute(f'DROP INDEX IF EXISTS {index} ON {staging_table(table)}')
+            except mariadb.Error as exception:
+                msg = f'Cannot drop indexes of table {table}'
+                LOG.error(msg)
+                raise RuntimeWarning(msg) from exception
+
+        LOG.debug(f'Prepared table {table} for bulk loading')
+
+    @classmethod
+    def index_staging_table(cls:Type[T], table:str) -> None:
+        with cls(autocommit=True) as (_, db_cursor):
+            try:
+                for index, column in STAGING_TABLE_INDEXES.get(table, {}).items():
+                    db_cursor.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {staging_table(table)} ({column})')
+            except mariadb.Error as exception:
+                msg = f'Cannot build indexes of table {table}'
+                LOG.error(msg)
+                raise RuntimeWarning(msg) from exception
+
+        LOG.info(f'Built indexes of table {table}')
+
+    @classmethod
+    def insert_batch(cls:Type[T], table:str, filename:str, keep_file:bool=False) -> None:
         column_mapper = {
-            'pages' : ' (@id, ns_numerical, full_page_title, qid)',
-            'sitelinks' : ' (@id, sitelink, qid_sitelink)',
+            'pages' : f' (@id, ns_numerical, full_page_title, qid) SET title_hash={TITLE_HASH_SQL.format(column="full_page_title")}',
+            'sitelinks' : f' (@id, sitelink, qid_sitelink) SET sitelink_hash={TITLE_HASH_SQL.format(column="sitelink")}',
+            'verdicts' : ' (@id, verdict_qid, verdict_sitelink)',
         }
 
         query = f"""LOAD DATA LOCAL INFILE '{filename}'
-        INTO TABLE {table}
+        INTO TABLE {staging_table(table)}
         FIELDS TERMINATED BY '\t'
         LINES TERMINATED BY '\n'
         {column_mapper.get(table, '')}"""
@@ -172,6 +342,7 @@ class ToolDB:
         with cls() as (db_connection, db_cursor):
             try:
                 db_cursor.execute("SET sql_mode='NO_BACKSLASH_ESCAPES'")
+                db_cursor.execute('SET unique_checks=0, foreign_key_checks=0')
                 db_cursor.execute(query)
             except mariadb.Error as exception:
                 msg = f'Cannot make import file {filename} into table {table} at tool_db'
@@ -181,7 +352,8 @@ class ToolDB:
                 db_connection.commit()
 
         LOG.info(f'Inserted file into database table {table}')
-        remove(filename)
+        if keep_file is not True:
+            remove(filename)
 
     @staticmethod
     def _create_tooldb() -> None:
@@ -213,13 +385,24 @@ class ToolDB:
 
 
 class LoggingDB:
-    def __init__(self) -> None:
-        self.connection = sqlite3.connect(DB_PATH)
-        self.cursor = self.connection.cursor()
-
-        self._create_tables()
+    migrated:set[str] = set()  # paths checked once per process
+
+    def __init__(self, path:Optional[str]=None, read_only:bool=False) -> None:
+        path = path or LOGGING_DB_PATH
+        if read_only is True and exists(path):  # neither schema changes nor write locks
+            self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            self.cursor = self.connection.cursor()
+        else:
+            self.connection = sqlite3.connect(path)
+            self.cursor = self.connection.cursor()
+            self._create_tables(path)
         LOG.debug('logging database connetion established')
 
+    @classmethod
+    def _run_wide(cls:Type[L]) -> L:
+        # history of all runs (and workers) is in DB_PATH; only read if another file is logged into
+        return cls(DB_PATH, read_only=(LOGGING_DB_PATH != DB_PATH))
+
     def __enter__(self) -> tuple[sqlite3.Connection, sqlite3.Cursor]:
         return self.connection, self.cursor
 
@@ -228,7 +411,7 @@ class LoggingDB:
         self.connection.close()
         LOG.debug('logging database connection closed')
 
-    def _create_tables(self) -> None:
+    def _create_tables(self, path:str) -> None:
         queries = [
             """CREATE TABLE IF NOT EXISTS
                 sitelink_case (
@@ -257,6 +440,72 @@ class LoggingDB:
                     p_dtype TEXT,
                     FOREIGN KEY (sitelink_case_rowid) REFERENCES sitelink_case (rowid)
                 )""",
+            """CREATE TABLE IF NOT EXISTS
+                sitelink_verdict (
+                    qid TEXT,
+                    dbname TEXT,
+                    page_title TEXT,
+                    verdict TEXT,
+                    item_revid INT,
+                    page_revid INT,
+                    checked_at INT,
+                    PRIMARY KEY (qid, dbname, page_title)
+                )""",
+            """CREATE TABLE IF NOT EXISTS
+                special_page_sitelink (
+                    run_id TEXT,
+                    qid TEXT,
+                    dbname TEXT,
+                    page_title TEXT,
+                    PRIMARY KEY (run_id, qid, dbname, page_title)
+                )""",
+            """CREATE TABLE IF NOT EXISTS
+                sitelink_edit (
+                    run_id TEXT,
+                    logged_at INT,
+                    revid INT,
+                    qid TEXT,
+                    dbname TEXT,
+                    page_title TEXT,
+                    likely_reason TEXT,
+                    log_type TEXT,
+                    log_action TEXT,
+                    log_timestamp INT,
+                    user_id INT,
+                    user_name TEXT,
+                    user_registration INT,
+                    user_editcount INT,
+                    user_block_count INT,
+                    eval_params TEXT,
+                    eval_str TEXT,
+                    log_event TEXT,
+                    legacy_case_rowid INT
+                )""",
+            """CREATE INDEX IF NOT EXISTS sitelink_edit_reason_wiki_time ON sitelink_edit (likely_reason, dbname, logged_at)""",
+            """CREATE INDEX IF NOT EXISTS sitelink_edit_wiki_time ON sitelink_edit (dbname, logged_at)""",
+            """CREATE INDEX IF NOT EXISTS sitelink_edit_logged_at ON sitelink_edit (logged_at)""",
+            """CREATE INDEX IF NOT EXISTS sitelink_edit_log_timestamp ON sitelink_edit (log_timestamp)""",
+            """CREATE INDEX IF NOT EXISTS sitelink_edit_run ON sitelink_edit (run_id)""",
+            """CREATE INDEX IF NOT EXISTS sitelink_edit_user ON sitelink_edit (user_name)""",
+            """CREATE INDEX IF NOT EXISTS sitelink_edit_qid ON sitelink_edit (qid)""",
+            """CREATE UNIQUE INDEX IF NOT EXISTS sitelink_edit_legacy_case ON sitelink_edit (legacy_case_rowid)""",
+            """CREATE TABLE IF NOT EXISTS
+                project_stats (
+                    run_id TEXT,
+                    dbname TEXT,
+                    started_at INT,
+                    scan_duration REAL,
+                    duration REAL,
+                    candidates INT,  -- -1 if the scan failed
+                    PRIMARY KEY (run_id, dbname)
+                )""",
+            """CREATE INDEX IF NOT EXISTS project_stats_wiki_time ON project_stats (dbname, started_at)""",
+            """CREATE INDEX IF NOT EXISTS sitelink_edit_run_wiki ON sitelink_edit (run_id, dbname)""",
+            """CREATE TABLE IF NOT EXISTS
+                schema_migration (
+                    name TEXT PRIMARY KEY,
+                    applied_at INT
+                )""",
         ]
 
         for query in queries:
@@ -264,6 +513,54 @@ class LoggingDB:
                 self.connection.execute(query)
                 LOG.debug('created table for logging database')
 
+        if path not in LoggingDB.migrated:
+            self._migrate_sitelink_case()
+            LoggingDB.migrated.add(path)
+
+    def _migrate_sitelink_case(self) -> None:
+        # one-off copy of the former EAV tables (sitelink_case, sitelink_logparams, sitelink_logevent,
+        # sitelink_logstr) into sitelink_edit; params had been stored as str() values, with "None" for None
+        def param(key:str, cast:str='TEXT') -> str:
+            return f"CAST(NULLIF(MAX(CASE WHEN p.p_key='{key}' THEN p.p_value END), 'None') AS {cast})"
+
+        query = f"""INSERT OR IGNORE INTO sitelink_edit
+            SELECT
+                NULL,
+                NULL,
+                c.revid,
+                c.qid,
+                c.dbname,
+                c.page_title,
+                {param('likely_reason')},
+                NULL,
+                {param('log_action')},
+                {param('log_timestamp', 'INTEGER')},
+                {param('user_id', 'INTEGER')},
+                {param('user_name')},
+                {param('user_registration', 'INTEGER')},
+                {param('user_editcount', 'INTEGER')},
+                {param('user_block_count', 'INTEGER')},
+                json_group_object(p.p_key, CAST(p.p_value AS TEXT)) FILTER (WHERE p.p_key IS NOT NULL),
+                (SELECT CAST(logstr AS TEXT) FROM sitelink_logstr WHERE sitelink_case_rowid=c.rowid),
+                (SELECT CAST(logevent AS TEXT) FROM sitelink_logevent WHERE sitelink_case_rowid=c.rowid),
+                c.rowid
+            FROM
+                sitelink_case AS c
+                    LEFT JOIN sitelink_logparams AS p ON p.sitelink_case_rowid=c.rowid
+            GROUP BY
+                c.rowid"""
+
+        # check and copy in one write transaction, so that concurrently starting processes migrate only once
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            result = self.connection.execute('SELECT 1 FROM schema_migration WHERE name=?', (LOGGING_DB_MIGRATION_EAV,)).fetchone()
+            if result is not None:
+                return
+
+            cursor = self.connection.execute(query)
+            self.connection.execute('INSERT OR IGNORE INTO schema_migration VALUES (?, ?)', (LOGGING_DB_MIGRATION_EAV, int(time())))
+        LOG.info(f'migrated {cursor.rowcount} logged cases to table sitelink_edit')
+
     # not in use right now
     @classmethod
     def query_logs(cls:Type[L], query:str, params:Optional[dict[str, Any]]=None) -> Optional[list[tuple]]:
@@ -282,47 +579,240 @@ class LoggingDB:
         return None
 
     @classmethod
-    def insert_log(cls:Type[L], revid:int, payload:dict[str, Any]) -> None:
-        query_case = """INSERT INTO sitelink_case VALUES (:qid, :dbname, :page_title, :revid)"""
-        payload_case = {
+    def insert_log(cls:Type[L], revid:int, payload:dict[str, Any], run_id:Optional[str]=None) -> None:
+        eval_params = payload.get('eval_params', {})
+        log_event = payload.get('log_event')
+
+        query = """INSERT INTO sitelink_edit VALUES (:run_id, :logged_at, :revid, :qid, :dbname, :page_title,
+            :likely_reason, :log_type, :log_action, :log_timestamp, :user_id, :user_name, :user_registration,
+            :user_editcount, :user_block_count, :eval_params, :eval_str, :log_event, NULL)"""
+        params = {
+            'run_id' : run_id,
+            'logged_at' : int(time()),
+            'revid' : revid,
             'qid' : payload.get('qid', ''),
             'dbname' : payload.get('dbname', ''),
             'page_title' : payload.get('page_title', ''),
-            'revid' : revid
+            'likely_reason' : eval_params.get('likely_reason'),
+            'log_type' : None if log_event is None else log_event.get('type'),
+            'log_action' : eval_params.get('log_action'),
+            'log_timestamp' : eval_params.get('log_timestamp'),
+            'user_id' : eval_params.get('user_id'),
+            'user_name' : eval_params.get('user_name'),
+            'user_registration' : eval_params.get('user_registration'),
+            'user_editcount' : eval_params.get('user_editcount'),
+            'user_block_count' : eval_params.get('user_block_count'),
+            'eval_params' : dumps(eval_params, default=str),
+            'eval_str' : payload.get('eval_str'),
+            'log_event' : None if log_event is None else str(log_event),
+        }
+
+        with cls() as (db_connection, db_cursor):
+            db_cursor.execute(query, params)
+            db_connection.commit()
+        LOG.info('inserted logging to database')
+
+    @classmethod
+    def query_case_counts(cls:Type[L], group_by:list[str], likely_reason:Optional[str]=None, dbname:Optional[str]=None, \
+                          since:Optional[int]=None, until:Optional[int]=None, run_id:Optional[str]=None) -> list[dict[str, Any]]:
+        # e.g. query_case_counts([ 'dbname' ], likely_reason='2A-b', since=...) for removals per wiki;
+        # since and until are unix timestamps of the edits
+        unknown_dimensions = [ dimension for dimension in group_by if dimension not in CASE_DIMENSIONS ]
+        if len(unknown_dimensions) > 0:
+            raise ValueError(f'Unknown case dimensions {unknown_dimensions}')
+
+        filters = {
+            'likely_reason=:likely_reason' : likely_reason,
+            'dbname=:dbname' : dbname,
+            'logged_at>=:since' : since,
+            'logged_at<:until' : until,
+            'run_id=:run_id' : run_id,
         }
+        conditions = [ condition for condition, value in filters.items() if value is not None ]
+        params = { 'likely_reason' : likely_reason, 'dbname' : dbname, 'since' : since, 'until' : until, 'run_id' : run_id }
+
+        select = [ f'{CASE_DIMENSIONS[dimension]} AS {dimension}' for dimension in group_by ]
+        query = f"""SELECT
+                {', '.join([ *select, 'COUNT(*) AS cnt' ])}
+            FROM
+                sitelink_edit"""
+        if len(conditions) > 0:
+            query += f"""
+            WHERE
+                {' AND '.join(conditions)}"""
+        if len(group_by) > 0:
+            query += f"""
+            GROUP BY
+                {', '.join(group_by)}
+            ORDER BY
+                {', '.join(group_by)}"""
+
+        with cls() as (_, db_cursor):
+            db_cursor.execute(query, params)
+            result = db_cursor.fetchall()
 
-        query_event = """INSERT INTO sitelink_logevent VALUES (:id, :logevent)"""
-        query_str = """INSERT INTO sitelink_logstr VALUES (:id, :logstr)"""
-        query_params = """INSERT INTO sitelink_logparams VALUES (:id, :key, :value, :datatype)"""
+        return [ dict(zip([ *group_by, 'cnt' ], row)) for row in result ]
+
+    @classmethod
+    def insert_verdicts(cls:Type[L], dbname:str, verdicts:list[tuple[str, str, str, int, int]]) -> None:
+        # verdicts: (qid, page_title, verdict, item_revid, page_revid)
+        query = """INSERT OR REPLACE INTO sitelink_verdict VALUES (?, ?, ?, ?, ?, ?, ?)"""
+        checked_at = int(time())
 
         with cls() as (db_connection, db_cursor):
-            db_cursor.execute(query_case, payload_case)
-            rowid = db_cursor.lastrowid
+            db_cursor.executemany(
+                query,
+                [ (qid, dbname, page_title, verdict, item_revid, page_revid, checked_at) for qid, page_title, verdict, item_revid, page_revid in verdicts ]
+            )
+            db_connection.commit()
+        LOG.debug(f'inserted {len(verdicts)} verdicts for {dbname} to database')
 
-            for key, value in payload.items():
-                if key in [ 'qid', 'dbname', 'page_title' ]:
-                    continue
-                if key == 'log_event':
-                    payload_event = {
-                        'id' : rowid,
-                        'logevent' : str(value)
-                    }
-                    db_cursor.execute(query_event, payload_event)                
-                elif key == 'eval_str':
-                    payload_str = {
-                        'id' : rowid,
-                        'logstr' : value
-                    }
-                    db_cursor.execute(query_str, payload_str)
-                elif key == 'eval_params':
-                    for key_params, value_params in value.items():
-                        payload_params = {
-                            'id' : rowid,
-                            'key' : key_params,
-                            'value' : str(value_params),
-                            'datatype' : str(type(value_params))
-                        }
-                        db_cursor.execute(query_params, payload_params)
+    @classmethod
+    def query_verdicts(cls:Type[L], dbname:str, min_checked_at:int=0) -> dict[tuple[str, str], tuple[str, int, int]]:
+        query = """SELECT
+                qid,
+                page_title,
+                verdict,
+                item_revid,
+                page_revid
+            FROM
+                sitelink_verdict
+            WHERE
+                dbname=:dbname
+                AND checked_at>=:min_checked_at"""
+        params = { 'dbname' : dbname, 'min_checked_at' : min_checked_at }
+
+        with cls._run_wide() as (_, db_cursor):
+            db_cursor.execute(query, params)
+            result = db_cursor.fetchall()
+
+        return { (qid, page_title) : (verdict, item_revid, page_revid) for qid, page_title, verdict, item_revid, page_revid in result }
+
+    @classmethod
+    def insert_special_page_sitelinks(cls:Type[L], run_id:str, entries:list[tuple[str, str, str]]) -> None:
+        # entries are (qid, dbname, page_title); duplicates, e.g. from a reclaimed wiki, are ignored
+        query = """INSERT OR IGNORE INTO special_page_sitelink VALUES (?, ?, ?, ?)"""
+
+        with cls() as (db_connection, db_cursor):
+            db_cursor.executemany(query, [ (run_id, *entry) for entry in entries ])
+            db_connection.commit()
+        LOG.debug(f'inserted {len(entries)} special page sitelinks to database')
+
+    @classmethod
+    def query_special_page_sitelinks(cls:Type[L], run_id:str) -> list[tuple[str, str, str]]:
+        query = """SELECT
+                qid,
+                dbname,
+                page_title
+            FROM
+                special_page_sitelink
+            WHERE
+                run_id=:run_id
+            ORDER BY
+                dbname,
+                page_title,
+                qid"""
+
+        with cls._run_wide() as (_, db_cursor):
+            db_cursor.execute(query, { 'run_id' : run_id })
+            result = db_cursor.fetchall()
+
+        return [ (qid, dbname, page_title) for qid, dbname, page_title in result ]
+
+    @classmethod
+    def clear_special_page_sitelinks(cls:Type[L], keep_run_id:Optional[str]=None) -> None:
+        with cls() as (db_connection, db_cursor):
+            if keep_run_id is None:
+                db_cursor.execute('DELETE FROM special_page_sitelink')
+            else:
+                db_cursor.execute('DELETE FROM special_page_sitelink WHERE run_id!=:run_id', { 'run_id' : keep_run_id })
+            db_connection.commit()
+
+    @classmethod
+    def insert_project_stats(cls:Type[L], run_id:str, dbname:str, started_at:int, scan_duration:float, duration:float, candidates:int) -> None:
+        query = """INSERT OR REPLACE INTO project_stats VALUES (:run_id, :dbname, :started_at, :scan_duration, :duration, :candidates)"""
+        payload = {
+            'run_id' : run_id,
+            'dbname' : dbname,
+            'started_at' : started_at,
+            'scan_duration' : scan_duration,
+            'duration' : duration,
+            'candidates' : candidates
+        }
 
+        with cls() as (db_connection, db_cursor):
+            db_cursor.execute(query, payload)
             db_connection.commit()
-            LOG.info('inserted logging to database')
+        LOG.debug(f'inserted project stats for {dbname} to database')
+
+    @classmethod
+    def add_project_duration(cls:Type[L], run_id:str, dbname:str, duration:float) -> None:
+        # e.g. time of consolidated edits, which are applied after the project itself
+        query = """UPDATE project_stats SET duration=duration+:duration WHERE run_id=:run_id AND dbname=:dbname"""
+
+        with cls() as (db_connection, db_cursor):
+            db_cursor.execute(query, { 'run_id' : run_id, 'dbname' : dbname, 'duration' : duration })
+            db_connection.commit()
+
+    @classmethod
+    def query_project_history(cls:Type[L], max_runs:int) -> dict[str, list[tuple[float, int, bool]]]:
+        # (duration in seconds, number of logged edits, scan failed) of the most recent max_runs runs
+        # per project, most recent run first
+        query = """SELECT
+                dbname,
+                duration,
+                (SELECT COUNT(*) FROM sitelink_edit AS e WHERE e.run_id=s.run_id AND e.dbname=s.dbname) AS fixes,
+                candidates<0 AS failed
+            FROM (
+                SELECT
+                    run_id,
+                    dbname,
+                    duration,
+                    candidates,
+                    ROW_NUMBER() OVER (PARTITION BY dbname ORDER BY started_at DESC) AS run_rank
+                FROM
+                    project_stats
+            ) AS s
+            WHERE
+                run_rank<=:max_runs
+            ORDER BY
+                dbname,
+                run_rank"""
+
+        with cls._run_wide() as (_, db_cursor):
+            db_cursor.execute(query, { 'max_runs' : max_runs })
+            result = db_cursor.fetchall()
+
+        history:dict[str, list[tuple[float, int, bool]]] = {}
+        for dbname, duration, fixes, failed in result:
+            history.setdefault(dbname, []).append((duration, fixes, bool(failed)))
+
+        return history
+
+    @classmethod
+    def merge_logging_db(cls:Type[L], path:str, run_id:str) -> None:
+        # rows which a worker logged into its own file for run_id; verdicts are merged if newer
+        queries = [
+            """INSERT INTO sitelink_edit SELECT * FROM worker.sitelink_edit WHERE run_id=:run_id""",
+            """INSERT OR REPLACE INTO project_stats SELECT * FROM worker.project_stats WHERE run_id=:run_id""",
+            """DELETE FROM special_page_sitelink WHERE run_id!=:run_id""",
+            """INSERT OR IGNORE INTO special_page_sitelink SELECT * FROM worker.special_page_sitelink WHERE run_id=:run_id""",
+            """INSERT OR REPLACE INTO sitelink_verdict
+                SELECT
+                    w.*
+                FROM
+                    worker.sitelink_verdict AS w
+                        LEFT JOIN main.sitelink_verdict AS m USING (qid, dbname, page_title)
+                WHERE
+                    m.checked_at IS NULL
+                    OR w.checked_at>m.checked_at""",
+        ]
+
+        with cls(DB_PATH) as (db_connection, _):
+            db_connection.execute('ATTACH DATABASE ? AS worker', (path,))
+            with db_connection:
+                db_connection.execute('BEGIN IMMEDIATE')
+                for query in queries:
+                    db_connection.execute(query, { 'run_id' : run_id })
+            db_connection.execute('DETACH DATABASE worker')
+        LOG.info(f'merged logging database {path} of run {run_id}')
@@ -1,19 +1,37 @@
 from datetime import datetime
 import logging
-from time import strftime
+from time import strftime, time
 from typing import Any, Optional
 
 import pandas as pd
 
-from .config import QIDS_TO_IGNORE, MAX_SITELINKS_PER_PROJECT
-from .types import WikiClient, Page, Sitelink, LogEvent
+from .config import QIDS_TO_IGNORE, VERDICT_CACHE, VERDICT_CACHE_TTL
+from .database import LoggingDB
+from .types import WikiClient, Page, PageStatus, Sitelink, LogEvent
+from .query_tooldb import query_existing_page_titles, stage_verdict_keys
+from .query_replicas import query_item_revisions, query_page_revisions, query_page_status, query_existing_pages, \
+    get_looked_up_namespaces
 from .bot_sitelinks import remove_sitelink_from_item, canonicalize_sitelink, normalize_title, \
-    check_if_item_has_sitelink, check_if_page_exists_on_client, check_if_page_is_redirect
+    check_if_item_has_sitelink, check_if_page_exists_on_client, check_if_page_is_redirect, get_cached_item_revision
 from .special_pages_report import log_special_page_sitelink
 
 
 LOG = logging.getLogger(__name__)
 
+# pre-classification of sitelinks to inexistent pages; only PRECHECK_MISSING is sent down the expensive path
+PRECHECK_SPECIAL:str = 'special'  # sitelink to a virtual namespace such as Special: or Media:
+PRECHECK_ALIAS:str = 'alias'  # sitelink uses a canonical or alias namespace prefix instead of the local one
+PRECHECK_VARIANT:str = 'variant'  # case/underscore spelling variant of an existing page
+PRECHECK_MISSING:str = 'missing'  # page is truly missing
+
+# verdicts for candidates which did not lead to an edit; skipped until item or client page change
+VERDICT_ITEM_LACKS_SITELINK:str = 'item_lacks_sitelink'
+VERDICT_IGNORED:str = 'ignored'
+VERDICT_NO_LOGEVENT:str = 'no_logevent'
+VERDICT_API_ERROR:str = 'api_error'
+VERDICT_BUFFER:list[tuple[str, str, str, Optional[int], Optional[int]]] = []  # (qid, page_title, verdict, item revid, page revid) of the current wiki
+VERDICT_PAGE_STATUSES:dict[str, PageStatus] = {}  # page_title: status as seen before the current wiki was processed
+
 
 def _make_callback_payload(qid:str, dbname:str, page_title:str, log_event:Optional[dict[str, Any]]=None, \
                            eval_params:Optional[dict]=None, eval_str:Optional[str]=None) -> dict[str, Any]:
@@ -32,18 +50,140 @@ def _make_callback_payload(qid:str, dbname:str, page_title:str, log_event:Option
     return callback_payload
 
 
-def remove_sitelinks(df:pd.DataFrame, wiki_client:WikiClient) -> None:
-    LOG.info(f'Cases of sitelinks to inexistent pages in {wiki_client.dbname}: {df.shape[0]}')
+def _record_verdict(sitelink:Sitelink, verdict:str) -> None:
+    # buffered with the revisions which verification saw, so that later changes invalidate the verdict;
+    # revisions unknown here are looked up in bulk by flush_verdicts()
+    if VERDICT_CACHE is not True:
+        return
 
-    if df.shape[0] > MAX_SITELINKS_PER_PROJECT:
-        df = df.sample(MAX_SITELINKS_PER_PROJECT)
-    
+    page_status = VERDICT_PAGE_STATUSES.get(sitelink.page.page_title)
+    VERDICT_BUFFER.append((
+        sitelink.qid,
+        sitelink.page.page_title,
+        verdict,
+        get_cached_item_revision(sitelink.qid),
+        None if page_status is None else page_status.revid
+    ))
+
+
+def flush_verdicts(wiki_client:WikiClient) -> None:
+    VERDICT_PAGE_STATUSES.clear()
+    if len(VERDICT_BUFFER) == 0:
+        return
+
+    item_revids = query_item_revisions(list({ qid for qid, _, _, item_revid, _ in VERDICT_BUFFER if item_revid is None }))
+    page_revids = query_page_revisions(wiki_client, list({ page_title for _, page_title, _, _, page_revid in VERDICT_BUFFER if page_revid is None }))
+    LoggingDB.insert_verdicts(
+        wiki_client.dbname,
+        [
+            (
+                qid,
+                page_title,
+                verdict,
+                item_revids.get(qid, 0) if item_revid is None else item_revid,
+                page_revids.get(page_title, 0) if page_revid is None else page_revid
+            ) for qid, page_title, verdict, item_revid, page_revid in VERDICT_BUFFER
+        ]
+    )
+    VERDICT_BUFFER.clear()
+
+
+def stage_cached_verdicts(wiki_client:WikiClient) -> int:
+    # candidates with an unchanged cached verdict are excluded in the tool database before the
+    # sample is drawn, so that they do not take its slots; requires the staging tables of the wiki
+    if VERDICT_CACHE is not True:
+        stage_verdict_keys([])
+        return 0
+
+    verdicts = LoggingDB.query_verdicts(wiki_client.dbname, min_checked_at=int(time())-VERDICT_CACHE_TTL)
+    if len(verdicts) == 0:
+        stage_verdict_keys([])
+        return 0
+
+    item_revids = query_item_revisions(list({ qid for qid, _ in verdicts.keys() }))
+    page_revids = query_page_revisions(wiki_client, list({ page_title for _, page_title in verdicts.keys() }))
+
+    unchanged = [
+        (qid, page_title) for (qid, page_title), (_, item_revid, page_revid) in verdicts.items() \
+            if item_revids.get(qid, 0) == item_revid and page_revids.get(page_title, 0) == page_revid
+    ]
+    stage_verdict_keys(unchanged)
+    LOG.info(f'Excluding {len(unchanged)} candidates in {wiki_client.dbname} with unchanged cached verdicts')
+
+    return len(unchanged)
+
+
+def preclassify_missing_pages(df:pd.DataFrame, wiki_client:WikiClient) -> pd.DataFrame:
+    df['precheck'] = PRECHECK_MISSING
+    if df.shape[0] == 0:
+        return df
+
+    prefix_to_namespace = wiki_client.get_namespace_prefixes()
+
+    title_parts = df['sitelink'].str.split(':', n=1)
+    has_colon = df['sitelink'].str.contains(':', regex=False)
+    prefix = title_parts.str[0].where(has_colon, '')
+    namespace = prefix.map(prefix_to_namespace)  # NaN if no namespace prefix; main namespace then
+    has_namespace = namespace.notna()
+
+    ns_numerical = namespace.map(lambda ns : ns.ns, na_action='ignore').fillna(0).astype(int)
+    ns_local = namespace.map(lambda ns : ns.ns_local, na_action='ignore').fillna('')
+    first_letter = namespace.map(lambda ns : ns.ns_case, na_action='ignore').fillna(
+        wiki_client.get_namespace_case_by_id(0)
+    ) == 'first-letter'
+
+    title = title_parts.str[-1].where(has_namespace, df['sitelink']).str.replace('_', ' ')
+    first_char = title.str[:1]
+    first_char_upper = first_char.str.upper()
+    first_char_upper = first_char_upper.where(first_char_upper.str.len() == 1, first_char)  # MediaWiki keeps e.g. ß and ligatures
+    title = title.where(~first_letter, first_char_upper + title.str[1:])
+    candidate = (ns_local + ':').where(has_namespace, '') + title
+
+    is_special = has_namespace & (ns_numerical < 0)
+    is_alias = has_namespace & ~is_special & (prefix != ns_local)
+    is_candidate = ~is_special & ~is_alias & (candidate != df['sitelink'])
+
+    # the staging table holds all pages of scanned namespaces, but only sitelink titles of looked up ones
+    is_looked_up = ns_numerical.isin(get_looked_up_namespaces(wiki_client.dbname))
+    existing_titles = query_existing_page_titles(candidate[is_candidate & ~is_looked_up].unique().tolist())
+    existing_titles |= query_existing_pages(wiki_client, candidate[is_candidate & is_looked_up].unique().tolist())
+    is_variant = is_candidate & candidate.isin(existing_titles)
+
+    df.loc[is_special, 'precheck'] = PRECHECK_SPECIAL
+    df.loc[is_alias, 'precheck'] = PRECHECK_ALIAS
+    df.loc[is_variant, 'precheck'] = PRECHECK_VARIANT
+
+    return df
+
+
+def remove_sitelinks(df:pd.DataFrame, wiki_client:WikiClient, candidate_count:Optional[int]=None) -> None:
+    if candidate_count is None:
+        candidate_count = df.shape[0]
+    LOG.info(f'Cases of sitelinks to inexistent pages in {wiki_client.dbname}: {candidate_count}' \
+             f' ({df.shape[0]} sampled)')
+
+    df = preclassify_missing_pages(df, wiki_client)
+    LOG.info(f'Pre-classified sitelinks to inexistent pages in {wiki_client.dbname}:' \
+             f' {df["precheck"].value_counts().to_dict()}')
+
+    # existence of truly missing pages is verified in bulk on the replica where possible
+    page_statuses = query_page_status(wiki_client, df.loc[df['precheck']==PRECHECK_MISSING, 'sitelink'].tolist())
+    VERDICT_PAGE_STATUSES.update(page_statuses)
+
+    try:
+        _process_missing_pages(df, wiki_client, page_statuses)
+    finally:
+        flush_verdicts(wiki_client)
+
+
+def _process_missing_pages(df:pd.DataFrame, wiki_client:WikiClient, page_statuses:dict[str, PageStatus]) -> None:
     for elem in df.itertuples():
         page = Page(
             elem.sitelink,
             wiki_client,
             page_namespace=elem.ns_numerical,
-            qid_local=elem.qid
+            qid_local=elem.qid,
+            lazy_logevents=(elem.precheck != PRECHECK_MISSING)
         )
 
         sitelink = Sitelink(
@@ -52,10 +192,25 @@ def remove_sitelinks(df:pd.DataFrame, wiki_client:WikiClient) -> None:
             page
         )
 
-        process_sitelink(sitelink)
+        if elem.precheck == PRECHECK_SPECIAL:
+            process_sitelink_special(sitelink)
+        elif elem.precheck == PRECHECK_ALIAS:
+            process_sitelink_alt_title(sitelink)
+        elif elem.precheck == PRECHECK_VARIANT:
+            process_sitelink_variant(sitelink)
+        else:
+            process_sitelink(sitelink, page_statuses.get(sitelink.page.page_title))
+
+
+def _check_if_page_is_redirect(sitelink:Sitelink, page_title:str) -> bool:
+    page_status = query_page_status(sitelink.wiki_client, [ page_title ]).get(page_title)
+    if page_status is not None:
+        return page_status.is_redirect
+
+    return check_if_page_is_redirect(sitelink.wiki_client.dbname, page_title)
 
 
-def process_sitelink(sitelink:Sitelink) -> None:  # TODO: tidy
+def process_sitelink(sitelink:Sitelink, page_status:Optional[PageStatus]=None) -> None:  # TODO: tidy
     try:
         item_has_sitelink = check_if_item_has_sitelink(sitelink.qid, sitelink.wiki_client.dbname, sitelink.page.page_title)
     except RuntimeWarning:
@@ -66,15 +221,20 @@ def process_sitelink(sitelink:Sitelink) -> None:  # TODO: tidy
             return
         else:
             LOG.info(f'Item {sitelink.qid} does not have a sitelink "{sitelink.page.page_title}" for {sitelink.wiki_client.dbname}')
+            _record_verdict(sitelink, VERDICT_ITEM_LACKS_SITELINK)
             return # nothing to do
 
-    try:
-        page_exists = check_if_page_exists_on_client(sitelink.wiki_client.dbname, sitelink.page.page_title)
-    except RuntimeWarning:
-        log_special_page_sitelink(sitelink.qid, sitelink.wiki_client.dbname, sitelink.page.page_title)
-        page_exists = False
+    if page_status is not None:
+        page_exists = page_status.exists
+    else:
+        try:
+            page_exists = check_if_page_exists_on_client(sitelink.wiki_client.dbname, sitelink.page.page_title)
+        except RuntimeWarning:
+            log_special_page_sitelink(sitelink.qid, sitelink.wiki_client.dbname, sitelink.page.page_title)
+            page_exists = False
 
     if sitelink.qid in QIDS_TO_IGNORE:
+        _record_verdict(sitelink, VERDICT_IGNORED)
         return
 
     if page_exists:
@@ -101,9 +261,41 @@ def process_sitelink(sitelink:Sitelink) -> None:  # TODO: tidy
         process_sitelink_delete(sitelink, log_event, eval_str, eval_params)
 
 
+def process_sitelink_special(sitelink:Sitelink) -> None:
+    # the sitelink might have been removed or changed since the replica scan
+    try:
+        item_has_sitelink = check_if_item_has_sitelink(sitelink.qid, sitelink.wiki_client.dbname, sitelink.page.page_title)
+    except RuntimeWarning:
+        return
+    if not item_has_sitelink:
+        LOG.info(f'Item {sitelink.qid} does not have a sitelink "{sitelink.page.page_title}" for {sitelink.wiki_client.dbname}')
+        _record_verdict(sitelink, VERDICT_ITEM_LACKS_SITELINK)
+        return
+
+    log_special_page_sitelink(sitelink.qid, sitelink.wiki_client.dbname, sitelink.page.page_title)
+
+
+def process_sitelink_variant(sitelink:Sitelink) -> None:
+    try:
+        item_has_sitelink = check_if_item_has_sitelink(sitelink.qid, sitelink.wiki_client.dbname, sitelink.page.page_title)
+    except RuntimeWarning:
+        return
+    if not item_has_sitelink:
+        LOG.info(f'Item {sitelink.qid} does not have a sitelink "{sitelink.page.page_title}" for {sitelink.wiki_client.dbname}')
+        _record_verdict(sitelink, VERDICT_ITEM_LACKS_SITELINK)
+        return
+
+    if sitelink.qid in QIDS_TO_IGNORE:
+        _record_verdict(sitelink, VERDICT_IGNORED)
+        return
+
+    process_sitelink_title_normalization(sitelink)
+
+
 def process_sitelink_no_logevent(sitelink:Sitelink) -> None:  # TODO: does nothing
     eval_str = f'Cannot find a log timestamp for page "{sitelink.page.page_title}" on {sitelink.wiki_client.dbname} in {sitelink.qid}'
     LOG.debug(eval_str)
+    _record_verdict(sitelink, VERDICT_NO_LOGEVENT)
 
 
 def process_sitelink_alt_title(sitelink:Sitelink) -> None:
@@ -122,7 +314,9 @@ def process_sitelink_alt_title(sitelink:Sitelink) -> None:
         eval_params=eval_params,
         eval_str=eval_str
     )
-    canonicalize_sitelink(sitelink.qid, sitelink.wiki_client.dbname, callback_payload)
+    edit_succeeded = canonicalize_sitelink(sitelink.qid, sitelink.wiki_client.dbname, callback_payload)
+    if edit_succeeded is False:
+        _record_verdict(sitelink, VERDICT_API_ERROR)
     LOG.debug(eval_str)
 
 
@@ -141,7 +335,9 @@ def process_sitelink_title_normalization(sitelink:Sitelink) -> None:
         eval_params=eval_params,
         eval_str=eval_str
     )
-    normalize_title(sitelink.qid, sitelink.wiki_client.dbname, sitelink.page.page_title, callback_payload)
+    edit_succeeded = normalize_title(sitelink.qid, sitelink.wiki_client.dbname, sitelink.page.page_title, callback_payload)
+    if edit_succeeded is False:
+        _record_verdict(sitelink, VERDICT_API_ERROR)
 
 
 def process_sitelink_move(sitelink:Sitelink, log_event:LogEvent, eval_str:list[str], eval_params:dict) -> None:
@@ -154,7 +350,7 @@ def process_sitelink_move(sitelink:Sitelink, log_event:LogEvent, eval_str:list[s
     eval_str.append(f'Move target: {move_target} ({move_target_namespace}, from {move_source_namespace})')
 
     try:
-        target_page_is_redirect = check_if_page_is_redirect(sitelink.wiki_client.dbname, move_target)
+        target_page_is_redirect = _check_if_page_is_redirect(sitelink, move_target)
     except ValueError:  # this usually happens when the old logging format has been used on the client, which this script does not understand
         LOG.warn(f'Problem with {sitelink.qid}, {sitelink.wiki_client.dbname}, {sitelink.page.page_title}, {log_event}')
         return
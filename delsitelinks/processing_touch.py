@@ -1,28 +1,162 @@
+from collections.abc import Generator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 import logging
+from threading import BoundedSemaphore, Lock
+from typing import Optional
 
 import pandas as pd
 
-from .types import WikiClient
+from .config import TOUCH_QUARANTINE_FAILURES, TOUCH_QUARANTINE_WIKIS, TOUCH_REVALIDATION, TOUCH_REVALIDATION_BATCH_SIZE
+from .query_replicas import query_page_status, query_sitelink_items
+from .types import PageStatus, WikiClient
 from .bot_touch import touch_page
 
 
 LOG = logging.getLogger(__name__)
 
+QUARANTINED_WIKIS:set[str] = set(TOUCH_QUARANTINE_WIKIS)  # plus wikis with too many consecutive failed touches in this run
+TOUCH_EXECUTOR:Optional[ThreadPoolExecutor] = None  # set by parallel_touch_workers(); pages are touched inline otherwise
+TOUCH_BACKLOG:Optional[BoundedSemaphore] = None
+SITE_LOCKS:dict[str, Lock] = {}  # one worker per wiki at a time, so that the touch rate of each site is respected
+SITE_LOCKS_LOCK = Lock()
+REVALIDATION_COUNTS:dict[str, int] = { 'checked' : 0, 'skipped' : 0 }  # of the whole run
+
+
+def is_quarantined(dbname:str) -> bool:
+    return dbname in QUARANTINED_WIKIS
+
+
+def _quarantine(dbname:str, reason:str) -> None:
+    QUARANTINED_WIKIS.add(dbname)
+    LOG.warn(f'{dbname} quarantined for the rest of the run: {reason}')
+
+
+def _site_lock(dbname:str) -> Lock:
+    with SITE_LOCKS_LOCK:
+        return SITE_LOCKS.setdefault(dbname, Lock())
+
+
+def _needs_no_touch(page_status:Optional[PageStatus], sitelink_item:Optional[str]) -> bool:
+    if page_status is None:  # unknown, e.g. an ambiguous title
+        return False
+
+    if page_status.exists is False:  # a touch would fail
+        return True
+
+    return page_status.qid == sitelink_item  # page_props agrees with the sitelink by now, or both are gone
+
+
+def _revalidate_touch_candidates(df:pd.DataFrame, wiki_client:WikiClient) -> pd.DataFrame:
+    # candidates were found when the wiki was scanned; many of them fix themselves before their touch
+    if TOUCH_REVALIDATION is not True or df.shape[0] == 0:
+        return df
+
+    page_titles = df['sitelink'].tolist()
+    try:
+        sitelink_items = query_sitelink_items(wiki_client.dbname, page_titles)
+        if sitelink_items is None:
+            return df
+        page_statuses = query_page_status(wiki_client, page_titles)
+    except RuntimeError as exception:  # touch all of them
+        LOG.warn(f'Cannot revalidate touch candidates of {wiki_client.dbname}: {exception}')
+        return df
+
+    if len(page_statuses) == 0:  # client replica lags behind
+        return df
+
+    needs_no_touch = df['sitelink'].map(lambda page_title : _needs_no_touch(page_statuses.get(page_title), sitelink_items.get(page_title)))
+
+    return df.loc[~needs_no_touch.astype(bool)]
+
+
+def _touch_pages_serially(df:pd.DataFrame, wiki_client:WikiClient) -> None:
+    with _site_lock(wiki_client.dbname):
+        consecutive_failures = 0
+        skipped = 0
+        touched = 0
+        for start in range(0, df.shape[0], TOUCH_REVALIDATION_BATCH_SIZE):
+            if is_quarantined(wiki_client.dbname):
+                LOG.info(f'{wiki_client.dbname} is quarantined; {df.shape[0]-start} pages not touched')
+                break
+
+            batch = df.iloc[start:start+TOUCH_REVALIDATION_BATCH_SIZE]
+            batch_to_touch = _revalidate_touch_candidates(batch, wiki_client)
+            skipped += batch.shape[0] - batch_to_touch.shape[0]
+
+            for elem in batch_to_touch.itertuples():
+                if is_quarantined(wiki_client.dbname):
+                    break
+
+                try:
+                    touch_page(
+                        wiki_client.dbname,
+                        elem.sitelink
+                    )
+                except RuntimeWarning:
+                    LOG.warn(f'did not touch "{elem.sitelink}" on project' \
+                             f' {wiki_client.dbname}')
+                    consecutive_failures += 1
+                    if TOUCH_QUARANTINE_FAILURES > 0 and consecutive_failures >= TOUCH_QUARANTINE_FAILURES:
+                        _quarantine(wiki_client.dbname, f'{consecutive_failures} consecutive failed touches')
+                else:
+                    consecutive_failures = 0
+                    touched += 1
+                    if touched%100==0:
+                        LOG.info(f'touched "{elem.sitelink}" on project' \
+                                 f' {wiki_client.dbname} ({touched}/{df.shape[0]})')
+
+        if TOUCH_REVALIDATION is True and df.shape[0] > 0:
+            LOG.info(f'{wiki_client.dbname}: {skipped}/{df.shape[0]} touch candidates ({skipped/df.shape[0]:.1%})' \
+                     f' needed no touch anymore and were skipped; {touched} touched')
+            with SITE_LOCKS_LOCK:
+                REVALIDATION_COUNTS['checked'] += df.shape[0]
+                REVALIDATION_COUNTS['skipped'] += skipped
+
+
+def _touch_pages_done(future:Future, dbname:str, backlog:BoundedSemaphore) -> None:
+    backlog.release()
+
+    exception = future.exception()
+    if exception is not None:  # e.g. pywikibot errors which bot_touch does not expect
+        _quarantine(dbname, f'touch worker failed with {exception!r}')
+
 
 def _touch_pages(df:pd.DataFrame, wiki_client:WikiClient) -> None:
-    for i, elem in enumerate(df.itertuples(), start=1):
-        try:
-            touch_page(
-                wiki_client.dbname,
-                elem.sitelink
-            )
-        except RuntimeWarning:
-            LOG.warn(f'did not touch "{elem.sitelink}" on project' \
-                     f' {wiki_client.dbname}')
-        else:
-            if i%100==0:
-                LOG.info(f'touched "{elem.sitelink}" on project' \
-                         f' {wiki_client.dbname} ({i}/{df.shape[0]})')
+    if is_quarantined(wiki_client.dbname):
+        LOG.info(f'{wiki_client.dbname} is quarantined; {df.shape[0]} pages not touched')
+        return
+
+    executor, backlog = TOUCH_EXECUTOR, TOUCH_BACKLOG
+    if executor is None or backlog is None:
+        _touch_pages_serially(df, wiki_client)
+        return
+
+    backlog.acquire()  # blocks the scans if the touch workers fall behind
+    future = executor.submit(_touch_pages_serially, df, wiki_client)
+    future.add_done_callback(lambda future : _touch_pages_done(future, wiki_client.dbname, backlog))
+
+
+@contextmanager
+def parallel_touch_workers(max_wikis:int) -> Generator[None, None, None]:
+    # touches of up to max_wikis wikis run concurrently in the background, while the next wikis are scanned
+    global TOUCH_EXECUTOR, TOUCH_BACKLOG
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_wikis), thread_name_prefix='touch')
+    TOUCH_EXECUTOR, TOUCH_BACKLOG = executor, BoundedSemaphore(2*max(1, max_wikis))
+    try:
+        yield
+    finally:
+        executor.shutdown(wait=True)
+        TOUCH_EXECUTOR, TOUCH_BACKLOG = None, None
+
+        if REVALIDATION_COUNTS['checked'] > 0:
+            LOG.info(f'Revalidation skipped {REVALIDATION_COUNTS["skipped"]}/{REVALIDATION_COUNTS["checked"]} touch candidates' \
+                     f' ({REVALIDATION_COUNTS["skipped"]/REVALIDATION_COUNTS["checked"]:.1%})')
+
+        quarantined = sorted(QUARANTINED_WIKIS - set(TOUCH_QUARANTINE_WIKIS))
+        if len(quarantined) > 0:
+            LOG.warn(f'Quarantined during this run; consider TOUCH_QUARANTINE_WIKIS: {", ".join(quarantined)}')
 
 
 def touch_different_local_qids(df:pd.DataFrame, wiki_client:WikiClient) -> None:
@@ -0,0 +1,143 @@
+from collections import Counter
+from collections.abc import Generator
+from contextlib import contextmanager
+import logging
+from os import environ, makedirs
+from os.path import basename, join
+import sys
+from threading import Event, Thread, get_ident
+import tracemalloc
+from types import FrameType
+from typing import Optional
+
+from .config import PROFILING, PROFILE_DIR, PROFILE_SAMPLE_INTERVAL, PROFILE_TRACEMALLOC_FRAMES, PROFILE_TOP_ALLOCATIONS
+
+
+# Opt-in profiling of process_project: a sampling profiler which writes collapsed stacks (input
+# for flamegraph.pl or speedscope) and tracemalloc reports of the top allocations per stage, one
+# pair of files per wiki in PROFILE_DIR. Enabled by PROFILING or DELSITELINKS_PROFILING=1.
+
+LOG = logging.getLogger(__name__)
+
+PROFILING_ENV:str = 'DELSITELINKS_PROFILING'
+
+
+def profiling_enabled() -> bool:
+    return PROFILING is True or environ.get(PROFILING_ENV, '') in [ '1', 'true', 'yes' ]
+
+
+class Sampler:
+    def __init__(self, interval:float) -> None:
+        self.interval = interval
+        self.stage = '-'
+        self.stacks:Counter[str] = Counter()
+        self.stop_event = Event()
+        self.thread = Thread(target=self._run, name='profiling-sampler', daemon=True)
+
+    @staticmethod
+    def _collapse(frame:Optional[FrameType]) -> list[str]:
+        labels:list[str] = []
+        while frame is not None:
+            labels.append(f'{frame.f_code.co_name} ({basename(frame.f_code.co_filename)})')
+            frame = frame.f_back
+        labels.reverse()
+
+        return labels
+
+    def _run(self) -> None:
+        own_ident = get_ident()
+        while not self.stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                self.stacks[';'.join([ self.stage, *self._collapse(frame) ])] += 1
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.thread.join()
+
+
+class ProjectProfile:
+    def __init__(self, dbname:str) -> None:
+        self.dbname = dbname
+        self.sampler = Sampler(PROFILE_SAMPLE_INTERVAL)
+        self.allocation_reports:list[str] = []
+        self.started_tracemalloc = False
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            self.started_tracemalloc = True
+        self.sampler.start()
+
+    def stop(self) -> None:
+        self.sampler.stop()
+        if self.started_tracemalloc is True:
+            tracemalloc.stop()
+
+    def add_allocation_report(self, stage:str, before:tracemalloc.Snapshot, after:tracemalloc.Snapshot, peak:int) -> None:
+        lines = [ f'== {self.dbname} / {stage}: peak {peak / 2**20:.1f} MiB traced' ]
+        for stat in after.compare_to(before, 'traceback')[:PROFILE_TOP_ALLOCATIONS]:
+            lines.append(f'{stat.size_diff / 2**20:+.2f} MiB in {stat.count_diff:+d} blocks ({stat.size / 2**20:.2f} MiB now)')
+            lines.extend([ f'    {line}' for line in stat.traceback.format(most_recent_first=True)[:2*PROFILE_TRACEMALLOC_FRAMES] ])
+        self.allocation_reports.append('\n'.join(lines))
+
+    def write(self) -> None:
+        makedirs(PROFILE_DIR, exist_ok=True)
+
+        with open(join(PROFILE_DIR, f'{self.dbname}.collapsed'), mode='w', encoding='utf8') as file_handle:
+            for stack, count in self.sampler.stacks.most_common():
+                file_handle.write(f'{stack} {count}\n')
+
+        with open(join(PROFILE_DIR, f'{self.dbname}.allocations.txt'), mode='w', encoding='utf8') as file_handle:
+            file_handle.write('\n\n'.join(self.allocation_reports))
+            file_handle.write('\n')
+
+        LOG.info(f'wrote profile of {self.dbname} with {sum(self.sampler.stacks.values())} samples to {PROFILE_DIR}')
+
+
+ACTIVE_PROFILE:Optional[ProjectProfile] = None
+
+
+@contextmanager
+def profile_project(dbname:str) -> Generator[None, None, None]:
+    global ACTIVE_PROFILE
+
+    if not profiling_enabled() or ACTIVE_PROFILE is not None:
+        yield
+        return
+
+    profile = ProjectProfile(dbname)
+    ACTIVE_PROFILE = profile
+    profile.start()
+    try:
+        yield
+    finally:
+        profile.stop()
+        ACTIVE_PROFILE = None
+        try:
+            profile.write()
+        except OSError as exception:
+            LOG.warn(f'Cannot write profile of {dbname}: {exception}')
+
+
+@contextmanager
+def profile_stage(stage:str) -> Generator[None, None, None]:
+    profile = ACTIVE_PROFILE
+    if profile is None:
+        yield
+        return
+
+    previous_stage = profile.sampler.stage
+    profile.sampler.stage = stage
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    try:
+        yield
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        profile.sampler.stage = previous_stage  # the snapshot comparison is not part of the stage
+        profile.add_allocation_report(stage, before, tracemalloc.take_snapshot(), peak)
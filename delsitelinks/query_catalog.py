@@ -0,0 +1,412 @@
+from dataclasses import dataclass, field
+import logging
+from typing import Any, Optional
+
+import mariadb
+
+from .config import QUERY_CHUNK_SIZE
+from .database import ToolDB
+
+
+LOG = logging.getLogger(__name__)
+
+CLIENT:str = 'client'  # placeholder database for queries that run against each client wiki
+
+
+@dataclass
+class CatalogQuery:
+    name:str
+    database:str  # CLIENT, 'wikidatawiki' or 'meta'
+    sql:str  # may contain str.format fields for parts which are assembled at runtime
+    sample_format:dict[str, str] = field(default_factory=dict)
+    sample_params:Optional[dict[str, Any]|tuple] = None
+    keyset:Optional[str] = None  # key column if run via Replica.query_mediawiki_keyset
+    full_scan_expected:bool = False
+    auditable:bool = True  # False if the stand-in schema cannot represent the query
+
+    def render(self, **format_args:str) -> str:
+        return self.sql.format(**format_args)
+
+
+WIKI_CLIENTS = CatalogQuery(
+    'wiki_clients',
+    'meta',
+    """SELECT
+        dbname,
+        url
+    FROM
+        wiki
+    WHERE
+        is_closed=0
+        AND has_wikidata=1
+    ORDER BY
+        dbname ASC""",  # https://quarry.wmcloud.org/query/12744
+    full_scan_expected=True  # ~1000 rows
+)
+
+KEY_BOUNDS = CatalogQuery(
+    'key_bounds',
+    CLIENT,
+    """SELECT
+        MIN({key}) AS min_key,
+        MAX({key}) AS max_key
+    FROM
+        {table}""",
+    sample_format={ 'key' : 'page_id', 'table' : 'page' }
+)
+
+PAGE_COUNT_ESTIMATE = CatalogQuery(
+    'page_count_estimate',
+    CLIENT,
+    """SELECT
+        MAX(page_id) AS max_key
+    FROM
+        page"""
+)
+
+PAGE_SCAN = CatalogQuery(
+    'page_scan',
+    CLIENT,
+    """SELECT
+        page_id,
+        page_namespace AS ns_numerical,
+        CONVERT(page_title USING utf8mb4) AS page_title,
+        CONVERT(pp_value USING utf8mb4) AS qid
+    FROM
+        page
+            LEFT JOIN page_props
+                ON page_id=pp_page
+                AND pp_propname='wikibase_item'{where_clause}""",
+    sample_format={ 'where_clause' : """
+    WHERE
+        page_namespace IN (0, 4, 14)
+        AND page_id>%(last_key)s
+        AND page_id<=%(stop_key)s""" },
+    sample_params={ 'last_key' : 0, 'stop_key' : 1000 },
+    keyset='page_id'
+)
+
+PAGES_BY_TITLE = CatalogQuery(
+    'pages_by_title',
+    CLIENT,
+    """SELECT
+                {columns}
+            FROM
+                page{joins}
+            WHERE
+                page_namespace=?
+                AND page_title IN ({placeholders})""",
+    sample_format={
+        'columns' : """page_namespace,
+                CONVERT(page_title USING utf8mb4) AS page_title,
+                page_is_redirect,
+                page_latest,
+                CONVERT(pp_value USING utf8mb4) AS qid""",
+        'joins' : """
+                    LEFT JOIN page_props
+                        ON page_id=pp_page
+                        AND pp_propname='wikibase_item'""",
+        'placeholders' : '?, ?'
+    },
+    sample_params=(4, 'Title_4', 'Title_20')
+)
+
+SITELINK_BOUNDS = CatalogQuery(
+    'sitelink_bounds',
+    'wikidatawiki',
+    """SELECT
+        COUNT(*) AS cnt,
+        MAX(ips_site_page) AS max_key
+    FROM
+        wb_items_per_site
+    WHERE
+        ips_site_id=%(dbname)s""",
+    sample_params={ 'dbname' : 'wiki1' }
+)
+
+SITELINK_BOUNDARY = CatalogQuery(
+    'sitelink_boundary',
+    'wikidatawiki',
+    """SELECT
+            ips_site_page
+        FROM
+            wb_items_per_site
+        WHERE
+            ips_site_id=%(dbname)s
+        ORDER BY
+            ips_site_page
+        LIMIT 1 OFFSET {offset}""",  # index-only read of wb_ips_item_site_page
+    sample_format={ 'offset' : '100' },
+    sample_params={ 'dbname' : 'wiki1' }
+)
+
+SITELINK_SCAN = CatalogQuery(
+    'sitelink_scan',
+    'wikidatawiki',
+    """SELECT
+        ips_site_page,
+        CONVERT(ips_site_page USING utf8mb4) AS sitelink,
+        CONCAT('Q', ips_item_id) AS qid_sitelink
+    FROM
+        wb_items_per_site{where_clause}""",
+    sample_format={ 'where_clause' : """
+    WHERE
+        ips_site_id=%(dbname)s
+        AND ips_site_page>%(last_key)s
+        AND ips_site_page<=%(stop_key)s""" },
+    sample_params={ 'dbname' : 'wiki1', 'last_key' : '', 'stop_key' : 'Title_9999' },
+    keyset='ips_site_page'
+)
+
+SITELINKS_BY_TITLE = CatalogQuery(
+    'sitelinks_by_title',
+    'wikidatawiki',
+    """SELECT
+            CONVERT(ips_site_page USING utf8mb4) AS sitelink,
+            CONCAT('Q', ips_item_id) AS qid_sitelink
+        FROM
+            wb_items_per_site
+        WHERE
+            ips_site_id=?
+            AND ips_site_page IN ({placeholders})""",
+    sample_format={ 'placeholders' : '?, ?' },
+    sample_params=('wiki1', 'Title_51', 'Title_101')
+)
+
+SITELINK_EXPORT_SCAN = CatalogQuery(
+    'sitelink_export_scan',
+    'wikidatawiki',
+    """SELECT
+        ips_row_id,
+        ips_site_id,
+        CONVERT(ips_site_page USING utf8mb4) AS sitelink,
+        CONCAT('Q', ips_item_id) AS qid_sitelink
+    FROM
+        wb_items_per_site
+    WHERE
+        ips_row_id>%(last_key)s
+        AND ips_row_id<=%(stop_key)s""",
+    sample_params={ 'last_key' : 0, 'stop_key' : 1000 },
+    keyset='ips_row_id'
+)
+
+REPLICATION_LAG = CatalogQuery(
+    'replication_lag',
+    CLIENT,
+    """SELECT
+        MAX(lag) AS lag
+    FROM
+        heartbeat_p.heartbeat""",
+    auditable=False  # separate database; a handful of rows
+)
+
+LOG_EVENTS = CatalogQuery(
+    'log_events',
+    CLIENT,
+    """SELECT
+                log_id,
+                log_timestamp,
+                actor_name,
+                log_params
+            FROM
+                logging_logindex
+                    JOIN actor_logging ON log_actor=actor_id
+            WHERE
+                log_namespace=%(lognamespace)s
+                AND log_title=%(logtitle)s
+                AND log_type=%(logtype)s
+                AND log_action=%(logaction)s""",  # log_page_time index of the page-based view
+    sample_params={ 'lognamespace' : 1, 'logtitle' : 'Title_1', 'logtype' : 'delete', 'logaction' : 'delete' }
+)
+
+USER_BLOCKLOG = CatalogQuery(
+    'user_blocklog',
+    'wikidatawiki',
+    """SELECT
+            log_id,
+            log_timestamp,
+            log_params
+        FROM
+            logging_logindex
+        WHERE
+            log_namespace=2
+            AND log_title=%(username)s
+            AND log_type='block'
+            AND log_action='block'""",
+    sample_params={ 'username' : 'Title_2' }
+)
+
+USER_BY_NAME = CatalogQuery(
+    'user_by_name',
+    'wikidatawiki',
+    """SELECT
+            user_id,
+            user_name,
+            user_registration,
+            user_editcount
+        FROM
+            user
+        WHERE
+            user_name=%(username)s""",
+    sample_params={ 'username' : 'User_1' }
+)
+
+CATALOG:list[CatalogQuery] = [
+    WIKI_CLIENTS,
+    KEY_BOUNDS,
+    PAGE_COUNT_ESTIMATE,
+    PAGE_SCAN,
+    PAGES_BY_TITLE,
+    SITELINK_BOUNDS,
+    SITELINK_BOUNDARY,
+    SITELINK_SCAN,
+    SITELINKS_BY_TITLE,
+    SITELINK_EXPORT_SCAN,
+    REPLICATION_LAG,
+    LOG_EVENTS,
+    USER_BLOCKLOG,
+    USER_BY_NAME,
+]
+
+
+# local stand-in for the replica views, with the indexes of the MediaWiki/Wikibase schema; the rows
+# only serve to keep the optimizer from preferring table scans on trivially small tables
+STANDIN_SCHEMA:list[str] = [
+    """CREATE TEMPORARY TABLE page (
+        page_id INT UNSIGNED NOT NULL AUTO_INCREMENT,
+        page_namespace INT NOT NULL,
+        page_title VARBINARY(255) NOT NULL,
+        page_is_redirect TINYINT UNSIGNED NOT NULL DEFAULT 0,
+        page_latest INT UNSIGNED NOT NULL DEFAULT 0,
+        PRIMARY KEY (page_id),
+        UNIQUE KEY name_title (page_namespace, page_title)
+    )""",
+    """CREATE TEMPORARY TABLE page_props (
+        pp_page INT UNSIGNED NOT NULL,
+        pp_propname VARBINARY(60) NOT NULL,
+        pp_value BLOB NOT NULL,
+        PRIMARY KEY (pp_page, pp_propname),
+        UNIQUE KEY pp_propname_page (pp_propname, pp_page)
+    )""",
+    """CREATE TEMPORARY TABLE logging_logindex (
+        log_id INT UNSIGNED NOT NULL AUTO_INCREMENT,
+        log_type VARBINARY(32) NOT NULL,
+        log_action VARBINARY(32) NOT NULL,
+        log_timestamp BINARY(14) NOT NULL,
+        log_actor BIGINT UNSIGNED NOT NULL,
+        log_namespace INT NOT NULL,
+        log_title VARBINARY(255) NOT NULL,
+        log_page INT UNSIGNED,
+        log_params BLOB NOT NULL,
+        PRIMARY KEY (log_id),
+        KEY log_type_time (log_type, log_timestamp),
+        KEY log_actor_time (log_actor, log_timestamp),
+        KEY log_page_time (log_namespace, log_title, log_timestamp),
+        KEY log_times (log_timestamp),
+        KEY log_page_id_time (log_page, log_timestamp),
+        KEY log_type_action (log_type, log_action, log_timestamp)
+    )""",
+    """CREATE TEMPORARY TABLE actor_logging (
+        actor_id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+        actor_name VARBINARY(255) NOT NULL,
+        PRIMARY KEY (actor_id),
+        UNIQUE KEY actor_name (actor_name)
+    )""",
+    """CREATE TEMPORARY TABLE user (
+        user_id INT UNSIGNED NOT NULL AUTO_INCREMENT,
+        user_name VARBINARY(255) NOT NULL,
+        user_registration BINARY(14),
+        user_editcount INT,
+        PRIMARY KEY (user_id),
+        UNIQUE KEY user_name (user_name)
+    )""",
+    """CREATE TEMPORARY TABLE wb_items_per_site (
+        ips_row_id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+        ips_item_id INT UNSIGNED NOT NULL,
+        ips_site_id VARBINARY(32) NOT NULL,
+        ips_site_page VARBINARY(310) NOT NULL,
+        PRIMARY KEY (ips_row_id),
+        UNIQUE KEY wb_ips_item_site_page (ips_site_id, ips_site_page),
+        KEY wb_ips_item_id (ips_item_id)
+    )""",
+    """CREATE TEMPORARY TABLE wiki (
+        dbname VARBINARY(32) NOT NULL,
+        url VARBINARY(255),
+        is_closed TINYINT NOT NULL DEFAULT 0,
+        has_wikidata TINYINT NOT NULL DEFAULT 1,
+        PRIMARY KEY (dbname)
+    )""",
+]
+
+STANDIN_ROWS:list[str] = [  # uses the Sequence storage engine of MariaDB
+    """INSERT INTO page (page_namespace, page_title, page_latest)
+        SELECT seq % 16, CONCAT('Title_', seq), seq FROM seq_1_to_20000""",
+    """INSERT INTO page_props (pp_page, pp_propname, pp_value)
+        SELECT seq, 'wikibase_item', CONCAT('Q', seq) FROM seq_1_to_20000""",
+    """INSERT INTO logging_logindex (log_type, log_action, log_timestamp, log_actor, log_namespace, log_title, log_page, log_params)
+        SELECT IF(seq % 2, 'delete', 'move'), IF(seq % 2, 'delete', 'move'), '20200101000000', seq % 500 + 1, seq % 16, CONCAT('Title_', seq), seq, '' FROM seq_1_to_20000""",
+    """INSERT INTO actor_logging (actor_name)
+        SELECT CONCAT('User_', seq) FROM seq_1_to_500""",
+    """INSERT INTO user (user_name, user_registration, user_editcount)
+        SELECT CONCAT('User_', seq), '20200101000000', seq FROM seq_1_to_500""",
+    """INSERT INTO wb_items_per_site (ips_item_id, ips_site_id, ips_site_page)
+        SELECT seq, CONCAT('wiki', seq % 50), CONCAT('Title_', seq) FROM seq_1_to_20000""",
+    """INSERT INTO wiki (dbname, url)
+        SELECT CONCAT('wiki', seq), CONCAT('https://wiki', seq, '.example.org') FROM seq_1_to_100""",
+]
+
+SCAN_ACCESS_TYPES:list[str] = [ 'ALL', 'index' ]  # full table scan, full index scan
+
+
+def _render_sample(catalog_query:CatalogQuery) -> str:
+    query = catalog_query.render(**catalog_query.sample_format)
+    if catalog_query.keyset is not None:  # as appended by Replica.query_mediawiki_keyset
+        query = f'{query}\n    ORDER BY {catalog_query.keyset}\n    LIMIT {int(QUERY_CHUNK_SIZE)}'
+
+    return query
+
+
+def audit_query_plans() -> dict[str, list[str]]:
+    # EXPLAINs every catalog query against the stand-in schema; returns the tables which are read
+    # by a full table or index scan, per query, unless this is expected for the query
+    findings:dict[str, list[str]] = {}
+
+    with ToolDB() as (_, db_cursor):
+        for statement in STANDIN_SCHEMA:
+            db_cursor.execute(statement)
+        try:
+            for statement in STANDIN_ROWS:
+                db_cursor.execute(statement)
+        except mariadb.Error as exception:
+            LOG.warn(f'Cannot fill stand-in schema, plans are based on empty tables: {exception}')
+
+        for catalog_query in CATALOG:
+            if catalog_query.auditable is not True:
+                continue
+
+            query = f'EXPLAIN {_render_sample(catalog_query)}'
+            try:
+                if catalog_query.sample_params is None:
+                    db_cursor.execute(query)
+                else:
+                    db_cursor.execute(query, catalog_query.sample_params)
+                plan = db_cursor.fetchall()
+            except mariadb.Error as exception:
+                LOG.warn(f'Cannot explain query {catalog_query.name}: {exception}')
+                findings[catalog_query.name] = [ 'EXPLAIN failed' ]
+                continue
+
+            scanned_tables = [ str(row.get('table')) for row in plan if row.get('type') in SCAN_ACCESS_TYPES ]
+            if len(scanned_tables) == 0:
+                access = [ f'{row.get("table")}/{row.get("type")}/{row.get("key")}' for row in plan ]
+                LOG.info(f'Query {catalog_query.name}: {", ".join(access)}')
+                continue
+
+            if catalog_query.full_scan_expected is True:
+                LOG.info(f'Query {catalog_query.name}: expected full scan of {", ".join(scanned_tables)}')
+                continue
+
+            LOG.warn(f'Query {catalog_query.name}: unexpected full scan of {", ".join(scanned_tables)}')
+            findings[catalog_query.name] = scanned_tables
+
+    return findings
@@ -1,75 +1,540 @@
+from collections.abc import Callable, Generator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
+from os import listdir, makedirs
+from os.path import exists, getmtime, join
+from shutil import rmtree
+from time import time
+from typing import Any, Optional
+
 import pandas as pd
 
-from .database import Replica, ToolDB
-from .types import WikiClient
+from .config import QUERY_KEYSET_PAGINATION, QUERY_PARALLELISM, QUERY_PARALLELISM_DEFAULT, \
+    SITELINK_EXPORT, SITELINK_EXPORT_DIR, SITELINK_EXPORT_PARALLELISM, SITELINK_EXPORT_MAX_AGE, \
+    PAGE_LOOKUP_MODE, PAGE_LOOKUP_COST_FACTOR, PAGE_LOOKUP_BATCH_SIZE, PAGE_SCAN_EXCLUDED_NAMESPACES, \
+    REPLICA_VERIFICATION, MAX_REPLICATION_LAG, REPLICATION_LAG_CACHE_TTL
+from .database import Replica, ToolDB, get_staging_suffix
+from .query_catalog import KEY_BOUNDS, PAGE_COUNT_ESTIMATE, PAGE_SCAN, PAGES_BY_TITLE, SITELINK_BOUNDS, SITELINK_BOUNDARY, \
+    SITELINK_SCAN, SITELINKS_BY_TITLE, SITELINK_EXPORT_SCAN, REPLICATION_LAG
+from .query_tooldb import query_sitelink_prefixes, query_sitelink_count, query_sitelink_titles
+from .types import Namespace, PageStatus, WikiClient
+from .work_queue import get_run_id
 
 
 TOOLDB_TMP_PAGES_FILE:str = './tmp_tooldb_pages.tsv'
 TOOLDB_TMP_SITELINKS_FILE:str = './tmp_tooldb_sitelinks.tsv'
+SITELINK_EXPORT_COMPLETE_FILE:str = '_complete'
+REPLICATION_LAGS:dict[str, tuple[float, Optional[float]]] = {}  # dbname: (checked at, lag in seconds)
+LOOKED_UP_NAMESPACES:dict[str, set[int]] = {}  # dbname: namespaces whose staged pages are only those with sitelinks
 LOG = logging.getLogger(__name__)
 
 
-def query_pages(wiki_client:WikiClient) -> None:
-    query_constraints = {
-        'wikidatawiki' : ' WHERE page_namespace!=0',
-        'commonswiki' : ' WHERE page_namespace!=6'
-    }
-
-    query = f"""SELECT
-        page_namespace AS ns_numerical,
-        CONVERT(page_title USING utf8mb4) AS page_title,
-        CONVERT(pp_value USING utf8mb4) AS qid
-    FROM
-        page
-            LEFT JOIN page_props
-                ON page_id=pp_page
-                AND pp_propname='wikibase_item'{query_constraints.get(wiki_client.dbname, '')}"""
-
-    ToolDB.clear_table('pages')
-
-    for chunk in Replica.query_mediawiki_chunked(wiki_client.dbname, query):
-        df = pd.DataFrame(data=chunk)
-        
-        df['page_title'] = df['page_title'].str.replace('_', ' ')
-        df['ns_lexical_with_colon'] = ''
-        for ns in df['ns_numerical'].unique():
-            if ns == 0:
+def _make_where_clause(conditions:list[str]) -> str:
+    if len(conditions) == 0:
+        return ''
+
+    return '\n    WHERE\n        ' + '\n        AND '.join(conditions)
+
+
+def _tmp_file(filename:str, partition:int) -> str:
+    return filename.replace('.tsv', f'{get_staging_suffix()}_{partition}.tsv')
+
+
+def _get_parallelism(dbname:str) -> int:
+    return max(1, QUERY_PARALLELISM.get(dbname, QUERY_PARALLELISM_DEFAULT))
+
+
+def _query_integer_key_ranges(dbname:str, table:str, key:str, parallelism:int) -> list[tuple[int, int]]:
+    result = Replica.query_mediawiki(dbname, KEY_BOUNDS.render(key=key, table=table))
+
+    if len(result) == 0 or result[0]['min_key'] is None:
+        return []
+
+    min_key = result[0]['min_key'] - 1  # lower bounds are exclusive
+    max_key = result[0]['max_key']
+    step = max(1, -(-(max_key - min_key) // parallelism))
+
+    return [ (start, min(start+step, max_key)) for start in range(min_key, max_key, step) ]
+
+
+def _query_site_page_ranges(dbname:str, parallelism:int) -> list[tuple[Any, Any]]:
+    params = { 'dbname' : dbname }
+    result = Replica.query_mediawiki('wikidatawiki', SITELINK_BOUNDS.render(), params=params)
+
+    if len(result) == 0 or result[0]['cnt'] == 0:
+        return []
+
+    count = result[0]['cnt']
+    boundaries:list[Any] = [ '' ]  # lower bounds are exclusive; all titles are larger than the empty string
+    for i in range(1, parallelism):
+        offset = (count * i) // parallelism
+        if offset <= 0:
+            continue
+
+        # index-only read of wb_ips_item_site_page; cheap compared to the scan itself
+        query_boundary = SITELINK_BOUNDARY.render(offset=str(int(offset)))
+        result_boundary = Replica.query_mediawiki('wikidatawiki', query_boundary, params=params)
+        if len(result_boundary) == 0:
+            continue
+        boundaries.append(result_boundary[0]['ips_site_page'])
+
+    boundaries.append(result[0]['max_key'])
+
+    return [ (start, stop) for start, stop in zip(boundaries[:-1], boundaries[1:]) if start != stop ]
+
+
+def _scan_key_ranges(dbname:str, query:str, key:str, key_ranges:list[tuple[Any, Any]], handle_chunk:Callable[[list[dict[str, Any]], int], None], params:Optional[dict[str, Any]]=None) -> None:
+    def scan_key_range(partition:int, start_key:Any, stop_key:Any) -> None:
+        range_params = { **(params or {}), 'stop_key' : stop_key }
+        for chunk in Replica.query_mediawiki_keyset(dbname, query, key, params=range_params, start_key=start_key):
+            handle_chunk(chunk, partition)
+        LOG.debug(f'finished scan of {key} range {partition} at {dbname}')
+
+    if len(key_ranges) == 0:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(key_ranges)) as executor:
+        futures = [
+            executor.submit(scan_key_range, partition, start_key, stop_key) for partition, (start_key, stop_key) in enumerate(key_ranges)
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+
+def _insert_pages_chunk(chunk:list[dict[str, Any]], wiki_client:WikiClient, partition:int=0) -> None:
+    df = pd.DataFrame(data=chunk)
+
+    df['page_title'] = df['page_title'].str.replace('_', ' ')
+    df['ns_lexical_with_colon'] = ''
+    for ns in df['ns_numerical'].unique():
+        if ns == 0:
+            continue
+        df.loc[df['ns_numerical']==ns, 'ns_lexical_with_colon'] = f'{wiki_client.get_namespace_by_id(ns)}:'
+    df['full_page_title'] = df['ns_lexical_with_colon'] + df['page_title']
+    df.drop(columns=['page_title', 'ns_lexical_with_colon'], inplace=True)
+
+    filename = _tmp_file(TOOLDB_TMP_PAGES_FILE, partition)
+    df.to_csv(
+        filename,
+        sep='\t',
+        header=False,
+        columns=['ns_numerical', 'full_page_title', 'qid']
+    )
+
+    ToolDB.insert_batch('pages', filename)
+
+
+def _insert_sitelinks_chunk(chunk:list[dict[str, Any]], partition:int=0) -> None:
+    df = pd.DataFrame(data=chunk)
+
+    filename = _tmp_file(TOOLDB_TMP_SITELINKS_FILE, partition)
+    df.to_csv(
+        filename,
+        sep='\t',
+        header=False,
+        columns=['sitelink', 'qid_sitelink']
+    )
+
+    ToolDB.insert_batch('sitelinks', filename)
+
+
+def _query_sitelink_namespaces(wiki_client:WikiClient) -> list[int]:
+    # requires the sitelinks table to be filled already
+    prefixes, has_unprefixed = query_sitelink_prefixes()
+    prefix_to_namespace = wiki_client.get_namespace_prefixes()
+
+    namespaces:set[int] = set()
+    if has_unprefixed is True:
+        namespaces.add(0)
+    for prefix in prefixes:
+        namespace = prefix_to_namespace.get(prefix)
+        if namespace is None:  # colon in title, but no namespace prefix
+            namespaces.add(0)
+        elif namespace.ns >= 0:  # virtual namespaces have no pages
+            namespaces.add(namespace.ns)
+
+    return sorted(namespaces)
+
+
+def _query_page_count_estimate(dbname:str) -> int:
+    result = Replica.query_mediawiki(dbname, PAGE_COUNT_ESTIMATE.render())
+
+    if len(result) == 0 or result[0]['max_key'] is None:
+        return 0
+
+    return result[0]['max_key']
+
+
+def _use_page_lookups(wiki_client:WikiClient) -> bool:
+    if PAGE_LOOKUP_MODE is not True:
+        return False
+
+    sitelink_count = query_sitelink_count()
+    page_count = _query_page_count_estimate(wiki_client.dbname)
+
+    use_page_lookups = sitelink_count * PAGE_LOOKUP_COST_FACTOR < page_count
+    LOG.info(f'{wiki_client.dbname}: {sitelink_count} sitelinks, ~{page_count} pages; using' \
+             f' {"point lookups" if use_page_lookups else "full page scan"}')
+
+    return use_page_lookups
+
+
+def _split_sitelink(sitelink:str, prefix_to_namespace:dict[str, Namespace]) -> tuple[int, str]:
+    if ':' in sitelink:
+        prefix, title = sitelink.split(':', 1)
+        namespace = prefix_to_namespace.get(prefix)
+        if namespace is not None:
+            return namespace.ns, title.replace(' ', '_')
+
+    return 0, sitelink.replace(' ', '_')
+
+
+def _group_titles_by_namespace(wiki_client:WikiClient, page_titles:list[str]) -> tuple[dict[int, list[str]], dict[tuple[int, str], str]]:
+    prefix_to_namespace = wiki_client.get_namespace_prefixes()
+
+    page_titles_by_key:dict[tuple[int, str], str] = {}
+    titles_by_namespace:dict[int, list[str]] = {}
+    for page_title in page_titles:
+        ns, title = _split_sitelink(page_title, prefix_to_namespace)
+        if ns < 0:  # virtual namespaces have no pages
+            continue
+        if (ns, title) in page_titles_by_key:
+            continue
+        page_titles_by_key[(ns, title)] = page_title
+        titles_by_namespace.setdefault(ns, []).append(title)
+
+    return titles_by_namespace, page_titles_by_key
+
+
+def _query_pages_by_title(dbname:str, titles_by_namespace:dict[int, list[str]], columns:str, joins:str='') -> Generator[list[dict[str, Any]], None, None]:
+    # one namespace per query, so that each batch is a range read on the name_title index
+    for ns, titles in titles_by_namespace.items():
+        for i in range(0, len(titles), PAGE_LOOKUP_BATCH_SIZE):
+            batch = titles[i:i+PAGE_LOOKUP_BATCH_SIZE]
+            query = PAGES_BY_TITLE.render(columns=columns, joins=joins, placeholders=', '.join(['?' for _ in batch]))
+
+            result = Replica.query_mediawiki(dbname, query, params_tuple=(ns, *batch))
+            if len(result) == 0:
                 continue
-            df.loc[df['ns_numerical']==ns, 'ns_lexical_with_colon'] = f'{wiki_client.get_namespace_by_id(ns)}:'
-        df['full_page_title'] = df['ns_lexical_with_colon'] + df['page_title']
-        df.drop(columns=['page_title', 'ns_lexical_with_colon'], inplace=True)
-        
-        df.to_csv(
-            TOOLDB_TMP_PAGES_FILE,
+
+            yield result
+
+
+def query_item_revisions(qids:list[str]) -> dict[str, int]:
+    columns = """CONVERT(page_title USING utf8mb4) AS page_title,
+                page_latest"""
+
+    revisions:dict[str, int] = {}
+    for result in _query_pages_by_title('wikidatawiki', { 0 : qids }, columns):
+        for row in result:
+            revisions[row['page_title']] = row['page_latest']
+
+    return revisions
+
+
+def query_page_revisions(wiki_client:WikiClient, page_titles:list[str]) -> dict[str, int]:
+    titles_by_namespace, page_titles_by_key = _group_titles_by_namespace(wiki_client, page_titles)
+    columns = """page_namespace,
+                CONVERT(page_title USING utf8mb4) AS page_title,
+                page_latest"""
+
+    revisions:dict[str, int] = {}
+    for result in _query_pages_by_title(wiki_client.dbname, titles_by_namespace, columns):
+        for row in result:
+            page_title = page_titles_by_key.get((row['page_namespace'], row['page_title']))
+            if page_title is not None:
+                revisions[page_title] = row['page_latest']
+
+    return revisions
+
+
+def query_replication_lag(dbname:str) -> Optional[float]:
+    cached = REPLICATION_LAGS.get(dbname)
+    if cached is not None and time() - cached[0] < REPLICATION_LAG_CACHE_TTL:
+        return cached[1]
+
+    try:
+        result = Replica.query_mediawiki(dbname, REPLICATION_LAG.render())
+    except RuntimeError:
+        return None
+
+    lag = None
+    if len(result) > 0 and result[0]['lag'] is not None:
+        lag = float(result[0]['lag'])
+    REPLICATION_LAGS[dbname] = (time(), lag)
+
+    return lag
+
+
+def query_sitelink_items(dbname:str, page_titles:list[str]) -> Optional[dict[str, str]]:
+    # current item of each sitelink; titles without sitelink are missing in the result; None if
+    # wikidatawiki lags behind
+    lag = query_replication_lag('wikidatawiki')
+    if lag is None or lag > MAX_REPLICATION_LAG:
+        LOG.info(f'Replication lag of wikidatawiki is {lag}; cannot query current sitelinks')
+        return None
+
+    sitelink_items:dict[str, str] = {}
+    for i in range(0, len(page_titles), PAGE_LOOKUP_BATCH_SIZE):
+        batch = page_titles[i:i+PAGE_LOOKUP_BATCH_SIZE]
+        query = SITELINKS_BY_TITLE.render(placeholders=', '.join(['?' for _ in batch]))
+
+        for row in Replica.query_mediawiki('wikidatawiki', query, params_tuple=(dbname, *batch)):
+            sitelink_items[row['sitelink']] = row['qid_sitelink']
+
+    return sitelink_items
+
+
+def _is_unambiguous_title(page_title:str, wiki_client:WikiClient, prefix_to_namespace:dict[str, Namespace]) -> bool:
+    # titles which the API would normalize, or whose prefix might be an interwiki prefix, are left to the API
+    if '_' in page_title or page_title != page_title.strip() or len(page_title) == 0:
+        return False
+
+    ns, title = 0, page_title
+    if ':' in page_title:
+        prefix, title = page_title.split(':', 1)
+        namespace = prefix_to_namespace.get(prefix)
+        if namespace is None:
+            return False
+        ns = namespace.ns
+
+    if ns < 0 or len(title) == 0:
+        return False
+
+    if wiki_client.get_namespace_case_by_id(ns) == 'first-letter' and title[:1] != title[:1].upper():
+        return False
+
+    return True
+
+
+def query_page_status(wiki_client:WikiClient, page_titles:list[str]) -> dict[str, PageStatus]:
+    # titles missing in the result need to be verified via the API
+    if REPLICA_VERIFICATION is not True:
+        return {}
+
+    lag = query_replication_lag(wiki_client.dbname)
+    if lag is None or lag > MAX_REPLICATION_LAG:
+        LOG.info(f'Replication lag of {wiki_client.dbname} is {lag}; verify via API')
+        return {}
+
+    prefix_to_namespace = wiki_client.get_namespace_prefixes()
+    unambiguous_titles = [ page_title for page_title in page_titles if _is_unambiguous_title(page_title, wiki_client, prefix_to_namespace) ]
+    titles_by_namespace, page_titles_by_key = _group_titles_by_namespace(wiki_client, unambiguous_titles)
+    columns = """page_namespace,
+                CONVERT(page_title USING utf8mb4) AS page_title,
+                page_is_redirect,
+                page_latest,
+                CONVERT(pp_value USING utf8mb4) AS qid"""
+    joins = """
+                    LEFT JOIN page_props
+                        ON page_id=pp_page
+                        AND pp_propname='wikibase_item'"""
+
+    page_statuses = { page_title : PageStatus(False, False, None) for page_title in page_titles_by_key.values() }
+    for result in _query_pages_by_title(wiki_client.dbname, titles_by_namespace, columns, joins):
+        for row in result:
+            page_title = page_titles_by_key.get((row['page_namespace'], row['page_title']))
+            if page_title is not None:
+                page_statuses[page_title] = PageStatus(True, bool(row['page_is_redirect']), row['qid'], row['page_latest'])
+
+    return page_statuses
+
+
+def get_looked_up_namespaces(dbname:str) -> set[int]:
+    # other pages of these namespaces, e.g. case variants of sitelink titles, are not staged
+    return LOOKED_UP_NAMESPACES.get(dbname, set())
+
+
+def query_existing_pages(wiki_client:WikiClient, page_titles:list[str]) -> set[str]:
+    titles_by_namespace, page_titles_by_key = _group_titles_by_namespace(wiki_client, page_titles)
+    columns = """page_namespace,
+                CONVERT(page_title USING utf8mb4) AS page_title"""
+
+    existing_titles:set[str] = set()
+    for result in _query_pages_by_title(wiki_client.dbname, titles_by_namespace, columns):
+        for row in result:
+            page_title = page_titles_by_key.get((row['page_namespace'], row['page_title']))
+            if page_title is not None:
+                existing_titles.add(page_title)
+
+    return existing_titles
+
+
+def _lookup_pages(wiki_client:WikiClient, namespaces:Optional[list[int]]=None) -> None:
+    # all sitelinks, or only those into the given namespaces
+    if namespaces is None:
+        page_titles = query_sitelink_titles()
+    else:
+        prefixes = [ prefix for prefix, namespace in wiki_client.get_namespace_prefixes().items() if namespace.ns in namespaces ]
+        page_titles = query_sitelink_titles(prefixes=prefixes, unprefixed=(0 in namespaces))
+
+    titles_by_namespace, _ = _group_titles_by_namespace(wiki_client, page_titles)
+    if namespaces is not None:
+        titles_by_namespace = { ns : titles for ns, titles in titles_by_namespace.items() if ns in namespaces }
+    columns = """page_namespace AS ns_numerical,
+                CONVERT(page_title USING utf8mb4) AS page_title,
+                CONVERT(pp_value USING utf8mb4) AS qid"""
+    joins = """
+                    LEFT JOIN page_props
+                        ON page_id=pp_page
+                        AND pp_propname='wikibase_item'"""
+
+    for result in _query_pages_by_title(wiki_client.dbname, titles_by_namespace, columns, joins):
+        _insert_pages_chunk(result, wiki_client)
+
+
+def query_pages(wiki_client:WikiClient) -> None:
+    namespaces = _query_sitelink_namespaces(wiki_client)
+    LOG.info(f'Namespaces with sitelinks in {wiki_client.dbname}: {namespaces}')
+
+    ToolDB.prepare_staging_table('pages')
+    LOOKED_UP_NAMESPACES.pop(wiki_client.dbname, None)
+
+    if len(namespaces) == 0:
+        return
+
+    if _use_page_lookups(wiki_client):
+        LOOKED_UP_NAMESPACES[wiki_client.dbname] = set(namespaces)
+        _lookup_pages(wiki_client)
+        return
+
+    excluded_namespaces = [ ns for ns in namespaces if ns in PAGE_SCAN_EXCLUDED_NAMESPACES.get(wiki_client.dbname, []) ]
+    if len(excluded_namespaces) > 0:
+        LOG.info(f'Looking up sitelinks into namespaces {excluded_namespaces} of {wiki_client.dbname} instead of scanning them')
+        LOOKED_UP_NAMESPACES[wiki_client.dbname] = set(excluded_namespaces)
+        _lookup_pages(wiki_client, excluded_namespaces)
+        namespaces = [ ns for ns in namespaces if ns not in excluded_namespaces ]
+        if len(namespaces) == 0:
+            return
+
+    conditions = [ f'page_namespace IN ({", ".join([ str(ns) for ns in namespaces ])})' ]
+    if QUERY_KEYSET_PAGINATION is True:
+        conditions.append('page_id>%(last_key)s')
+        conditions.append('page_id<=%(stop_key)s')
+
+    query = PAGE_SCAN.render(where_clause=_make_where_clause(conditions))
+
+    if QUERY_KEYSET_PAGINATION is not True:
+        for chunk in Replica.query_mediawiki_chunked(wiki_client.dbname, query):
+            _insert_pages_chunk(chunk, wiki_client)
+        return
+
+    key_ranges = _query_integer_key_ranges(wiki_client.dbname, 'page', 'page_id', _get_parallelism(wiki_client.dbname))
+    LOG.debug(f'scanning page table of {wiki_client.dbname} in {len(key_ranges)} page_id range(s)')
+    _scan_key_ranges(
+        wiki_client.dbname,
+        query,
+        'page_id',
+        key_ranges,
+        lambda chunk, partition : _insert_pages_chunk(chunk, wiki_client, partition)
+    )
+
+
+def _export_sitelinks_chunk(chunk:list[dict[str, Any]], partition:int=0) -> None:
+    df = pd.DataFrame(data=chunk)
+
+    partition_dir = join(SITELINK_EXPORT_DIR, str(partition))
+    for site_id, df_site in df.groupby('ips_site_id', sort=False):
+        if isinstance(site_id, (bytes, bytearray)):
+            site_id = site_id.decode('utf8')
+
+        df_site.to_csv(
+            join(partition_dir, f'{site_id}.tsv'),
             sep='\t',
             header=False,
-            columns=['ns_numerical', 'full_page_title', 'qid']
+            columns=['sitelink', 'qid_sitelink'],
+            mode='a'
         )
 
-        ToolDB.insert_batch('pages', TOOLDB_TMP_PAGES_FILE)
 
+def clear_sitelink_export() -> None:
+    if exists(SITELINK_EXPORT_DIR):
+        rmtree(SITELINK_EXPORT_DIR)
+    LOG.info('sitelink export was cleared')
 
-def query_sitelinks(wiki_client:WikiClient) -> None:
-    params = { 'dbname' : wiki_client.dbname }
-    query = f"""SELECT
-        CONVERT(ips_site_page USING utf8mb4) AS sitelink,
-        CONCAT('Q', ips_item_id) AS qid_sitelink
-    FROM
-        wb_items_per_site
-    WHERE
-        ips_site_id=%(dbname)s"""
 
-    ToolDB.clear_table('sitelinks')
+def export_sitelinks() -> None:
+    # one pass over wb_items_per_site for the whole run, partitioned into one file per site (and
+    # scan range); query_sitelinks then loads a wiki's files instead of querying wikidatawiki again
+    clear_sitelink_export()
 
-    for chunk in Replica.query_mediawiki_chunked('wikidatawiki', query, params=params):
-        df = pd.DataFrame(data=chunk)
+    key_ranges = _query_integer_key_ranges('wikidatawiki', 'wb_items_per_site', 'ips_row_id', max(1, SITELINK_EXPORT_PARALLELISM))
+    for partition in range(len(key_ranges)):
+        makedirs(join(SITELINK_EXPORT_DIR, str(partition)))
 
-        df.to_csv(
-            TOOLDB_TMP_SITELINKS_FILE,
-            sep='\t',
-            header=False,
-            columns=['sitelink', 'qid_sitelink']
+    try:
+        _scan_key_ranges(
+            'wikidatawiki',
+            SITELINK_EXPORT_SCAN.render(),
+            'ips_row_id',
+            key_ranges,
+            _export_sitelinks_chunk
         )
+    except BaseException:  # a partial export must never be used
+        clear_sitelink_export()
+        raise
+
+    # the marker names the run, so that other runs (and worker pods) scan the replica instead
+    with open(join(SITELINK_EXPORT_DIR, SITELINK_EXPORT_COMPLETE_FILE), mode='w', encoding='utf8') as file_handle:
+        file_handle.write(get_run_id())
+    LOG.info(f'exported wb_items_per_site in {len(key_ranges)} range(s) to {SITELINK_EXPORT_DIR}')
+
+
+def _sitelink_export_is_available() -> bool:
+    if SITELINK_EXPORT is not True:
+        return False
+
+    complete_file = join(SITELINK_EXPORT_DIR, SITELINK_EXPORT_COMPLETE_FILE)
+    if not exists(complete_file):
+        return False
+
+    if time() - getmtime(complete_file) >= SITELINK_EXPORT_MAX_AGE:
+        return False
+
+    with open(complete_file, mode='r', encoding='utf8') as file_handle:
+        return file_handle.read().strip() == get_run_id()
+
+
+def _load_exported_sitelinks(wiki_client:WikiClient) -> None:
+    for partition in sorted(listdir(SITELINK_EXPORT_DIR)):
+        filename = join(SITELINK_EXPORT_DIR, partition, f'{wiki_client.dbname}.tsv')
+        if not exists(filename):
+            continue
+
+        ToolDB.insert_batch('sitelinks', filename, keep_file=True)  # the export stays complete until it is cleared
+
+
+def query_sitelinks(wiki_client:WikiClient, use_export:bool=True) -> None:
+    # use_export=False always scans the replica and leaves the run-wide export alone
+    if use_export is True and _sitelink_export_is_available():
+        ToolDB.prepare_staging_table('sitelinks')
+        _load_exported_sitelinks(wiki_client)
+        return
+
+    # keyset on ips_site_page rather than ips_row_id: together with ips_site_id it forms the unique
+    # index wb_ips_item_site_page, so each chunk is a range read within this site's index entries
+    conditions = [ 'ips_site_id=%(dbname)s' ]
+    if QUERY_KEYSET_PAGINATION is True:
+        conditions.append('ips_site_page>%(last_key)s')
+        conditions.append('ips_site_page<=%(stop_key)s')
+
+    params = { 'dbname' : wiki_client.dbname }
+    query = SITELINK_SCAN.render(where_clause=_make_where_clause(conditions))
+
+    ToolDB.prepare_staging_table('sitelinks')
+
+    if QUERY_KEYSET_PAGINATION is not True:
+        for chunk in Replica.query_mediawiki_chunked('wikidatawiki', query, params=params):
+            _insert_sitelinks_chunk(chunk)
+        return
 
-        ToolDB.insert_batch('sitelinks', TOOLDB_TMP_SITELINKS_FILE)
+    key_ranges = _query_site_page_ranges(wiki_client.dbname, _get_parallelism(wiki_client.dbname))
+    LOG.debug(f'scanning sitelinks of {wiki_client.dbname} in {len(key_ranges)} ips_site_page range(s)')
+    _scan_key_ranges(
+        'wikidatawiki',
+        query,
+        'ips_site_page',
+        key_ranges,
+        _insert_sitelinks_chunk,
+        params=params
+    )
@@ -1,61 +1,201 @@
+from collections.abc import Generator
 import logging
+from typing import Any, Optional
+
 import pandas as pd
 
-from .database import ToolDB
+from .database import ToolDB, TITLE_HASH_SQL, get_staging_suffix, staging_table
 
 
 LOG = logging.getLogger(__name__)
 
+TOOLDB_TMP_VERDICTS_FILE:str = './tmp_tooldb_verdicts{suffix}.tsv'
 
-def query_missing_page_df() -> pd.DataFrame:
-    query = """SELECT
-      CONVERT(qid_sitelink USING utf8mb4) AS qid_sitelink,
-      CONVERT(sitelink USING utf8mb4) AS sitelink,
-      ns_numerical,
-      CONVERT(qid USING utf8mb4) AS qid
+CANDIDATE_CONDITIONS:dict[str, str] = {  # candidate set: condition over the join of the staging tables
+    'missing_page' : "ns_numerical IS NULL",
+    'qid_different' : "ns_numerical IS NOT NULL AND qid!='' AND qid!=qid_sitelink",
+    'qid_missing' : "ns_numerical IS NOT NULL AND qid=''",
+}
+
+
+def query_sitelink_prefixes() -> tuple[list[str], bool]:
+    query_prefixes = f"""SELECT DISTINCT
+      CONVERT(SUBSTRING_INDEX(sitelink, ':', 1) USING utf8mb4) AS prefix
     FROM
-      sitelinks
-        LEFT JOIN pages ON sitelink=full_page_title
+      {staging_table('sitelinks')}
+    WHERE
+      sitelink LIKE '%:%'"""
+
+    query_main = f"""SELECT EXISTS (
+      SELECT
+        1
+      FROM
+        {staging_table('sitelinks')}
+      WHERE
+        sitelink NOT LIKE '%:%'
+    ) AS has_unprefixed"""
+
+    prefixes = [ row['prefix'] for row in ToolDB.query_tooldb(query_prefixes) ]
+    has_unprefixed = bool(ToolDB.query_tooldb(query_main)[0]['has_unprefixed'])
+
+    return prefixes, has_unprefixed
+
+
+def query_sitelink_count() -> int:
+    query = f"""SELECT
+      COUNT(*) AS cnt
+    FROM
+      {staging_table('sitelinks')}"""
+
+    return ToolDB.query_tooldb(query)[0]['cnt']
+
+
+def query_sitelink_titles(prefixes:Optional[list[str]]=None, unprefixed:bool=False) -> list[str]:
+    # all titles, or only those with one of the prefixes and/or without any prefix
+    query = f"""SELECT
+      CONVERT(sitelink USING utf8mb4) AS sitelink
+    FROM
+      {staging_table('sitelinks')}"""
+
+    if prefixes is None and unprefixed is False:
+        return [ row['sitelink'] for row in ToolDB.query_tooldb(query) ]
+
+    conditions = [ "sitelink LIKE CONCAT(?, ':%')" for _ in (prefixes or []) ]
+    if unprefixed is True:
+        conditions.append("sitelink NOT LIKE '%:%'")
+    if len(conditions) == 0:
+        return []
+
+    query += f"""
+    WHERE
+      {' OR '.join(conditions)}"""
+
+    return [ row['sitelink'] for row in ToolDB.query_tooldb(query, params_tuple=tuple(prefixes or [])) ]
+
+
+def query_missing_page_count() -> int:
+    query = f"""SELECT
+      COUNT(*) AS cnt
+    FROM
+      {staging_table('sitelinks')}
+        LEFT JOIN {staging_table('pages')} ON sitelink_hash=title_hash AND sitelink=full_page_title
     WHERE
       ns_numerical IS NULL"""
 
-    df = pd.DataFrame(data=ToolDB.query_tooldb(query))
+    return ToolDB.query_tooldb(query)[0]['cnt']
 
-    return df
 
+def query_candidate_counts() -> dict[str, int]:
+    # all candidate sets in one pass over the join; only the counts leave the database
+    counts = ''.join([ f"""
+      COALESCE(SUM({condition}), 0) AS {candidate_set},""" for candidate_set, condition in CANDIDATE_CONDITIONS.items() ])
 
-def query_local_qid_is_different_df() -> pd.DataFrame:
-    query = """SELECT
+    query = f"""SELECT{counts}
+      COUNT(*) AS sitelinks
+    FROM
+      {staging_table('sitelinks')}
+        LEFT JOIN {staging_table('pages')} ON sitelink_hash=title_hash AND sitelink=full_page_title"""
+
+    return { key : int(value) for key, value in ToolDB.query_tooldb(query)[0].items() }
+
+
+def _candidate_query(candidate_set:str, exclude_verdicts:bool=False) -> str:
+    # exclude_verdicts: anti-join the staged verdict keys, see stage_verdict_keys()
+    verdict_join, verdict_condition = '', ''
+    if exclude_verdicts is True:
+        verdict_join = f"""
+        LEFT JOIN {staging_table('verdicts')} ON verdict_qid=qid_sitelink AND verdict_sitelink=sitelink"""
+        verdict_condition = """
+      AND verdict_qid IS NULL"""
+
+    return f"""SELECT
       CONVERT(qid_sitelink USING utf8mb4) AS qid_sitelink,
       CONVERT(sitelink USING utf8mb4) AS sitelink,
       ns_numerical,
       CONVERT(qid USING utf8mb4) AS qid
     FROM
-      sitelinks
-        LEFT JOIN pages ON sitelink=full_page_title
+      {staging_table('sitelinks')}
+        LEFT JOIN {staging_table('pages')} ON sitelink_hash=title_hash AND sitelink=full_page_title{verdict_join}
     WHERE
-      ns_numerical IS NOT NULL
-      AND qid!=''
-      AND qid!=qid_sitelink"""
+      {CANDIDATE_CONDITIONS[candidate_set]}{verdict_condition}"""
+
+
+def stage_verdict_keys(keys:list[tuple[str, str]]) -> None:
+    # (qid, sitelink) of candidates which are skipped, so that they do not take sample slots
+    ToolDB.prepare_staging_table('verdicts')
+    if len(keys) == 0:
+        return
+
+    filename = TOOLDB_TMP_VERDICTS_FILE.format(suffix=get_staging_suffix())
+    pd.DataFrame(data=keys, columns=['qid', 'sitelink']).to_csv(
+        filename,
+        sep='\t',
+        header=False,
+        columns=['qid', 'sitelink']
+    )
+
+    ToolDB.insert_batch('verdicts', filename)
+
+
+def query_candidates_chunked(candidate_set:str, chunksize:int) -> Generator[list[dict[str, Any]], None, None]:
+    yield from ToolDB.query_tooldb_chunked(_candidate_query(candidate_set), chunksize=chunksize)
+
+
+def query_missing_page_df(limit:Optional[int]=None, seed:Optional[int]=None, order:Optional[str]=None, exclude_verdicts:bool=False) -> pd.DataFrame:
+    # sampling and capping happen in the database, so that only up to limit rows are transferred
+    order_clauses = {
+        'oldest_item' : 'CAST(SUBSTRING(qid_sitelink, 2) AS UNSIGNED) ASC',  # approximates sitelink age
+    }
+
+    query = _candidate_query('missing_page', exclude_verdicts=exclude_verdicts)
+
+    if order is not None:
+        if order not in order_clauses:
+            raise ValueError(f'Unknown candidate order "{order}"')
+        query += f"""
+    ORDER BY
+      {order_clauses[order]}"""
+    elif limit is not None:
+        query += f"""
+    ORDER BY
+      RAND({'' if seed is None else int(seed)})"""
+
+    if limit is not None:
+        query += f"""
+    LIMIT {int(limit)}"""
 
     df = pd.DataFrame(data=ToolDB.query_tooldb(query))
 
     return df
 
 
+def query_local_qid_is_different_df() -> pd.DataFrame:
+    df = pd.DataFrame(data=ToolDB.query_tooldb(_candidate_query('qid_different')))
+
+    return df
+
+
 def query_local_qid_is_missing_df() -> pd.DataFrame:
-    query = """SELECT
-      CONVERT(qid_sitelink USING utf8mb4) AS qid_sitelink,
-      CONVERT(sitelink USING utf8mb4) AS sitelink,
-      ns_numerical,
-      CONVERT(qid USING utf8mb4) AS qid
-    FROM
-      sitelinks
-        LEFT JOIN pages ON sitelink=full_page_title
-    WHERE
-      ns_numerical IS NOT NULL
-      AND qid=''"""
+    df = pd.DataFrame(data=ToolDB.query_tooldb(_candidate_query('qid_missing')))
 
-    df = pd.DataFrame(data=ToolDB.query_tooldb(query))
+    return df
+
+
+def query_existing_page_titles(full_page_titles:list[str], batchsize:int=1000) -> set[str]:
+    existing_titles:set[str] = set()
+
+    for i in range(0, len(full_page_titles), batchsize):
+        batch = full_page_titles[i:i+batchsize]
+        query = f"""SELECT
+          CONVERT(full_page_title USING utf8mb4) AS full_page_title
+        FROM
+          {staging_table('pages')}
+        WHERE
+          title_hash IN ({', '.join([TITLE_HASH_SQL.format(column='?') for _ in batch])})"""
+
+        batch_titles = set(batch)
+        for row in ToolDB.query_tooldb(query, params_tuple=tuple(batch)):
+            if row['full_page_title'] in batch_titles:  # hash collisions
+                existing_titles.add(row['full_page_title'])
 
-    return df
\ No newline at end of file
+    return existing_titles
@@ -0,0 +1,73 @@
+import logging
+from time import time
+from typing import Optional
+
+from .config import PROJECT_STATS_HISTORY, RUN_TIME_BUDGET
+from .database import LoggingDB
+from .types import ProjectEstimate
+
+
+LOG = logging.getLogger(__name__)
+
+
+def estimate_projects(dbnames:list[str]) -> list[ProjectEstimate]:
+    history = LoggingDB.query_project_history(PROJECT_STATS_HISTORY)
+
+    estimates:list[ProjectEstimate] = []
+    for dbname in dbnames:
+        runs = history.get(dbname, [])
+        if len(runs) == 0:
+            estimates.append(ProjectEstimate(dbname))
+            continue
+
+        total_duration = sum([ duration for duration, _, _ in runs ])
+        total_fixes = sum([ fixes for _, fixes, _ in runs ])
+        estimates.append(
+            ProjectEstimate(
+                dbname,
+                total_duration / len(runs),
+                total_fixes / max(total_duration / 60, 1/60),
+                runs[0][2]
+            )
+        )
+
+    return estimates
+
+
+def _by_yield(estimate:ProjectEstimate) -> tuple[float, float, str]:
+    return -(estimate.fixes_per_minute or 0), estimate.duration or 0, estimate.dbname
+
+
+def order_projects(estimates:list[ProjectEstimate]) -> list[ProjectEstimate]:
+    # unmeasured projects first (alphabetically), so that all projects get an estimate; then by
+    # expected fixes per minute, and the shorter project first in case of equal yield; projects
+    # whose scan failed in the most recent run go last, so that they do not use up the budget
+    unmeasured = [ estimate for estimate in estimates if estimate.fixes_per_minute is None ]
+    measured = [ estimate for estimate in estimates if estimate.fixes_per_minute is not None and estimate.failed is not True ]
+    failing = [ estimate for estimate in estimates if estimate.fixes_per_minute is not None and estimate.failed is True ]
+
+    ordered = [
+        *sorted(unmeasured, key=lambda estimate : estimate.dbname),
+        *sorted(measured, key=_by_yield),
+        *sorted(failing, key=_by_yield)
+    ]
+    LOG.info(f'Scheduled {len(ordered)} projects; {len(unmeasured)} without stats from previous runs, {len(failing)} failed recently')
+
+    return ordered
+
+
+def remaining_budget(started_at:float) -> Optional[float]:
+    # time in seconds, or None without a budget
+    if RUN_TIME_BUDGET is None:
+        return None
+
+    return RUN_TIME_BUDGET - (time() - started_at)
+
+
+def fits_budget(started_at:float, estimate:ProjectEstimate, reserved:float=0) -> bool:
+    # reserved: time in seconds which is already promised to earlier projects, e.g. for their queued edits
+    remaining = remaining_budget(started_at)
+    if remaining is None:
+        return True
+
+    return remaining - reserved > (estimate.duration or 0)
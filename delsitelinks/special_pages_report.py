@@ -1,31 +1,15 @@
 import logging
+import re
 from time import strftime
 
-import pywikibot as pwb
-
-from .config import SPECIAL_PAGE_LOG
+from .database import LoggingDB
+from .work_queue import get_run_id
 
 
 LOG = logging.getLogger(__name__)
 
-
-def log_special_page_sitelink(qid:str, dbname:str, page_title:str) -> None:
-    with open(SPECIAL_PAGE_LOG, mode='a', encoding='utf8') as file_handle:
-        file_handle.write(f'{qid}\t{dbname}\t{page_title}\n')
-    LOG.info(f'added sitelink {qid} --> {dbname} to special page log')
-
-
-def clear_special_page_log() -> None:
-    with open(SPECIAL_PAGE_LOG, mode='w', encoding='utf8') as file_handle:
-        file_handle.write('')
-    LOG.info('special page log was cleared')
-
-
-def write_special_page_report() -> None:
-    site = pwb.Site('wikidata', 'wikidata')
-    page = pwb.Page(site, 'Wikidata:Database reports/Special pages as sitelinks')
-
-    page_text = """List of sitelinks to MediaWiki Special pages. Update: <onlyinclude>{ts}</onlyinclude>
+SPECIAL_PAGE_REPORT_TITLE:str = 'Wikidata:Database reports/Special pages as sitelinks'
+SPECIAL_PAGE_REPORT_TEXT:str = """List of sitelinks to MediaWiki Special pages. Update: <onlyinclude>{ts}</onlyinclude>
 
 {{| class="wikitable sortable"
 |-
@@ -34,21 +18,58 @@ def write_special_page_report() -> None:
 |}}
 
 [[Category:Database reports]]"""
+SPECIAL_PAGE_REPORT_TIMESTAMP:re.Pattern = re.compile(r'<onlyinclude>.*?</onlyinclude>')
+
+SPECIAL_PAGE_BUFFER:list[tuple[str, str, str]] = []  # (qid, dbname, page_title); written to the logging database per project
+
+
+def log_special_page_sitelink(qid:str, dbname:str, page_title:str) -> None:
+    SPECIAL_PAGE_BUFFER.append((qid, dbname, page_title))
+    LOG.info(f'added sitelink {qid} --> {dbname} to special page log')
 
-    table_body = ''
-    with open(SPECIAL_PAGE_LOG, mode='r', encoding='utf8') as file_handle:
-        for line in file_handle:
-            try:
-                qid, dbname, page_title = line.strip().split('\t')
-            except ValueError:
-                break
 
-            table_body = f'{table_body}|-\n| [[{qid}]] || {dbname} || {page_title}\n'
+def flush_special_page_log() -> None:
+    if len(SPECIAL_PAGE_BUFFER) == 0:
+        return
 
-    page.text = page_text.format(
+    LoggingDB.insert_special_page_sitelinks(get_run_id(), SPECIAL_PAGE_BUFFER)
+    SPECIAL_PAGE_BUFFER.clear()
+
+
+def clear_special_page_log(keep_current_run:bool=False) -> None:
+    # workers of a shared run keep the entries which other workers have already logged for it
+    SPECIAL_PAGE_BUFFER.clear()
+    LoggingDB.clear_special_page_sitelinks(get_run_id() if keep_current_run is True else None)
+    LOG.info('special page log was cleared')
+
+
+def _render_special_page_report(entries:list[tuple[str, str, str]]) -> str:
+    table_body = ''.join([ f'|-\n| [[{qid}]] || {dbname} || {page_title}\n' for qid, dbname, page_title in entries ])
+
+    return SPECIAL_PAGE_REPORT_TEXT.format(
         ts=strftime('%Y-%m-%d %H:%M (%Z)'),
         table_body=table_body
     )
+
+
+def _strip_timestamp(page_text:str) -> str:
+    return SPECIAL_PAGE_REPORT_TIMESTAMP.sub('', page_text, count=1).strip()
+
+
+def write_special_page_report() -> None:
+    import pywikibot as pwb  # not needed for the special page log itself
+
+    flush_special_page_log()
+    page_text = _render_special_page_report(LoggingDB.query_special_page_sitelinks(get_run_id()))
+
+    site = pwb.Site('wikidata', 'wikidata')
+    page = pwb.Page(site, SPECIAL_PAGE_REPORT_TITLE)
+
+    if page.exists() and _strip_timestamp(page.text) == _strip_timestamp(page_text):
+        LOG.info('special page report is unchanged; not saved')
+        return
+
+    page.text = page_text
     page.save(summary='upd', minor=False)
 
     LOG.info('sucessfully wrote special page report')
@@ -1,65 +1,98 @@
+from glob import glob
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from .config import NEEDS_FIX_WIKIS, WORK_WHITELIST, WORK_BLACKLIST, MIN_PROJECT, MAX_PROJECT, TOUCH_QID_DIFFERENT, TOUCH_QID_MISSING
-from .database import Replica
+from os import remove
+from time import sleep, time
+
+from .config import CONSOLIDATE_ITEM_EDITS, SITELINK_EXPORT, MAX_SITELINKS_PER_PROJECT, SITELINK_SAMPLE_SEED, SITELINK_SAMPLE_ORDER, \
+    NEEDS_FIX_WIKIS, WORK_WHITELIST, WORK_BLACKLIST, MIN_PROJECT, MAX_PROJECT, TOUCH_QID_DIFFERENT, TOUCH_QID_MISSING, \
+    WORK_QUEUE_HEARTBEAT, TOUCH_PARALLEL_WIKIS, CANDIDATE_EXPORT, WORKER_DB_PATH
+from .api_session import close_sessions
+from .cassette import install_cassette
+from .database import LoggingDB, Replica, ToolDB, set_staging_suffix, set_logging_db_path
+from .profiling import profile_project, profile_stage
+from .query_catalog import WIKI_CLIENTS, audit_query_plans
+from .scheduling import estimate_projects, order_projects, remaining_budget, fits_budget
 from .types import WikiClient
-from .query_replicas import query_pages, query_sitelinks
-from .query_tooldb import query_missing_page_df, query_local_qid_is_different_df, query_local_qid_is_missing_df
-from .processing_sitelinks import remove_sitelinks
-from .processing_touch import touch_different_local_qids, touch_missing_local_qids
-from .special_pages_report import clear_special_page_log, write_special_page_report
+from .query_replicas import query_pages, query_sitelinks, export_sitelinks, clear_sitelink_export
+from .query_tooldb import query_missing_page_count, query_missing_page_df, query_local_qid_is_different_df, query_local_qid_is_missing_df
+from .special_pages_report import clear_special_page_log, flush_special_page_log, write_special_page_report
+from .work_queue import get_run_id
+
+# modules which depend on pywikibot are imported where they are needed, so that scanning the
+# replicas neither pays for importing pywikibot nor triggers a login
 
 LOG = logging.getLogger(__name__)
 
 
 def process_project(wiki_client:WikiClient, job_remove_sitelinks:bool=False, job_qid_different:bool=False, job_qid_missing:bool=False) -> None:  # TODO: default input args
-    # threading does not speed up things here since both methods operate on the same database and the
-    # operation is apparently limited by database-io anyways. however, this way both queries are started
-    # at the same time and thus keeping them synced    
+    with profile_project(wiki_client.dbname):
+        _process_project(wiki_client, job_remove_sitelinks, job_qid_different, job_qid_missing)
+
+
+def _process_project(wiki_client:WikiClient, job_remove_sitelinks:bool, job_qid_different:bool, job_qid_missing:bool) -> None:
+    # sitelinks go first since the page scan is restricted to the namespaces which occur in them;
+    # both scans are parallelized internally over key ranges for large wikis
+    started_at = time()
     try:
-        with ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(query_pages, wiki_client),
-                executor.submit(query_sitelinks, wiki_client)
-            ]
-            for future in as_completed(futures):
-                future.result()
+        with profile_stage('query_sitelinks'):
+            query_sitelinks(wiki_client)
+        with profile_stage('query_pages'):
+            query_pages(wiki_client)
+            ToolDB.index_staging_table('pages')
     except RuntimeError as exception:  # this catches particularly lost database connection situations
         LOG.warn(exception)
+        if job_remove_sitelinks is True:  # failure marker; such wikis are scheduled last in later runs
+            scan_duration = time() - started_at
+            LoggingDB.insert_project_stats(get_run_id(), wiki_client.dbname, int(started_at), scan_duration, scan_duration, -1)
         return
+    scan_duration = time() - started_at
+
+    if CANDIDATE_EXPORT is True:
+        from .candidate_export import export_candidate_sets
+
+        with profile_stage('export_candidates'):
+            try:
+                export_candidate_sets(wiki_client.dbname)
+            except (RuntimeError, RuntimeWarning, OSError) as exception:  # the jobs do not depend on the export
+                LOG.warn(f'Cannot export candidates of {wiki_client.dbname}: {exception}')
 
     if job_remove_sitelinks is True:
-        page_is_missing = query_missing_page_df()
-        #page_is_missing.to_csv(f'./{wiki_client.dbname}-page_is_missing.tsv', sep='\t', header=False)
+        from .processing_sitelinks import remove_sitelinks, stage_cached_verdicts
+
+        with profile_stage('query_missing_pages'):
+            page_is_missing_count = query_missing_page_count()
+            excluded_count = stage_cached_verdicts(wiki_client)
+            page_is_missing = query_missing_page_df(
+                limit=MAX_SITELINKS_PER_PROJECT,
+                seed=SITELINK_SAMPLE_SEED,
+                order=SITELINK_SAMPLE_ORDER,
+                exclude_verdicts=excluded_count > 0
+            )
 
-        remove_sitelinks(page_is_missing, wiki_client)
+        with profile_stage('remove_sitelinks'):
+            remove_sitelinks(page_is_missing, wiki_client, page_is_missing_count)
+            flush_special_page_log()
+
+        # scheduling input for later runs; fixes are counted from the edit log
+        LoggingDB.insert_project_stats(get_run_id(), wiki_client.dbname, int(started_at), scan_duration, time() - started_at, page_is_missing_count)
 
     if job_qid_different is True:
-        local_qid_is_different = query_local_qid_is_different_df()
-        #local_qid_is_different.to_csv(f'./{wiki_client.dbname}-local_qid_is_different.tsv', sep='\t', header=False)
+        from .processing_touch import touch_different_local_qids
 
-        touch_different_local_qids(local_qid_is_different, wiki_client)
+        with profile_stage('touch_different_local_qids'):
+            local_qid_is_different = query_local_qid_is_different_df()
+            touch_different_local_qids(local_qid_is_different, wiki_client)
 
     if job_qid_missing is True:
-        local_qid_is_missing = query_local_qid_is_missing_df()
-        #local_qid_is_missing.to_csv(f'./{wiki_client.dbname}-local_qid_is_missing.tsv', sep='\t', header=False)
+        from .processing_touch import touch_missing_local_qids
 
-        touch_missing_local_qids(local_qid_is_missing, wiki_client)
+        with profile_stage('touch_missing_local_qids'):
+            local_qid_is_missing = query_local_qid_is_missing_df()
+            touch_missing_local_qids(local_qid_is_missing, wiki_client)
 
 
 def query_wiki_clients(lazy_namespaces:bool=False) -> list[WikiClient]:
-    query = """SELECT
-        dbname,
-        url
-    FROM
-        wiki
-    WHERE
-        is_closed=0
-        AND has_wikidata=1
-    ORDER BY
-        dbname ASC"""  # https://quarry.wmcloud.org/query/12744
-    result = Replica.query_mediawiki('meta', query)
+    result = Replica.query_mediawiki('meta', WIKI_CLIENTS.render())
 
     wiki_clients = []
     for dct in result:
@@ -71,56 +104,187 @@ def query_wiki_clients(lazy_namespaces:bool=False) -> list[WikiClient]:
     return wiki_clients
 
 
+def _is_selected_project(dbname:str) -> bool:
+    if dbname in NEEDS_FIX_WIKIS:
+        return False
+
+    if WORK_BLACKLIST is not None and dbname in WORK_BLACKLIST:
+        return False
+
+    if WORK_WHITELIST is not None and dbname not in WORK_WHITELIST:
+        return False
+
+    if MIN_PROJECT is not None and dbname < MIN_PROJECT:
+        return False
+
+    if MAX_PROJECT is not None and dbname > MAX_PROJECT:
+        return False
+
+    return True
+
+
 def main_tidy_sitelinks() -> None:
-    wiki_clients = query_wiki_clients(lazy_namespaces=True)
+    try:
+        install_cassette()
+        started_at = time()
+        wiki_clients = { wiki_client.dbname : wiki_client for wiki_client in query_wiki_clients(lazy_namespaces=True) }
+        estimates = order_projects(estimate_projects([ dbname for dbname in wiki_clients.keys() if _is_selected_project(dbname) ]))
+
+        clear_special_page_log()
 
-    clear_special_page_log()
+        if SITELINK_EXPORT is True:
+            try:
+                export_sitelinks()
+            except RuntimeError as exception:  # fall back to per-wiki sitelink queries
+                LOG.warn(exception)
+                clear_sitelink_export()
 
-    for i, wiki_client in enumerate(wiki_clients, start=1):
-        if wiki_client.dbname in NEEDS_FIX_WIKIS:
-            continue
+        reserved = 0.0  # expected time of the queued edits of processed projects; their durations include edit time
+        for i, estimate in enumerate(estimates, start=1):
+            if not fits_budget(started_at, estimate, reserved):
+                LOG.info(f'{estimate.dbname} ({i}/{len(estimates)}) skipped; expected to exceed the run time budget')
+                continue
 
-        if WORK_BLACKLIST is not None and wiki_client.dbname in WORK_BLACKLIST:
-            continue
+            LOG.info(f'{estimate.dbname} ({i}/{len(estimates)})')
+            project_started_at = time()
+            process_project(wiki_clients[estimate.dbname], job_remove_sitelinks=True, job_qid_different=False, job_qid_missing=False)
+            if CONSOLIDATE_ITEM_EDITS is True:
+                reserved += max(0, (estimate.duration or 0) - (time() - project_started_at))
 
-        if WORK_WHITELIST is not None and wiki_client.dbname not in WORK_WHITELIST:
-            continue
+        if CONSOLIDATE_ITEM_EDITS is True:
+            from .bot_sitelinks import apply_queued_sitelink_changes
 
-        if MIN_PROJECT is not None and wiki_client.dbname < MIN_PROJECT:
-            continue
+            remaining = remaining_budget(started_at)
+            apply_queued_sitelink_changes(deadline=None if remaining is None else time() + remaining)
 
-        if MAX_PROJECT is not None and wiki_client.dbname > MAX_PROJECT:
-            continue
+        write_special_page_report()
 
-        LOG.info(f'{wiki_client.dbname} ({i}/{len(wiki_clients)})')
-        process_project(wiki_client, job_remove_sitelinks=True, job_qid_different=False, job_qid_missing=False)
+        if SITELINK_EXPORT is True:
+            clear_sitelink_export()
+    finally:
+        close_sessions()
 
-    write_special_page_report()
+
+def _merge_worker_logging_dbs(run_id:str) -> None:
+    # all workers are done with the queue, so that their files are not written any longer
+    for path in sorted(glob(WORKER_DB_PATH.format(worker='*'))):
+        LoggingDB.merge_logging_db(path, run_id)
+        remove(path)
+
+
+def main_tidy_sitelinks_worker() -> None:
+    # one of several identical pods: claims wikis from the shared work queue until it is empty;
+    # the run-wide sitelink export is not used here, since workers would overwrite each others' export;
+    # consolidated edits are not supported either, since a completed wiki must not have changes left
+    # in the memory of the pod
+    from .work_queue import get_worker_id, enqueue_wikis, claim_wiki, complete_wiki, release_wiki, lease_heartbeat, \
+        query_queue_is_drained, claim_run_report, query_run_summary, skip_wikis_over_budget, query_run_started_at, \
+        fail_abandoned_wikis
+
+    if CONSOLIDATE_ITEM_EDITS is True:
+        raise RuntimeError('CONSOLIDATE_ITEM_EDITS is not supported in work queue mode')
+
+    try:
+        install_cassette()
+        run_id = get_run_id()
+        worker = get_worker_id()
+        set_staging_suffix(f'_{worker}')
+        set_logging_db_path(WORKER_DB_PATH.format(worker=worker))
+        LOG.info(f'Worker {worker} of run {run_id}')
+
+        wiki_clients = { wiki_client.dbname : wiki_client for wiki_client in query_wiki_clients(lazy_namespaces=True) }
+        estimates = order_projects(estimate_projects([ dbname for dbname in wiki_clients.keys() if _is_selected_project(dbname) ]))
+        enqueue_wikis(
+            run_id,
+            [ estimate.dbname for estimate in estimates ],
+            { estimate.dbname : estimate.duration or 0 for estimate in estimates }
+        )
+        started_at = query_run_started_at(run_id)  # the budget is shared by all workers of the run
+
+        clear_special_page_log(keep_current_run=True)
+
+        while True:
+            remaining = remaining_budget(started_at)
+            if remaining is not None:
+                skipped = skip_wikis_over_budget(run_id, remaining)
+                if skipped > 0:
+                    LOG.info(f'{skipped} wikis skipped; expected to exceed the run time budget')
+
+            claim = claim_wiki(run_id, worker, max_expected_duration=remaining)
+            if claim is None:
+                fail_abandoned_wikis(run_id)
+                if query_queue_is_drained(run_id):
+                    break
+                sleep(WORK_QUEUE_HEARTBEAT)  # other workers are busy; their wikis are reclaimed if their leases expire
+                continue
+
+            dbname, claim_token = claim
+            if dbname not in wiki_clients:  # enqueued by a worker with a different wiki list
+                release_wiki(run_id, dbname, claim_token)
+                continue
+
+            LOG.info(f'{dbname} claimed by worker {worker}')
+            try:
+                with lease_heartbeat(run_id, dbname, claim_token):
+                    process_project(wiki_clients[dbname], job_remove_sitelinks=True, job_qid_different=False, job_qid_missing=False)
+            except Exception as exception:  # the wiki is left to other workers; keep working on the queue
+                LOG.warn(f'{dbname} failed at worker {worker}: {exception}')
+                release_wiki(run_id, dbname, claim_token)
+                continue
+
+            complete_wiki(run_id, dbname, claim_token)
+
+        if claim_run_report(run_id):
+            LOG.info(f'Run {run_id} finished: {query_run_summary(run_id)}')
+            _merge_worker_logging_dbs(run_id)
+            write_special_page_report()
+    finally:
+        close_sessions()
 
 
 # Remarks related to page touch:
 # * arzwiki has still some work to do
-# * azwiki has some problem with nulledits
-# * cawikisource, ckbwiki, eswikiquote, eswikivoyage, simplewiki, zhwikinews have captchas to solve
-# * specieswiki has some login problem
+# * wikis with known touch problems (nulledits, captchas, login) are listed in TOUCH_QUARANTINE_WIKIS
 def main_power_touch() -> None:
-    wiki_clients = query_wiki_clients(lazy_namespaces=True)
+    # wikis are scanned one after another; their touches run in per-wiki workers in the background
+    from .processing_touch import is_quarantined, parallel_touch_workers
+
+    try:
+        install_cassette()
+        wiki_clients = query_wiki_clients(lazy_namespaces=True)
 
-    for i, wiki_client in enumerate(wiki_clients, start=1):
-        if wiki_client.dbname in NEEDS_FIX_WIKIS:
-            continue
+        with parallel_touch_workers(TOUCH_PARALLEL_WIKIS):
+            for i, wiki_client in enumerate(wiki_clients, start=1):
+                if not _is_selected_project(wiki_client.dbname) or is_quarantined(wiki_client.dbname):
+                    continue
 
-        if WORK_BLACKLIST is not None and wiki_client.dbname in WORK_BLACKLIST:
-            continue
+                LOG.info(f'{wiki_client.dbname} ({i}/{len(wiki_clients)})')
+                process_project(wiki_client, job_qid_different=True, job_qid_missing=True)
+    finally:
+        close_sessions()
 
-        if WORK_WHITELIST is not None and wiki_client.dbname not in WORK_WHITELIST:
-            continue
 
-        if MIN_PROJECT is not None and wiki_client.dbname < MIN_PROJECT:
-            continue
+def main_query_audit() -> None:
+    findings = audit_query_plans()
+
+    if len(findings) == 0:
+        LOG.info('Query audit: no unexpected full scans')
+        return
+
+    for name, tables in findings.items():
+        LOG.warn(f'Query audit: {name} scans {", ".join(tables)}')
+    raise RuntimeError(f'Query audit found {len(findings)} queries with unexpected full scans')
+
+
+def main_census() -> None:
+    # all wikis, including those which are not selected for regular runs; read-only
+    from .census import CENSUS_COLUMNS, run_census
+
+    run_id = get_run_id()
+    wiki_clients = query_wiki_clients(lazy_namespaces=True)
+    LOG.info(f'Census {run_id} of {len(wiki_clients)} wikis')
+
+    rows = run_census(run_id, wiki_clients)
 
-        if MAX_PROJECT is not None and wiki_client.dbname > MAX_PROJECT:
-            continue
-        
-        LOG.info(f'{wiki_client.dbname} ({i}/{len(wiki_clients)})')
-        process_project(wiki_client, job_qid_different=True, job_qid_missing=True)
+    totals = ', '.join([ f'{column}={sum([ row[column] for row in rows ])}' for column in CENSUS_COLUMNS ])
+    LOG.info(f'Census {run_id} finished for {len(rows)}/{len(wiki_clients)} wikis: {totals}')
@@ -6,8 +6,10 @@ from json import JSONDecodeError
 import phpserialize
 import requests
 
-from .config import LARGE_WIKIS_LOGEVENTS
+from .api_session import get_session
+from .config import HTTP_TIMEOUT
 from .database import Replica
+from .query_catalog import LOG_EVENTS, USER_BLOCKLOG, USER_BY_NAME
 
 
 LOG = logging.getLogger(__name__)
@@ -20,6 +22,7 @@ class Namespace:
     ns_local:str
     ns_generic:str
     ns_aliases:list[str] = field(default_factory=list)
+    ns_case:str = 'first-letter'  # or 'case-sensitive'; from siteinfo
 
 
 @dataclass
@@ -48,18 +51,7 @@ class User:
         user_name_tidied = self.user_name.replace(" ", "_").replace("'", "''")
 
         params = { 'username' : user_name_tidied }
-        query = f"""SELECT
-            log_id,
-            log_timestamp,
-            log_params
-        FROM
-            logging
-        WHERE
-            log_type='block'
-            AND log_action='block'
-            AND log_namespace=2
-            AND log_title=%(username)s"""
-        result = Replica.query_mediawiki('wikidatawiki', query, params=params)
+        result = Replica.query_mediawiki('wikidatawiki', USER_BLOCKLOG.render(), params=params)
 
         for row in result:
             self.user_blocklog.append(
@@ -113,16 +105,7 @@ class User:
         user_name_tidied = user_name.replace("'", "''")
         
         params = { 'username' : user_name_tidied }
-        query_exists = f"""SELECT
-            user_id,
-            user_name,
-            user_registration,
-            user_editcount
-        FROM
-            user
-        WHERE
-            user_name=%(username)s"""
-        result_exists = Replica.query_mediawiki('wikidatawiki', query_exists, params=params)
+        result_exists = Replica.query_mediawiki('wikidatawiki', USER_BY_NAME.render(), params=params)
 
         if len(result_exists)==0:
             return cls()
@@ -186,6 +169,7 @@ class WikiClient:
             ns_id = data.get('id')
             ns_local = data.get('name')
             ns_generic = data.get('canonical')
+            ns_case = data.get('case', 'first-letter')
             ns_aliasses = []
 
             for alias_data in payload.get('query', {}).get('namespacealiases', []):
@@ -198,7 +182,8 @@ class WikiClient:
                     ns_id,
                     ns_local,
                     ns_generic,
-                    ns_aliasses
+                    ns_aliasses,
+                    ns_case
                 )
             )
 
@@ -217,18 +202,41 @@ class WikiClient:
 
         return ''  # assume main namespace otherwise; TODO: is this okay?
 
+    def get_namespace_case_by_id(self, id:int) -> str:
+        for namespace in self.get_namespaces():
+            if namespace.ns == id:
+                return namespace.ns_case
+
+        return 'first-letter'
+
     def get_namespaces(self) -> list[Namespace]:
         if len(self.namespaces) == 0:
             self._init_namespaces()
         
         return self.namespaces
 
+    def get_namespace_prefixes(self) -> dict[str, Namespace]:
+        prefixes:dict[str, Namespace] = {}
+
+        for namespace in self.get_namespaces():
+            if namespace.ns == 0:
+                continue
+            for prefix in [ namespace.ns_local, namespace.ns_generic, *namespace.ns_aliases ]:
+                if prefix is not None and prefix not in prefixes:
+                    prefixes[prefix] = namespace
+
+        return prefixes
+
     @staticmethod
     def api_request(host:str, request_params:dict) -> dict:
-        response = requests.get(
-            url=f'https://{host}/w/api.php',
-            params=request_params
-        )
+        try:
+            response = get_session(host).get(
+                url=f'https://{host}/w/api.php',
+                params=request_params,
+                timeout=HTTP_TIMEOUT
+            )
+        except requests.RequestException as exception:
+            raise RuntimeError(f'Cannot retrieve data from MWAPI at {host}') from exception
 
         if response.status_code not in [ 200 ]:
             raise RuntimeError(f'Cannot retrieve namespaces from MWAPI; HTTP status {response.status_code}')
@@ -247,10 +255,12 @@ class Page:
     wiki_client:WikiClient
     page_namespace:Optional[Namespace] = None
     qid_local:Optional[str] = None  # the value from page_props table
+    lazy_logevents:Optional[bool] = False
     log_events:list[LogEvent] = field(init=False, default_factory=list)
 
     def __post_init__(self) -> None:
-        self._init_logevents()
+        if self.lazy_logevents is not True:
+            self._init_logevents()
     
     def _init_logevents(self) -> None:
         log_actions = [
@@ -268,66 +278,15 @@ class Page:
             self.wiki_client.get_namespaces()
         )
         
-        # TODO: figure out whether this can be done one way or the other for all projects
-        if self.wiki_client.dbname not in LARGE_WIKIS_LOGEVENTS.keys():
-            params = {
-                'logtype' : log.get('type', ''),
-                'logaction' : log.get('action', ''),
-                'logtitle' : plain_page_title.replace(' ', '_').replace('"', '""'),
-                'lognamespace' : page_namespace
-            }
-            query = f"""SELECT
-                log_id,
-                log_timestamp,
-                actor_name,
-                log_params
-            FROM
-                logging_userindex
-                    JOIN actor_logging ON log_actor=actor_id
-            WHERE
-                log_type=%(logtype)s
-                AND log_action=%(logaction)s
-                AND log_title=%(logtitle)s
-                AND log_namespace=%(lognamespace)s"""
-
-            result = Replica.query_mediawiki(self.wiki_client.dbname, query, params=params)
-        else:
-            api_response = WikiClient.api_request(
-                LARGE_WIKIS_LOGEVENTS.get(self.wiki_client.dbname, 'meta.wikimedia.org'),
-                {
-                    'action': 'query',
-                    'format': 'json',
-                    'list': 'logevents',
-                    'leprop': 'ids',
-                    'leaction': f'{log.get("type", "")}/{log.get("action", "")}',
-                    'letitle': self.page_title
-                }
-            )
-
-            logids:list[int] = []
-            for dct in api_response.get('query', {}).get('logevents', []):
-                logids.append(dct.get('logid'))       
-
-            if len(logids) == 0:
-                result = []
-            else:
-                params_tuple = tuple(logids)
-                query = f"""SELECT
-                    log_id,
-                    log_timestamp,
-                    actor_name,
-                    log_params
-                FROM
-                    logging_userindex
-                        JOIN actor_logging ON log_actor=actor_id
-                WHERE
-                    log_id IN ({', '.join(['?' for _ in logids])})"""  # [str(logid) for logid in logids]
-
-                result = Replica.query_mediawiki(
-                    self.wiki_client.dbname,
-                    query,
-                    params_tuple=params_tuple
-                )
+        # logging_logindex exposes the log_page_time index (log_namespace, log_title, log_timestamp), which
+        # logging_userindex does not; this keeps the lookup cheap on large wikis as well
+        params = {
+            'logtype' : log.get('type', ''),
+            'logaction' : log.get('action', ''),
+            'logtitle' : plain_page_title.replace(' ', '_').replace('"', '""'),
+            'lognamespace' : page_namespace
+        }
+        result = Replica.query_mediawiki(self.wiki_client.dbname, LOG_EVENTS.render(), params=params)
 
         log_events:list[LogEvent] = []
 
@@ -421,8 +380,34 @@ class Page:
         return 0, page_title  # page title contains a colon, but not a namespace identifier --- thus assume main namespace
 
 
+@dataclass
+class PageStatus:  # state of a client page as seen by a replica
+    exists:bool
+    is_redirect:bool
+    qid:Optional[str]  # page_props.wikibase_item
+    revid:int = 0  # page_latest; 0 if the page does not exist
+
+
 @dataclass
 class Sitelink:
     qid:str  # from wikibase wb_items_per_site
     wiki_client:WikiClient
     page:Page
+
+
+@dataclass
+class SitelinkChange:
+    qid:str
+    dbname:str
+    old_title:str  # canonical title of the sitelink as verified; change is dropped if the item meanwhile differs
+    new_title:str  # empty string for removal
+    summary:str
+    callback_payload:dict[str, Any]
+
+
+@dataclass
+class ProjectEstimate:  # from the project stats of recent runs
+    dbname:str
+    duration:Optional[float] = None  # time in seconds; None if never measured
+    fixes_per_minute:Optional[float] = None
+    failed:bool = False  # the scan of the most recent run failed
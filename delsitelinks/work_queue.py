@@ -0,0 +1,331 @@
+from collections.abc import Generator
+from contextlib import contextmanager
+import logging
+from os import environ
+from socket import gethostname
+from threading import Event, Thread
+from time import strftime, time
+from typing import Any, Optional
+from uuid import uuid4
+
+import mariadb
+
+from .config import WORK_QUEUE_LEASE, WORK_QUEUE_HEARTBEAT, WORK_QUEUE_MAX_ATTEMPTS
+from .database import ToolDB
+
+
+LOG = logging.getLogger(__name__)
+
+RUN_ID_ENV:str = 'DELSITELINKS_RUN_ID'  # identical for all pods of a run, e.g. the name of the k8s job
+WORKER_ID_ENV:str = 'JOB_COMPLETION_INDEX'  # set by k8s for indexed jobs
+
+
+def get_run_id() -> str:
+    return environ.get(RUN_ID_ENV, strftime('%G-W%V'))  # falls back to the ISO week of the weekly run
+
+
+def get_worker_id() -> str:
+    worker_id = environ.get(WORKER_ID_ENV)
+    if worker_id is None:
+        worker_id = gethostname()
+
+    # also used as staging table suffix
+    return 'w' + ''.join([ char if char.isalnum() else '_' for char in worker_id.lower() ])
+
+
+def _execute(query:str, params:dict[str, Any]) -> int:
+    with ToolDB(autocommit=True) as (_, db_cursor):
+        try:
+            db_cursor.execute(query, params)
+        except mariadb.Error as exception:
+            msg = f'Cannot make work queue query "{query}" with params "{params}" against tool_db'
+            LOG.warn(msg)
+            raise RuntimeWarning(msg) from exception
+
+        return db_cursor.rowcount
+
+
+def _create_tables() -> None:
+    queries = [
+        """CREATE TABLE IF NOT EXISTS work_queue (
+            run_id VARBINARY(64) NOT NULL,
+            dbname VARBINARY(64) NOT NULL,
+            status VARBINARY(16) NOT NULL DEFAULT 'pending',
+            worker VARBINARY(64) DEFAULT NULL,
+            claim_token VARBINARY(32) DEFAULT NULL,
+            lease_until INT UNSIGNED NOT NULL DEFAULT 0,
+            attempts INT UNSIGNED NOT NULL DEFAULT 0,
+            finished_at INT UNSIGNED DEFAULT NULL,
+            PRIMARY KEY (run_id, dbname),
+            KEY claim_token (claim_token)
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin""",
+        """ALTER TABLE work_queue ADD COLUMN IF NOT EXISTS priority INT NOT NULL DEFAULT 0""",
+        """ALTER TABLE work_queue ADD COLUMN IF NOT EXISTS expected_duration INT UNSIGNED NOT NULL DEFAULT 0""",
+        """CREATE TABLE IF NOT EXISTS work_run (
+            run_id VARBINARY(64) NOT NULL,
+            created_at INT UNSIGNED NOT NULL,
+            reported TINYINT UNSIGNED NOT NULL DEFAULT 0,
+            PRIMARY KEY (run_id)
+        ) DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin""",
+    ]
+
+    with ToolDB(autocommit=True) as (_, db_cursor):
+        try:
+            for query in queries:
+                db_cursor.execute(query)
+        except mariadb.Error as exception:
+            msg = 'Cannot create work queue tables in tool_db'
+            LOG.error(msg)
+            raise RuntimeWarning(msg) from exception
+
+
+def enqueue_wikis(run_id:str, dbnames:list[str], expected_durations:Optional[dict[str, float]]=None) -> None:
+    # idempotent; every pod of a run enqueues the same wikis, and existing entries are left untouched;
+    # wikis are claimed in the order of dbnames; the first work queue call of each worker, which
+    # therefore creates the tables
+    _create_tables()
+
+    with ToolDB(autocommit=True) as (_, db_cursor):
+        try:
+            db_cursor.execute(
+                'INSERT IGNORE INTO work_run (run_id, created_at) VALUES (?, ?)',
+                (run_id, int(time()))
+            )
+            if len(dbnames) > 0:
+                db_cursor.executemany(
+                    'INSERT IGNORE INTO work_queue (run_id, dbname, priority, expected_duration) VALUES (?, ?, ?, ?)',
+                    [
+                        (run_id, dbname, len(dbnames) - i, int((expected_durations or {}).get(dbname) or 0)) for i, dbname in enumerate(dbnames)
+                    ]
+                )
+        except mariadb.Error as exception:
+            msg = f'Cannot enqueue wikis for run {run_id}'
+            LOG.error(msg)
+            raise RuntimeWarning(msg) from exception
+
+    LOG.info(f'Enqueued {len(dbnames)} wikis for run {run_id}')
+
+
+def claim_wiki(run_id:str, worker:str, max_expected_duration:Optional[float]=None) -> Optional[tuple[str, str]]:
+    # pending wikis, and wikis whose lease has expired (crashed pod), can be claimed; the update is
+    # atomic, so that each wiki is claimed by exactly one worker
+    claim_token = uuid4().hex
+    params = {
+        'run_id' : run_id,
+        'worker' : worker,
+        'claim_token' : claim_token,
+        'now' : int(time()),
+        'lease_until' : int(time()) + WORK_QUEUE_LEASE,
+        'max_attempts' : WORK_QUEUE_MAX_ATTEMPTS,
+        'max_expected_duration' : 2**32 if max_expected_duration is None else max(0, int(max_expected_duration)),
+    }
+    query = """UPDATE
+        work_queue
+    SET
+        status='claimed',
+        worker=%(worker)s,
+        claim_token=%(claim_token)s,
+        lease_until=%(lease_until)s,
+        attempts=attempts+1
+    WHERE
+        run_id=%(run_id)s
+        AND attempts<%(max_attempts)s
+        AND (status='pending' OR (status='claimed' AND lease_until<%(now)s))
+        AND expected_duration<%(max_expected_duration)s
+    ORDER BY
+        priority DESC,
+        dbname ASC
+    LIMIT 1"""
+
+    if _execute(query, params) == 0:
+        return None
+
+    result = ToolDB.query_tooldb(
+        'SELECT CONVERT(dbname USING utf8mb4) AS dbname FROM work_queue WHERE claim_token=%(claim_token)s',
+        params={ 'claim_token' : claim_token }
+    )
+    if len(result) == 0:
+        return None
+
+    return result[0]['dbname'], claim_token
+
+
+def renew_lease(run_id:str, dbname:str, claim_token:str) -> bool:
+    params = {
+        'run_id' : run_id,
+        'dbname' : dbname,
+        'claim_token' : claim_token,
+        'lease_until' : int(time()) + WORK_QUEUE_LEASE,
+    }
+    query = """UPDATE
+        work_queue
+    SET
+        lease_until=%(lease_until)s
+    WHERE
+        run_id=%(run_id)s
+        AND dbname=%(dbname)s
+        AND claim_token=%(claim_token)s
+        AND status='claimed'"""
+
+    return _execute(query, params) > 0
+
+
+def complete_wiki(run_id:str, dbname:str, claim_token:str) -> None:
+    params = { 'run_id' : run_id, 'dbname' : dbname, 'claim_token' : claim_token, 'now' : int(time()) }
+    query = """UPDATE
+        work_queue
+    SET
+        status='done',
+        finished_at=%(now)s
+    WHERE
+        run_id=%(run_id)s
+        AND dbname=%(dbname)s
+        AND claim_token=%(claim_token)s"""
+
+    if _execute(query, params) == 0:
+        LOG.warn(f'Claim of {dbname} was lost before completion; the wiki might be processed twice')
+
+
+def release_wiki(run_id:str, dbname:str, claim_token:str) -> None:
+    # failed wikis are retried by any worker until WORK_QUEUE_MAX_ATTEMPTS is reached
+    params = {
+        'run_id' : run_id,
+        'dbname' : dbname,
+        'claim_token' : claim_token,
+        'max_attempts' : WORK_QUEUE_MAX_ATTEMPTS,
+        'now' : int(time()),
+    }
+    query = """UPDATE
+        work_queue
+    SET
+        status=IF(attempts<%(max_attempts)s, 'pending', 'failed'),
+        lease_until=0,
+        finished_at=IF(attempts<%(max_attempts)s, NULL, %(now)s)
+    WHERE
+        run_id=%(run_id)s
+        AND dbname=%(dbname)s
+        AND claim_token=%(claim_token)s"""
+
+    _execute(query, params)
+
+
+def skip_wikis_over_budget(run_id:str, remaining_budget:float) -> int:
+    # pending (or abandoned) wikis which cannot finish within the run time budget any longer are not started
+    params = { 'run_id' : run_id, 'remaining_budget' : max(0, int(remaining_budget)), 'now' : int(time()) }
+    query = """UPDATE
+        work_queue
+    SET
+        status='skipped',
+        finished_at=%(now)s
+    WHERE
+        run_id=%(run_id)s
+        AND (status='pending' OR (status='claimed' AND lease_until<%(now)s))
+        AND (expected_duration>=%(remaining_budget)s OR %(remaining_budget)s=0)"""
+
+    return _execute(query, params)
+
+
+def query_run_started_at(run_id:str) -> float:
+    query = """SELECT
+        created_at
+    FROM
+        work_run
+    WHERE
+        run_id=%(run_id)s"""
+
+    result = ToolDB.query_tooldb(query, params={ 'run_id' : run_id })
+    if len(result) == 0:
+        return time()
+
+    return float(result[0]['created_at'])
+
+
+@contextmanager
+def lease_heartbeat(run_id:str, dbname:str, claim_token:str) -> Generator[None, None, None]:
+    stop = Event()
+
+    def heartbeat() -> None:
+        while not stop.wait(WORK_QUEUE_HEARTBEAT):
+            try:
+                renewed = renew_lease(run_id, dbname, claim_token)
+            except RuntimeWarning:
+                continue  # retried with the next heartbeat; the lease outlasts several heartbeats
+            if renewed is not True:
+                LOG.warn(f'Lease of {dbname} was lost; another worker may claim it')
+                return
+
+    thread = Thread(target=heartbeat, name=f'lease-{dbname}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def fail_abandoned_wikis(run_id:str) -> int:
+    # expired claims without attempts left (pod crashed on the last attempt) can never be reclaimed
+    params = { 'run_id' : run_id, 'max_attempts' : WORK_QUEUE_MAX_ATTEMPTS, 'now' : int(time()) }
+    query = """UPDATE
+        work_queue
+    SET
+        status='failed',
+        finished_at=%(now)s
+    WHERE
+        run_id=%(run_id)s
+        AND status='claimed'
+        AND lease_until<%(now)s
+        AND attempts>=%(max_attempts)s"""
+
+    failed = _execute(query, params)
+    if failed > 0:
+        LOG.warn(f'{failed} abandoned wikis of run {run_id} failed; no attempts left')
+
+    return failed
+
+
+def query_queue_is_drained(run_id:str) -> bool:
+    # no wiki is waiting or being worked on; expired claims with attempts left will be reclaimed,
+    # expired claims without attempts left count as finished
+    query = """SELECT
+        COUNT(*) AS cnt
+    FROM
+        work_queue
+    WHERE
+        run_id=%(run_id)s
+        AND (
+            (status='claimed' AND (lease_until>=%(now)s OR attempts<%(max_attempts)s))
+            OR (status='pending' AND attempts<%(max_attempts)s)
+        )"""
+
+    params = { 'run_id' : run_id, 'max_attempts' : WORK_QUEUE_MAX_ATTEMPTS, 'now' : int(time()) }
+    result = ToolDB.query_tooldb(query, params=params)
+
+    return result[0]['cnt'] == 0
+
+
+def claim_run_report(run_id:str) -> bool:
+    # exactly one worker of a run writes the run-wide reports
+    query = """UPDATE
+        work_run
+    SET
+        reported=1
+    WHERE
+        run_id=%(run_id)s
+        AND reported=0"""
+
+    return _execute(query, { 'run_id' : run_id }) > 0
+
+
+def query_run_summary(run_id:str) -> dict[str, int]:
+    query = """SELECT
+        CONVERT(status USING utf8mb4) AS status,
+        COUNT(*) AS cnt
+    FROM
+        work_queue
+    WHERE
+        run_id=%(run_id)s
+    GROUP BY
+        status"""
+
+    return { row['status'] : row['cnt'] for row in ToolDB.query_tooldb(query, params={ 'run_id' : run_id }) }
@@ -0,0 +1,8 @@
+import logging
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+
+from delsitelinks.tasks import main_query_audit
+
+main_query_audit()
\ No newline at end of file
@@ -0,0 +1,8 @@
+import logging
+import logging.config
+
+logging.config.fileConfig('logging.conf')
+
+from delsitelinks.tasks import main_tidy_sitelinks_worker
+
+main_tidy_sitelinks_worker()
\ No newline at end of file